@@ -2,37 +2,67 @@ import logging
 import os
 import streamlit as st
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
-from dotenv import load_dotenv
-from urllib.parse import quote_plus
+from contextlib import nullcontext
 
-from src.streamlit_components import user_selector, account_balance_overview, transaction_overview, transaction_category_ui, \
-    planned_transactions_ui, close_month_ui, refresh_exchange_rates_ui, balance_checker_ui, run_dbt_models
+from src.database_engine import get_engine, session_scope
+from src.partitions import maintain_partitions
+from src.maintenance import run_overdue_maintenance
+from src.instrumentation import collect_query_stats, query_scope
+from src.tracing import span, flush_metrics
+from src.reference_data import pinned_versions
+from src.streamlit_components import user_selector, period_selector, account_balance_overview, transaction_overview, \
+    transaction_category_ui, planned_transactions_ui, close_month_ui, refresh_exchange_rates_ui, balance_checker_ui, run_dbt_models, \
+    partition_report_ui, query_debug_panel, monthly_totals_ui
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 LOGGER = logging.getLogger("budget_main")
 LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
 
-load_dotenv()  # Load environment variables from .env file
-DB_USER = quote_plus(os.getenv('DB_USER', '').encode())
-DB_PASSWORD = quote_plus(os.getenv('DB_PASSWORD', '').encode())
-DB_HOST = quote_plus(os.getenv('DB_HOST', '').encode())
-DB_PORT = quote_plus(os.getenv('DB_PORT', '').encode())
-DB_NAME = quote_plus(os.getenv('DB_NAME', '').encode())
-
-engine = create_engine(
-    f"postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
-with Session(engine) as session:
-    with session.begin():
-        st.set_page_config(page_title="Data Entry", layout="wide", page_icon='🔢')
-        st.title("Budget Tracker")
-        run_dbt_models()
-        refresh_exchange_rates_ui(session)
-        user_selector(session)
-        balance_checker_ui(session)
-        transaction_overview(session)
-        account_balance_overview(session)
-        transaction_category_ui(session)
-        planned_transactions_ui(session)
-        close_month_ui(session)
\ No newline at end of file
+QUERY_DEBUG_PANEL = os.getenv("QUERY_DEBUG_PANEL", "false").lower() in ("1", "true", "yes")
+
+engine = get_engine()
+
+@st.cache_resource(ttl="24h", show_spinner=False)
+def partition_maintenance():
+    """Create the upcoming transaction partitions when the app starts and then once a day"""
+    with session_scope(engine) as session:
+        return maintain_partitions(session)
+
+@st.cache_resource(ttl="1h", show_spinner=False)
+def overdue_maintenance():
+    """Mark the overdue planned transactions at startup and then hourly, the watermark limits the update to the first run of each day"""
+    with session_scope(engine) as session:
+        return run_overdue_maintenance(session)
+
+partition_maintenance()
+overdue_maintenance()
+st.set_page_config(page_title="Data Entry", layout="wide", page_icon='🔢')
+st.title("Budget Tracker")
+def run_component(component):
+    # Every component gets its own short-lived session so a connection is only held while that component talks to the database
+    with span(component.__name__), session_scope(engine) as session, query_scope(component.__name__):
+        component(session)
+
+# The panels are fragments keyed by their component name: their widgets only rerun the panel and a save reruns the panels
+# listed in PANEL_DEPENDENTS as well. The selected user and period are inputs of every panel, changing them reruns the page.
+# The cached accounts and categories of the selected user are checked against its data version once per rerun.
+try:
+    with span("rerun"), pinned_versions(), collect_query_stats() if QUERY_DEBUG_PANEL else nullcontext() as query_stats:
+        for component in [run_dbt_models, refresh_exchange_rates_ui]:
+            st.fragment(run_component, key=component.__name__)(component)
+        run_component(user_selector)
+        period_selector()
+        for component in [balance_checker_ui,
+                          transaction_overview,
+                          account_balance_overview,
+                          monthly_totals_ui,
+                          transaction_category_ui,
+                          planned_transactions_ui,
+                          close_month_ui,
+                          partition_report_ui]:
+            st.fragment(run_component, key=component.__name__)(component)
+finally:
+    # Spans are exported after every full rerun, also when a component stopped or restarted the script
+    flush_metrics()
+if QUERY_DEBUG_PANEL:
+    query_debug_panel(query_stats)
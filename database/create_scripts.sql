@@ -42,6 +42,8 @@ CREATE TABLE "app"."transaction_categories" (
   "effective_to" timestamp
 );
 
+CREATE INDEX ON "app"."transaction_categories" ("user_id");
+
 CREATE TABLE "app"."recurring_transactions" (
   "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
   "user_id" integer,
@@ -51,6 +53,8 @@ CREATE TABLE "app"."recurring_transactions" (
   "due_date_day" integer
 );
 
+CREATE INDEX ON "app"."recurring_transactions" ("user_id");
+
 CREATE TABLE "app"."planned_transactions" (
   "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
   "category_id" integer,
@@ -63,6 +67,12 @@ CREATE TABLE "app"."planned_transactions" (
   "realized_date" timestamp
 );
 
+CREATE INDEX ON "app"."planned_transactions" ("user_id", "due_date");
+
+CREATE INDEX ON "app"."planned_transactions" ("transaction_id");
+
+CREATE INDEX ON "app"."planned_transactions" ("due_date") WHERE "transaction_status" = 'planned';
+
 CREATE TABLE "app"."accounts" (
   "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
   "user_id" integer,
@@ -73,15 +83,50 @@ CREATE TABLE "app"."accounts" (
   "effective_to" date
 );
 
+CREATE INDEX ON "app"."accounts" ("user_id");
+
 CREATE TABLE "app"."current_account_balance" (
   "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
   "user_id" integer,
-  "account_id" integer,
+  "account_id" integer UNIQUE,
   "balance" numeric,
   "currency" varchar DEFAULT 'HUF',
   "last_modified_date" date
 );
 
+CREATE INDEX ON "app"."current_account_balance" ("user_id");
+
+CREATE TABLE "app"."postings" (
+  "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  "user_id" integer,
+  "account_id" integer,
+  "transaction_id" integer,
+  "amount" numeric NOT NULL,
+  "currency" varchar DEFAULT 'HUF',
+  "date" timestamp NOT NULL,
+  "created_at" timestamp NOT NULL DEFAULT (now()),
+  "reconciliation" boolean NOT NULL DEFAULT false
+);
+
+CREATE INDEX ON "app"."postings" ("transaction_id");
+
+CREATE INDEX ON "app"."postings" ("user_id", "account_id");
+
+CREATE TABLE "app"."monthly_totals" (
+  "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  "user_id" integer NOT NULL,
+  "month" date NOT NULL,
+  "category_id" integer NOT NULL,
+  "account_id" integer NOT NULL,
+  "target_account_id" integer,
+  "transaction_type" "app"."transaction_type" NOT NULL,
+  "currency" varchar NOT NULL,
+  "amount" numeric NOT NULL,
+  "transaction_count" integer NOT NULL
+);
+
+CREATE UNIQUE INDEX ON "app"."monthly_totals" ("user_id", "month", "category_id", "account_id", "target_account_id", "transaction_type", "currency") NULLS NOT DISTINCT;
+
 CREATE TABLE "app"."balance_history" (
   "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
   "user_id" integer,
@@ -92,6 +137,8 @@ CREATE TABLE "app"."balance_history" (
   "created_at" date
 );
 
+CREATE INDEX ON "app"."balance_history" ("user_id", "account_id", "month");
+
 CREATE TABLE "app"."users" (
   "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
   "first_name" varchar,
@@ -103,9 +150,13 @@ CREATE TABLE "app"."exchange_rates" (
   "from_currency" varchar,
   "to_currency" varchar,
   "rate" numeric,
-  "date" date
+  "date" date,
+  "loaded_at" timestamp NOT NULL DEFAULT (now()),
+  UNIQUE ("from_currency", "to_currency", "date")
 );
 
+CREATE INDEX ON "app"."exchange_rates" ("loaded_at");
+
 CREATE TABLE "app"."closed_months" (
   "id" INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
   "user_id" integer,
@@ -113,6 +164,8 @@ CREATE TABLE "app"."closed_months" (
   "year" integer
 );
 
+CREATE INDEX ON "app"."closed_months" ("user_id", "year", "month");
+
 CREATE TABLE "app"."date_dim" (
   "date_id" integer PRIMARY KEY,
   "date" date,
@@ -124,4 +177,20 @@ CREATE TABLE "app"."date_dim" (
   "is_holiday" bool
 );
 
+CREATE TABLE "app"."user_data_versions" (
+  "user_id" integer PRIMARY KEY,
+  "version" bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE "app"."maintenance_runs" (
+  "task" varchar PRIMARY KEY,
+  "watermark" date NOT NULL,
+  "last_run_at" timestamp NOT NULL,
+  "rows_affected" integer
+);
+
 COMMENT ON TABLE "app"."transactions" IS 'Partitioned by date and user_id';
+COMMENT ON TABLE "app"."postings" IS 'One signed leg per account per transaction in the account currency, append-only: edits and deletes add reversing legs. Adjustments and opening balances have no transaction_id';
+COMMENT ON TABLE "app"."monthly_totals" IS 'Transaction amounts and counts per user, month, category, account pair, type and currency, kept up to date by the dml functions';
+COMMENT ON TABLE "app"."user_data_versions" IS 'Bumped on every change of a user''s accounts, categories or recurring transactions, used to invalidate the cached reference data';
+COMMENT ON TABLE "app"."maintenance_runs" IS 'Last run of each scheduled maintenance task, the watermark is the day it covered';
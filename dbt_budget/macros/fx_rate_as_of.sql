@@ -0,0 +1,7 @@
+{% macro fx_rate_as_of(fx, currency, as_of) -%}
+  {#- Join condition picking the HUF rate of the currency that was valid at as_of from int_budget_app__fx_rate_intervals -#}
+  {{ fx }}.from_currency = {{ currency }}
+    and {{ fx }}.to_currency = 'HUF'
+    and ({{ fx }}.valid_from is null or {{ fx }}.valid_from <= {{ as_of }})
+    and ({{ fx }}.valid_to is null or {{ fx }}.valid_to > {{ as_of }})
+{%- endmacro %}
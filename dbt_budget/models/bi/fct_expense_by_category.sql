@@ -1,30 +1,46 @@
 with 
 
-transactions_with_category as (
-  select * from {{ ref('int_budget_app__huf_transactions_with_category') }}
+monthly_totals as (
+  select * from {{ ref('int_budget_app__monthly_transaction_totals') }}
 ),
 
-filtered_transactions as (
+fx_rates as (
+  select * from {{ ref('int_budget_app__fx_rate_intervals') }}
+),
+
+transaction_categories as (
+  select * from {{ ref('stg_budget_app__transaction_categories') }}
+),
+
+accounts as (
+  select * from {{ ref('stg_budget_app__accounts') }}
+),
+
+filtered_totals as (
   select
-    t.huf_amount,
-    t.category,
-    t.date,
-    t.transaction_type
-  from transactions_with_category t
+    t.amount * coalesce(fx.rate, 1) as huf_amount,
+    tc.category,
+    t.month
+  from monthly_totals t
+  join transaction_categories tc on t.category_id = tc.category_id
+  join accounts src_a on t.account_id = src_a.account_id
+  left join accounts tgt_a on t.target_account_id = tgt_a.account_id
+  -- Monthly totals are converted with the rate of the month's last day, the newest rate for the running month
+  left join fx_rates fx on {{ fx_rate_as_of('fx', 't.currency', "cast(t.month + interval '1 month' - interval '1 day' as date)") }}
   where 1=1
-    and t.category <> 'Income'
-    and ((t.source_type <> t.target_type) or t.target_type is NULL)
-    and not (t.source_type = 'saving' and t.target_type = 'bank')
+    and tc.category <> 'Income'
+    and ((src_a.account_type <> tgt_a.account_type) or tgt_a.account_type is NULL)
+    and not (src_a.account_type = 'saving' and tgt_a.account_type = 'bank')
 ),
 
 summary_tbl as(
   select
     category,
-    date_trunc('month', cast(date as timestamp)) as date,
+    cast(month as timestamp) as date,
     sum(huf_amount) as sum
-  from filtered_transactions
-  group by category, date_trunc('month', cast(date as timestamp))
+  from filtered_totals
+  group by category, month
   order by category asc, date asc
 )
 
-select * from summary_tbl
\ No newline at end of file
+select * from summary_tbl
@@ -1,23 +1,37 @@
 with 
 
-transactions_with_income_expense as (
-  select * from {{ ref('int_budget_app__huf_transactions_with_category') }}
+monthly_totals as (
+  select * from {{ ref('int_budget_app__monthly_transaction_totals') }}
+  where month = date_trunc('month', now())
 ),
 
-filtered_transactions as (
+fx_rates as (
+  select * from {{ ref('int_budget_app__fx_rate_intervals') }}
+),
+
+accounts as (
+  select * from {{ ref('stg_budget_app__accounts') }}
+),
+
+filtered_totals as (
   select
-    t.huf_amount,
-    t.inc_exp
-  from transactions_with_income_expense t
+    t.amount * coalesce(fx.rate, 1) as huf_amount,
+    case
+      when t.transaction_type = 'credit' then 'income'
+      else 'expense'
+    end as inc_exp
+  from monthly_totals t
+  join accounts src_a on t.account_id = src_a.account_id
+  left join accounts tgt_a on t.target_account_id = tgt_a.account_id
+  -- Monthly totals are converted with the rate of the month's last day, the newest rate for the running month
+  left join fx_rates fx on {{ fx_rate_as_of('fx', 't.currency', "cast(t.month + interval '1 month' - interval '1 day' as date)") }}
   where 1=1 
-    and ((t.source_type <> t.target_type) or t.target_type is null)
-    and not (t.source_type = 'saving' and t.target_type = 'bank')
-    and t.date >= date_trunc('month', now())
-    and t.date < date_trunc('month', (now() + interval '1 month'))
+    and ((src_a.account_type <> tgt_a.account_type) or tgt_a.account_type is null)
+    and not (src_a.account_type = 'saving' and tgt_a.account_type = 'bank')
 )
 
 select
   inc_exp,
   sum(huf_amount) as sum
-from filtered_transactions
-group by inc_exp
\ No newline at end of file
+from filtered_totals
+group by inc_exp
@@ -0,0 +1,127 @@
+{{
+  config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key=['from_currency', 'to_currency', 'rate_date'],
+    indexes=[{'columns': ['from_currency', 'to_currency', 'rate_date'], 'unique': True}]
+  )
+}}
+
+with
+
+exchange_rates as (
+  select * from {{ ref('stg_budget_app__exchange_rates') }}
+),
+
+changed_rates as (
+  select
+    from_currency,
+    to_currency,
+    rate,
+    date as rate_date,
+    loaded_at
+  from exchange_rates
+  {% if is_incremental() %}
+  -- Only the rates inserted or updated since the last run, found through the loaded_at index.
+  -- loaded_at is the start of the loading transaction, so a load that commits after a run can carry an older
+  -- loaded_at than the watermark: the rates of the reload window are read again, rewriting them is idempotent.
+  where loaded_at > (
+    select coalesce(max(loaded_at), '-infinity') - interval '{{ var("fx_rate_reload_window", "1 hour") }}'
+    from {{ this }}
+  )
+  {% endif %}
+),
+
+{% if is_incremental() %}
+-- The stored intervals right before and after each changed rate: the one before now ends at the changed rate,
+-- the one after supplies the end of the changed rate's interval and is rewritten when it was the first of its pair
+neighbours as (
+  select
+    i.from_currency,
+    i.to_currency,
+    i.rate,
+    i.rate_date,
+    i.valid_from,
+    i.valid_to,
+    i.loaded_at,
+    bool_or(i.is_before or i.valid_from is null) as is_written
+  from changed_rates c
+  cross join lateral (
+    (
+      select p.*, true as is_before
+      from {{ this }} p
+      where p.from_currency = c.from_currency
+        and p.to_currency = c.to_currency
+        and p.rate_date < c.rate_date
+      order by p.rate_date desc
+      limit 1
+    )
+    union all
+    (
+      select p.*, false as is_before
+      from {{ this }} p
+      where p.from_currency = c.from_currency
+        and p.to_currency = c.to_currency
+        and p.rate_date > c.rate_date
+      order by p.rate_date
+      limit 1
+    )
+  ) i
+  where not exists (
+    select 1
+    from changed_rates c2
+    where c2.from_currency = i.from_currency
+      and c2.to_currency = i.to_currency
+      and c2.rate_date = i.rate_date
+  )
+  group by i.from_currency, i.to_currency, i.rate, i.rate_date, i.valid_from, i.valid_to, i.loaded_at
+),
+{% endif %}
+
+candidates as (
+  select
+    from_currency,
+    to_currency,
+    rate,
+    rate_date,
+    cast(null as date) as stored_valid_from,
+    cast(null as date) as stored_valid_to,
+    loaded_at,
+    true as is_written
+  from changed_rates
+  {% if is_incremental() %}
+  union all
+  select from_currency, to_currency, rate, rate_date, valid_from, valid_to, loaded_at, is_written
+  from neighbours
+  {% endif %}
+),
+
+intervals as (
+  select
+    from_currency,
+    to_currency,
+    rate,
+    rate_date,
+    -- The first rate of a pair is also used for the dates before it. A changed rate without a stored rate before
+    -- it is the first one, the stored interval before the changed rates keeps its start.
+    case
+      when lag(rate_date) over pair_dates is null then stored_valid_from
+      else rate_date
+    end as valid_from,
+    coalesce(lead(rate_date) over pair_dates, stored_valid_to) as valid_to,
+    loaded_at,
+    is_written
+  from candidates
+  window pair_dates as (partition by from_currency, to_currency order by rate_date)
+)
+
+select
+  from_currency,
+  to_currency,
+  rate,
+  rate_date,
+  valid_from,
+  valid_to,
+  loaded_at
+from intervals
+where is_written
@@ -1,7 +1,7 @@
 with 
 
 fx_rate as (
-    select * from {{ ref('int_budget_app__latest_fx_rate') }}
+    select * from {{ ref('int_budget_app__fx_rate_intervals') }}
 ),
 
 accounts as (
@@ -21,7 +21,8 @@ src as (
         bh.month
     from balance_history bh
     join accounts a on a.account_id = bh.account_id
-    join fx_rate fx on fx.from_currency = bh.currency
+    -- The balance of a closed month is converted with the rate of its last day
+    join fx_rate fx on {{ fx_rate_as_of('fx', 'bh.currency', "cast(bh.month + interval '1 month' - interval '1 day' as date)") }}
 )
 
 select * from src
\ No newline at end of file
@@ -1,7 +1,10 @@
+{# Amounts are converted with the rate valid on the transaction date #}
+{{ config(materialized='view') }}
+
 with 
 
 fx_rates as (
-  select * from {{ ref('int_budget_app__latest_fx_rate') }}
+  select * from {{ ref('int_budget_app__fx_rate_intervals') }}
 ),
 
 transaction_categories as (
@@ -18,6 +21,8 @@ accounts as (
 
 transactions_with_category as (
   select
+    t.transaction_id,
+    t.user_id,
     t.amount,
     t.currency,
     t.date,
@@ -35,6 +40,8 @@ transactions_with_category as (
 
 transactions_with_fx as (
   select
+    t.transaction_id,
+    t.user_id,
     t.amount * coalesce(fx.rate, 1) as huf_amount,
     t.category,
     t.date,
@@ -48,7 +55,7 @@ transactions_with_fx as (
     t.target_account,
     t.target_type
   from transactions_with_category t
-  left join fx_rates fx on t.currency = fx.from_currency
+  left join fx_rates fx on {{ fx_rate_as_of('fx', 't.currency', 't.date') }}
 )
 
 select * from transactions_with_fx
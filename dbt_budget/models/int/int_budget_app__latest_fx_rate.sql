@@ -1,31 +1,17 @@
-with
+{# The open interval of every pair is its newest rate, no ranking of the rate history needed #}
+{{ config(materialized='view') }}
 
-exchange_rates as (
-    select * from {{ ref('stg_budget_app__exchange_rates') }}
-),
+with
 
-rates_window as (
-    SELECT
-          from_currency,
-          to_currency,
-          rate,
-          "date",
-          ROW_NUMBER() OVER (
-            PARTITION BY from_currency,
-            to_currency
-            ORDER BY
-              "date" DESC
-          ) AS rn
-        FROM
-          exchange_rates
-        WHERE
-          to_currency = 'HUF'
+fx_rate_intervals as (
+    select * from {{ ref('int_budget_app__fx_rate_intervals') }}
 )
 
 SELECT
   from_currency,
   to_currency,
   rate,
-  "date"
-FROM rates_window
-WHERE rn = 1
+  rate_date as "date"
+FROM fx_rate_intervals
+WHERE to_currency = 'HUF'
+  AND valid_to IS NULL
@@ -0,0 +1,20 @@
+{# app.monthly_totals is kept up to date by the dml functions, the model reads one row per group instead of the transactions #}
+{{ config(materialized='view') }}
+
+with 
+
+monthly_totals as (
+  select * from {{ ref('stg_budget_app__monthly_totals') }}
+)
+
+select
+  user_id,
+  month,
+  category_id,
+  account_id,
+  target_account_id,
+  transaction_type,
+  currency,
+  amount,
+  transaction_count
+from monthly_totals
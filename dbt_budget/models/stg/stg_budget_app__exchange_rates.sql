@@ -10,9 +10,10 @@ select
         from_currency,
         to_currency,
         rate,
-        date
+        date,
+        loaded_at
 
     from source
 )
 
-select * from renamed
\ No newline at end of file
+select * from renamed
@@ -0,0 +1,23 @@
+with 
+
+source as (
+    select * from {{ source('budget_app', 'monthly_totals') }}
+),
+
+renamed as (
+    select
+        id as monthly_total_id,
+        user_id,
+        month,
+        category_id,
+        account_id,
+        target_account_id,
+        transaction_type,
+        currency,
+        amount,
+        transaction_count
+
+    from source
+)
+
+select * from renamed
@@ -1,7 +1,8 @@
 from sqlalchemy import (
-    Column, Integer, String, Numeric, Date, DateTime, Boolean, Enum
+    Column, Integer, BigInteger, String, Numeric, Date, DateTime, Boolean, Enum, Index, UniqueConstraint, text
 )
 from sqlalchemy.orm import declarative_base
+from datetime import datetime
 import enum
 
 Base = declarative_base()
@@ -36,7 +37,7 @@ class Account(Base):
     __tablename__ = 'accounts'
     __table_args__ = {'schema': 'app'}
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer)
+    user_id = Column(Integer, index=True)
     account_name = Column(String)
     account_type = Column(String)
     currency = Column(String, default='HUF')
@@ -47,14 +48,15 @@ class TransactionCategory(Base):
     __tablename__ = 'transaction_categories'
     __table_args__ = {'schema': 'app'}
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer)
+    user_id = Column(Integer, index=True)
     category = Column(String, nullable=False)
     effective_from = Column(DateTime, nullable=False)
     effective_to = Column(DateTime)
 
 class Transaction(Base):
     __tablename__ = 'transactions'
-    __table_args__ = {'schema': 'app'}
+    # Matches the (user_id, date) index every monthly partition gets
+    __table_args__ = (Index('ix_app_transactions_user_id_date', 'user_id', 'date'), {'schema': 'app'})
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer)
     account_id = Column(Integer)
@@ -70,7 +72,7 @@ class RecurringTransaction(Base):
     __tablename__ = 'recurring_transactions'
     __table_args__ = {'schema': 'app'}
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer)
+    user_id = Column(Integer, index=True)
     category_id = Column(Integer)
     recurrence = Column(Enum(RecurrenceEnum, name="recurrence"))
     amount = Column(Numeric)
@@ -78,11 +80,16 @@ class RecurringTransaction(Base):
 
 class PlannedTransaction(Base):
     __tablename__ = 'planned_transactions'
-    __table_args__ = {'schema': 'app'}
+    __table_args__ = (
+        Index('ix_app_planned_transactions_user_id_due_date', 'user_id', 'due_date'),
+        # Only the still planned rows, for marking the overdue ones of every user at once
+        Index('ix_app_planned_transactions_planned_due_date', 'due_date', postgresql_where=text("transaction_status = 'planned'")),
+        {'schema': 'app'}
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     category_id = Column(Integer)
     user_id = Column(Integer)
-    transaction_id = Column(Integer)
+    transaction_id = Column(Integer, index=True)
     transaction_status = Column(Enum(TransactionStatusEnum, name="transaction_status", schema="app"))
     amount = Column(Numeric)
     currency = Column(String, default='HUF')
@@ -93,15 +100,48 @@ class CurrentAccountBalance(Base):
     __tablename__ = 'current_account_balance'
     __table_args__ = {'schema': 'app'}
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer)
-    account_id = Column(Integer)
+    user_id = Column(Integer, index=True)
+    account_id = Column(Integer, unique=True)
     balance = Column(Numeric)
     currency = Column(String, default='HUF')
     last_modified_date = Column(Date)
 
+class Posting(Base):
+    __tablename__ = 'postings'
+    __table_args__ = (Index('ix_app_postings_user_id_account_id', 'user_id', 'account_id'), {'schema': 'app'})
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer)
+    account_id = Column(Integer)
+    transaction_id = Column(Integer, index=True)
+    amount = Column(Numeric, nullable=False)
+    currency = Column(String, default='HUF')
+    date = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    # Adjustments posted by the balance reconciliation, they correct the ledger and are not movements of the account
+    reconciliation = Column(Boolean, nullable=False, default=False, server_default=text("false"))
+
+class MonthlyTotal(Base):
+    __tablename__ = 'monthly_totals'
+    __table_args__ = (
+        # One row per group, a transaction without a target account belongs to the group with a null target_account_id
+        Index('ix_app_monthly_totals_group', 'user_id', 'month', 'category_id', 'account_id', 'target_account_id', 'transaction_type', 'currency',
+              unique=True, postgresql_nulls_not_distinct=True),
+        {'schema': 'app'}
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False)
+    month = Column(Date, nullable=False)
+    category_id = Column(Integer, nullable=False)
+    account_id = Column(Integer, nullable=False)
+    target_account_id = Column(Integer)
+    transaction_type = Column(Enum(TransactionTypeEnum, name="transaction_type"), nullable=False)
+    currency = Column(String, nullable=False)
+    amount = Column(Numeric, nullable=False)
+    transaction_count = Column(Integer, nullable=False)
+
 class BalanceHistory(Base):
     __tablename__ = 'balance_history'
-    __table_args__ = {'schema': 'app'}
+    __table_args__ = (Index('ix_app_balance_history_user_id_account_id_month', 'user_id', 'account_id', 'month'), {'schema': 'app'})
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer)
     account_id = Column(Integer)
@@ -112,16 +152,22 @@ class BalanceHistory(Base):
 
 class ExchangeRate(Base):
     __tablename__ = 'exchange_rates'
-    __table_args__ = {'schema': 'app'}
+    __table_args__ = (
+        UniqueConstraint('from_currency', 'to_currency', 'date'),
+        Index('ix_app_exchange_rates_loaded_at', 'loaded_at'),
+        {'schema': 'app'}
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     from_currency = Column(String)
     to_currency = Column(String)
     rate = Column(Numeric)
     date = Column(Date)
+    # Set on every insert and update, the incremental fx rate interval model picks up the rates loaded since its last run
+    loaded_at = Column(DateTime, nullable=False, server_default=text("now()"))
 
 class ClosedMonth(Base):
     __tablename__ = 'closed_months'
-    __table_args__ = {'schema': 'app'}
+    __table_args__ = (Index('ix_app_closed_months_user_id_year_month', 'user_id', 'year', 'month'), {'schema': 'app'})
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer)
     month = Column(Integer)
@@ -138,3 +184,17 @@ class DateDim(Base):
     day = Column(Integer)
     is_weekend = Column(Boolean)
     is_holiday = Column(Boolean)
+
+class UserDataVersion(Base):
+    __tablename__ = 'user_data_versions'
+    __table_args__ = {'schema': 'app'}
+    user_id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+class MaintenanceRun(Base):
+    __tablename__ = 'maintenance_runs'
+    __table_args__ = {'schema': 'app'}
+    task = Column(String, primary_key=True)
+    watermark = Column(Date, nullable=False)
+    last_run_at = Column(DateTime, nullable=False)
+    rows_affected = Column(Integer)
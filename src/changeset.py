@@ -0,0 +1,85 @@
+import pandas as pd
+
+from dataclasses import dataclass, field
+
+@dataclass
+class Changeset:
+    """Rows to insert and update as lists of dicts, and the keys of the deleted rows."""
+    inserts: list = field(default_factory=list)
+    updates: list = field(default_factory=list)
+    deletes: list = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.inserts or self.updates or self.deletes)
+
+def _records(df):
+    # NaN / NaT become None so the dml layer sees the same values as with iterrows().get()
+    return [{k: (None if not isinstance(v, (list, dict)) and pd.isna(v) else v) for k, v in rec.items()} for rec in df.to_dict("records")]
+
+def diff_frames(original, edited, key, columns, lookups=None, rename=None):
+    """
+    Compare the frame given to st.data_editor with the edited frame in one merge on `key`.
+
+    Rows without a key are inserts, rows whose key disappeared are deletes and rows where any of `columns` changed are updates.
+    `lookups` maps a display column to a {label: id} dict, the label is replaced by its id in the returned rows.
+    `rename` maps display column names to the field names the dml layer expects, the key included.
+    """
+    lookups = lookups or {}
+    rename = rename or {}
+    edited = edited.reindex(columns=[key] + columns)
+    for col, mapping in lookups.items():
+        edited[col] = edited[col].map(mapping).astype("Int64")
+
+    new_rows = edited[edited[key].isna()].drop(columns=[key])
+    new_rows = new_rows[new_rows.notna().any(axis=1)]
+
+    original = original.reindex(columns=[key] + columns)
+    original_keys = original[original[key].notna()].copy()
+    for col, mapping in lookups.items():
+        original_keys[col] = original_keys[col].map(mapping).astype("Int64")
+    merged = original_keys.merge(edited[edited[key].notna()], on=key, how="outer", suffixes=("_orig", ""), indicator=True)
+
+    deleted = merged.loc[merged["_merge"] == "left_only", key]
+    kept = merged[merged["_merge"] != "left_only"]
+    changed = pd.Series(False, index=kept.index)
+    for col in columns:
+        before, after = kept[f"{col}_orig"], kept[col]
+        both_null = before.isna() & after.isna()
+        changed |= ~both_null & ((before != after) | before.isna() | after.isna())
+    updated = kept.loc[changed, [key] + columns]
+    updated[key] = updated[key].astype(int)
+
+    return Changeset(
+        inserts=_records(new_rows.rename(columns=rename)),
+        updates=_records(updated.rename(columns=rename)),
+        deletes=[int(k) for k in deleted]
+    )
+
+def apply_editor_state(original, state, date_columns=()):
+    """
+    Rebuild the frame st.data_editor returns from the editing state it keeps in st.session_state under its key.
+
+    Button callbacks run before the editor returns the frame of the current run, so they read the edits from the state:
+    cell edits and deletions by row position, then the added rows, in the order the editor applies them.
+    Dates arrive as ISO strings, the values of `date_columns` are parsed like the editor does.
+    """
+    def parse(col, value):
+        if col not in date_columns or value is None:
+            return value
+        value = pd.Timestamp(value)
+        return value if pd.api.types.is_datetime64_any_dtype(original[col]) else value.date()
+
+    edited = original.astype(object)
+    for position, values in state.get("edited_rows", {}).items():
+        for col, value in values.items():
+            if col in edited.columns:
+                edited.iat[int(position), edited.columns.get_loc(col)] = parse(col, value)
+    edited = edited.drop(index=edited.index[list(state.get("deleted_rows", []))])
+    added = [{col: parse(col, row.get(col)) for col in edited.columns} for row in state.get("added_rows", [])]
+    if added:
+        edited = pd.concat([edited, pd.DataFrame(added, columns=edited.columns, dtype=object)], ignore_index=True)
+    return edited
+
+def invert(mapping):
+    """Turn an {id: label} dict into {label: id}, keeping the first id of duplicated labels."""
+    return {v: k for k, v in reversed(list(mapping.items()))}
@@ -1,17 +1,24 @@
 import logging
 import os
 
-from sqlalchemy import extract
-from datetime import datetime, timedelta
+from sqlalchemy import func, insert, literal, update, delete, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from datetime import datetime
 from decimal import Decimal
-from models import User, TransactionCategory, Account, CurrentAccountBalance, Transaction, RecurringTransaction, PlannedTransaction, BalanceHistory, ExchangeRate, ClosedMonth, TransactionStatusEnum
-from src.web_data import fetch_exchange_rates
+from models import User, TransactionCategory, Account, CurrentAccountBalance, Transaction, RecurringTransaction, PlannedTransaction, BalanceHistory, ExchangeRate, ClosedMonth, Posting, TransactionStatusEnum, TransactionTypeEnum
+from src.web_data import fetch_exchange_rates, fetch_historical_exchange_rates
+from src.exchange_rate_cache import get_exchange_rate_cache
+from src.recurrence import plan_recurring_transactions
+from src.instrumentation import instrumented
+from src.reference_data import bump_data_version, get_reference_data
+from src.monthly_totals import apply_monthly_totals
 
 # Logger configuration
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 LOGGER = logging.getLogger("budget_database_func")
 LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
 
+@instrumented
 def add_new_user(first_name, last_name, session, balance=0.0):
 
     default_categories = ["Water", "Electricity", "Heating", "Telco", "Common Expenses", "Bank Charges", "Car", "BKV", "Correction"]
@@ -36,9 +43,11 @@ def add_new_user(first_name, last_name, session, balance=0.0):
                                   balance=balance, 
                                   transaction_type="credit", 
                                   session=session)
+    bump_data_version(new_user.id, session)
 
     return new_user.id, default_account.id
 
+@instrumented
 def add_modify_account(user_id, account_name, account_type, session, currency='HUF', amount=0.0, account_id=None):
     if account_id:
         acct = session.query(Account).filter_by(id=account_id, user_id=user_id, effective_to=None).first()
@@ -68,7 +77,15 @@ def add_modify_account(user_id, account_name, account_type, session, currency='H
         balance = session.query(CurrentAccountBalance).filter_by(account_id=acct.id, user_id=user_id).first()
 
         if balance:
-            balance.balance = amount
+            # The new balance is reached with an adjustment posting of the difference
+            difference = Decimal(amount) - balance.balance
+            create_modify_account_balance(
+                account_id=acct.id,
+                user_id=user_id,
+                balance=abs(difference),
+                transaction_type="credit" if difference >= 0 else "debit",
+                session=session
+            )
             balance.last_modified_date = datetime.now().date()
             session.flush()
         else:
@@ -82,71 +99,45 @@ def add_modify_account(user_id, account_name, account_type, session, currency='H
                 session=session
             )
         session.flush()
+    bump_data_version(user_id, session)
     return acct.id  # Return the new account ID
       # Ensure the account ID is available for further operations
 
-def balance_calculation(amount, trx_currency, account_currency, date, transaction_type, user_id, account_id, session, target_account_id=None, reverse=False):
-    source_amount = currency_conversion(amount, trx_currency, account_currency, date, session)
-    if not target_account_id:
-        target_account_currency = 'HUF'
-        target_account_type = 'bank'
-    else:
-        target_account_currency = session.query(Account).filter_by(id=target_account_id).first().currency
-        target_account_type = session.query(Account).filter_by(id=target_account_id).first().account_type
-
-    if transaction_type == 'transfer':
-        target_amount = currency_conversion(amount, trx_currency, target_account_currency, date, session)
-        
-        create_modify_account_balance(account_id=account_id,
-                                      user_id=user_id,
-                                      balance=source_amount,
-                                      transaction_type="debit" if not reverse else "credit",
-                                      session=session)
-        if target_account_type == 'loan':
-            create_modify_account_balance(account_id=target_account_id,
-                                          user_id=user_id,
-                                          balance=target_amount,
-                                          transaction_type="debit" if not reverse else "credit",
-                                          session=session)
-        else:
-            create_modify_account_balance(account_id=target_account_id,
-                                          user_id=user_id,
-                                          balance=target_amount,
-                                          transaction_type="credit" if not reverse else "debit",
-                                          session=session)
-    else:
-        if not reverse:
-            t_type = transaction_type
-        else:
-            t_type = "credit" if transaction_type == "debit" else "debit"
-        create_modify_account_balance(account_id=account_id,
-                                      user_id=user_id,
-                                      balance=source_amount,
-                                      transaction_type=t_type,
-                                      session=session)
-
+@instrumented
 def create_modify_account_balance(account_id, user_id, balance, transaction_type, session, currency='HUF'):
-    # First check if the account_id, user_id pair exists in the current_account_balance table
+    """Post a balance adjustment without a transaction, e.g. an opening balance, and update the account's current balance."""
     balance = Decimal(balance)  # Ensure balance is a Decimal for accurate arithmetic operations
-    existing_balance = session.query(CurrentAccountBalance).filter_by(
-        account_id=account_id, user_id=user_id
-    ).first()
-
-    if existing_balance:
-        # If it exists, update the balance
-        if transaction_type == "debit":
-            existing_balance.balance -= balance
-        elif transaction_type == "credit":
-            existing_balance.balance += balance
-        else:
-            raise ValueError("Invalid transaction type. Use 'debit' or 'credit'.")
+    if transaction_type == "debit":
+        delta = -balance
+    elif transaction_type == "credit":
+        delta = balance
     else:
-        # If it doesn't exist, create a new record
-        new_balance = CurrentAccountBalance(
-            user_id=user_id, account_id=account_id, balance=balance, currency=currency, last_modified_date=datetime.now().date()
-        )
-        session.add(new_balance)
+        raise ValueError("Invalid transaction type. Use 'debit' or 'credit'.")
+    currency = session.query(CurrentAccountBalance.currency).filter_by(account_id=account_id, user_id=user_id).scalar() or currency
+    if delta != 0:
+        session.add(Posting(user_id=user_id, account_id=account_id, transaction_id=None, amount=delta, currency=currency, date=datetime.now()))
+    _upsert_balance_summaries(user_id, {account_id: delta}, session, {account_id: currency})
 
+def _upsert_balance_summaries(user_id, deltas, session, currencies=None):
+    """
+    Add {account_id: signed delta} to CurrentAccountBalance, the running sum of the account's postings, in one atomic statement.
+    The database adds to the stored balance under the row lock, so concurrent writers cannot overwrite each other's changes.
+    Rows are written in account order so writers touching several accounts lock them in the same order.
+    """
+    currencies = currencies or {}
+    today = datetime.now().date()
+    stmt = pg_insert(CurrentAccountBalance).values([
+        {'user_id': user_id, 'account_id': account_id, 'balance': delta, 'currency': currencies.get(account_id, 'HUF'), 'last_modified_date': today}
+        for account_id, delta in sorted(deltas.items())
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CurrentAccountBalance.account_id],
+        set_={'balance': CurrentAccountBalance.balance + stmt.excluded.balance, 'last_modified_date': stmt.excluded.last_modified_date}
+    ).returning(CurrentAccountBalance)
+    # Refresh balance objects already loaded in the session with the stored values
+    session.scalars(stmt, execution_options={'populate_existing': True}).all()
+
+@instrumented
 def add_modify_transaction_category(user_id, category_name, session, category_id=None):
     if category_id:
         cat = session.query(TransactionCategory).filter_by(id=category_id, user_id=user_id).first()
@@ -177,8 +168,10 @@ def add_modify_transaction_category(user_id, category_name, session, category_id
         
         session.flush()
         id = cat.id
+    bump_data_version(user_id, session)
     return id
 
+@instrumented
 def mark_transaction_as_recurring(user_id, category_id, session, recurrence: str = 'monthly', amount: float = 0.0, due_date_day: int = 10):
     # Check if the category exists for the user
     if recurrence not in ['daily', 'weekly', 'monthly', 'yearly']:
@@ -196,7 +189,9 @@ def mark_transaction_as_recurring(user_id, category_id, session, recurrence: str
             amount=amount
         )
         session.add(recurring_trx)
+        bump_data_version(user_id, session)
 
+@instrumented
 def add_modify_planned_transaction(user_id, category_id, due_date, amount, session, trx_currency='HUF', trx_status='planned', planned_tx_id=None):
     if planned_tx_id:
         planned_trx = session.query(PlannedTransaction).filter_by(id=planned_tx_id, user_id=user_id).first()
@@ -221,49 +216,358 @@ def add_modify_planned_transaction(user_id, category_id, due_date, amount, sessi
         planned_trx.transaction_status = trx_status
     session.flush()  # Ensure planned_trx.id is available for further operations
 
+@instrumented
+def add_modify_planned_transactions_bulk(user_id, rows, session):
+    """
+    Insert the planned transactions without an 'id' and update the ones with one, with one statement for each group.
+    Rows use the keyword arguments of add_modify_planned_transaction (category_id, due_date, amount, trx_currency, trx_status).
+    """
+    inserts, updates = [], []
+    for row in rows:
+        values = {
+            'user_id': user_id,
+            'category_id': row.get('category_id'),
+            'due_date': row.get('due_date'),
+            'amount': row.get('amount'),
+            'currency': row.get('trx_currency') or 'HUF',
+            'transaction_status': row.get('trx_status') or 'planned'
+        }
+        if row.get('id'):
+            updates.append({'id': int(row['id']), **values})
+        else:
+            inserts.append(values)
+    if updates:
+        owned = {p[0] for p in session.query(PlannedTransaction.id).filter(
+            PlannedTransaction.user_id == user_id,
+            PlannedTransaction.id.in_([u['id'] for u in updates])
+        ).all()}
+        for u in updates:
+            if u['id'] not in owned:
+                raise ValueError(f"Planned Transaction ID {u['id']} does not exist.")
+        session.execute(update(PlannedTransaction), updates)
+    if inserts:
+        session.execute(insert(PlannedTransaction), inserts)
+    session.flush()
+
+@instrumented
+def cancel_planned_transactions(user_id, planned_transaction_ids, session):
+    """Mark planned transactions as cancelled. Realized ones are left untouched."""
+    if not planned_transaction_ids:
+        return
+    session.execute(update(PlannedTransaction).where(
+        PlannedTransaction.user_id == user_id,
+        PlannedTransaction.id.in_([int(i) for i in planned_transaction_ids]),
+        PlannedTransaction.transaction_status != TransactionStatusEnum.realized
+    ).values(transaction_status=TransactionStatusEnum.cancelled))
+
+@instrumented
+def deactivate_accounts(user_id, account_ids, session):
+    """Accounts are not deleted, only marked inactive from today."""
+    if not account_ids:
+        return
+    session.execute(update(Account).where(
+        Account.user_id == user_id,
+        Account.id.in_([int(i) for i in account_ids]),
+        Account.effective_to == None
+    ).values(effective_to=datetime.now().date()))
+    bump_data_version(user_id, session)
+
+@instrumented
 def add_transaction(user_id, category_id, transaction_type, date, amount, session, account_id=None, trx_currency='HUF', comment=None, target_account_id=None):
-    # if tranfer then target_account_id must be provided
-    if not account_id:
+    # Validation, the insert and the postings take a fixed number of statements through the bulk path
+    return add_transactions_bulk(user_id, [{
+        'category_id': category_id,
+        'transaction_type': transaction_type,
+        'date': date,
+        'amount': amount,
+        'account_id': account_id,
+        'trx_currency': trx_currency,
+        'comment': comment,
+        'target_account_id': target_account_id
+    }], session)[0]
+
+@instrumented
+def add_transactions_bulk(user_id, transactions, session):
+    """
+    Insert many transactions for one user at once.
+    Each item of `transactions` is a dict with the keyword arguments of add_transaction (category_id, transaction_type, date, amount,
+    account_id, trx_currency, comment, target_account_id). Categories, closed months and accounts are validated with one query each,
+    the postings are inserted in bulk and the balance changes are summed per account before they are written, like the monthly totals.
+    """
+    if not transactions:
+        return []
+    rows = []
+    for trx in transactions:
+        transaction_type = trx.get('transaction_type')
+        if isinstance(transaction_type, TransactionTypeEnum):
+            transaction_type = transaction_type.value
+        if transaction_type not in ('debit', 'credit', 'transfer'):
+            raise ValueError("Invalid transaction type. Use 'debit', 'credit', or 'transfer'.")
+        if transaction_type == 'transfer' and not trx.get('target_account_id'):
+            raise ValueError("target_account_id must be provided for transfer transactions")
+        date = trx.get('date')
+        rows.append({
+            'user_id': user_id,
+            'account_id': trx.get('account_id'),
+            'category_id': trx.get('category_id'),
+            'target_account_id': trx.get('target_account_id'),
+            'transaction_type': transaction_type,
+            'date': datetime.strptime(date, "%Y-%m-%d") if isinstance(date, str) else date,
+            'amount': Decimal(trx.get('amount')),
+            'currency': trx.get('trx_currency') or 'HUF',
+            'comment': trx.get('comment')
+        })
+
+    # Resolve every referenced account with a single query, falling back to the default bank account
+    account_ids = {r['account_id'] for r in rows if r['account_id']} | {r['target_account_id'] for r in rows if r['target_account_id']}
+    accounts = {a.id: a for a in session.query(Account).filter(Account.id.in_(account_ids)).all()} if account_ids else {}
+    if any(not r['account_id'] for r in rows):
         default_account = session.query(Account).filter_by(user_id=user_id, account_type='bank').first()
         if not default_account:
             raise ValueError("No default bank account found.")
         LOGGER.info(f'No account provided, using default bank account: {default_account.account_name}')
-        account_id = default_account.id
-        account_currency = default_account.currency
+        accounts[default_account.id] = default_account
+        for r in rows:
+            r['account_id'] = r['account_id'] or default_account.id
+    missing_accounts = account_ids - accounts.keys()
+    if missing_accounts:
+        raise ValueError(f"Account ID {min(missing_accounts)} does not exist.")
+
+    #Validate category_ids are valid categories in the transaction_categories table
+    category_ids = {r['category_id'] for r in rows}
+    valid_categories = {c[0] for c in session.query(TransactionCategory.id).filter(
+        TransactionCategory.user_id == user_id,
+        TransactionCategory.id.in_(category_ids)
+    ).all()}
+    for category_id in category_ids:
+        if category_id not in valid_categories:
+            raise ValueError(f"Category ID {category_id} does not exist for user ID {user_id}")
+
+    # Validate no transaction date falls into a closed month
+    closed_months = set(session.query(ClosedMonth.year, ClosedMonth.month).filter(ClosedMonth.user_id == user_id).all())
+    for r in rows:
+        if (r['date'].year, r['date'].month) in closed_months:
+            raise ValueError(f"Transaction date {r['date']} is in a closed month.")
+
+    preload_exchange_rates(rows, accounts, session)
+    new_ids = session.scalars(insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True), rows).all()
+    replace_transaction_postings(user_id, dict(zip(new_ids, rows)), accounts, session, replace=False)
+    apply_monthly_totals(user_id, [], rows, session)
+    return list(new_ids)
+
+@instrumented
+def modify_transactions_bulk(user_id, changes, session):
+    """
+    Apply many transaction edits at once. Each item of `changes` holds the transaction 'id' and the fields to change, as in modify_transaction.
+    Validation runs one query per check, the legs of the edited transactions are reversed and posted again and the difference is written in one update per account.
+    The edited transactions move between their old and new monthly totals.
+    """
+    modifiable_fields = ['account_id', 'category_id', 'target_account_id', 'transaction_type', 'date', 'amount', 'currency', 'comment']
+    if not changes:
+        return []
+    changes = {int(c['id']): {k: v for k, v in c.items() if k != 'id'} for c in changes}
+    trxs = {t.id: t for t in session.query(Transaction).filter(Transaction.user_id == user_id, Transaction.id.in_(changes)).all()}
+    for transaction_id, fields in changes.items():
+        if transaction_id not in trxs:
+            raise ValueError(f"Transaction ID {transaction_id} does not exist.")
+        for key, value in fields.items():
+            if key not in modifiable_fields:
+                raise ValueError(f"Field '{key}' cannot be modified.")
+            if key == 'transaction_type' and isinstance(value, TransactionTypeEnum):
+                fields[key] = value.value
+            elif key == 'transaction_type' and value not in ('debit', 'credit', 'transfer'):
+                raise ValueError("Invalid transaction type. Use 'debit', 'credit', or 'transfer'.")
+            if key == 'date' and isinstance(value, str):
+                fields[key] = datetime.strptime(value, "%Y-%m-%d")
+            if key == 'amount':
+                fields[key] = Decimal(value)
+
+    old_rows = {t.id: {
+        'account_id': t.account_id,
+        'category_id': t.category_id,
+        'target_account_id': t.target_account_id,
+        'transaction_type': t.transaction_type.value,
+        'date': t.date,
+        'amount': t.amount,
+        'currency': t.currency
+    } for t in trxs.values()}
+    new_rows = {transaction_id: {**old_rows[transaction_id], **fields} for transaction_id, fields in changes.items()}
+    for r in new_rows.values():
+        if r['transaction_type'] == 'transfer' and not r['target_account_id']:
+            raise ValueError("target_account_id must be provided for transfer transactions")
+
+    category_ids = {f['category_id'] for f in changes.values() if 'category_id' in f}
+    if category_ids:
+        valid_categories = {c[0] for c in session.query(TransactionCategory.id).filter(
+            TransactionCategory.user_id == user_id,
+            TransactionCategory.id.in_(category_ids)
+        ).all()}
+        for category_id in category_ids:
+            if category_id not in valid_categories:
+                raise ValueError(f"Category ID {category_id} does not exist for user ID {user_id}")
+    closed_months = set(session.query(ClosedMonth.year, ClosedMonth.month).filter(ClosedMonth.user_id == user_id).all())
+    for f in changes.values():
+        if 'date' in f and (f['date'].year, f['date'].month) in closed_months:
+            raise ValueError(f"Transaction date {f['date']} is in a closed month.")
+
+    account_ids = {r['account_id'] for r in new_rows.values()} | {r['target_account_id'] for r in new_rows.values() if r['target_account_id']}
+    accounts = {a.id: a for a in session.query(Account).filter(Account.id.in_(account_ids)).all()}
+    missing_accounts = account_ids - accounts.keys()
+    if missing_accounts:
+        raise ValueError(f"Account ID {min(missing_accounts)} does not exist.")
+
+    for transaction_id, fields in changes.items():
+        for key, value in fields.items():
+            setattr(trxs[transaction_id], key, value)
+    session.flush()
+    replace_transaction_postings(user_id, new_rows, accounts, session)
+    apply_monthly_totals(user_id, [old_rows[i] for i in changes], new_rows.values(), session)
+    return list(changes)
+
+@instrumented
+def delete_transactions(user_id, transaction_ids, session):
+    """
+    Delete transactions, reverse their postings and remove their effect from the account balances and the monthly totals.
+    Planned transactions linked to a deleted transaction become planned again.
+    """
+    if not transaction_ids:
+        return
+    transaction_ids = {int(i) for i in transaction_ids}
+    trxs = session.query(Transaction).filter(Transaction.user_id == user_id, Transaction.id.in_(transaction_ids)).all()
+    missing = transaction_ids - {t.id for t in trxs}
+    if missing:
+        raise ValueError(f"Transaction ID {min(missing)} does not exist.")
+    closed_months = set(session.query(ClosedMonth.year, ClosedMonth.month).filter(ClosedMonth.user_id == user_id).all())
+    for t in trxs:
+        if (t.date.year, t.date.month) in closed_months:
+            raise ValueError(f"Transaction date {t.date} is in a closed month.")
+
+    session.execute(update(PlannedTransaction).where(
+        PlannedTransaction.user_id == user_id,
+        PlannedTransaction.transaction_id.in_(transaction_ids)
+    ).values(transaction_id=None, transaction_status=TransactionStatusEnum.planned, realized_date=None))
+    replace_transaction_postings(user_id, {t: None for t in transaction_ids}, {}, session)
+    apply_monthly_totals(user_id, [{
+        'account_id': t.account_id,
+        'category_id': t.category_id,
+        'target_account_id': t.target_account_id,
+        'transaction_type': t.transaction_type,
+        'date': t.date,
+        'amount': t.amount,
+        'currency': t.currency
+    } for t in trxs], [], session)
+    session.execute(delete(Transaction).where(Transaction.user_id == user_id, Transaction.id.in_(transaction_ids)))
+
+def preload_exchange_rates(rows, accounts, session):
+    """Load the rates of every conversion the transaction rows need with one query instead of one per row."""
+    currencies = {r['currency'] for r in rows} | {accounts[r['account_id']].currency for r in rows} | \
+        {accounts[r['target_account_id']].currency for r in rows if r['target_account_id']}
+    if len(currencies) > 1:
+        dates = [r['date'] for r in rows]
+        get_exchange_rate_cache(session).preload(session, min(dates), max(dates), currencies)
+
+@instrumented
+def apply_balance_deltas(user_id, deltas, session, currencies=None):
+    """Write summed balance changes, given as {account_id: signed delta}, to the balance summary with one statement."""
+    deltas = {account_id: delta for account_id, delta in deltas.items() if delta != 0}
+    if deltas:
+        _upsert_balance_summaries(user_id, deltas, session, currencies)
+
+@instrumented
+def replace_transaction_postings(user_id, rows, accounts, session, replace=True):
+    """
+    Post the legs of the transactions' new rows and apply the difference to the balance summary. The ledger is append-only:
+    the legs in effect are cancelled by reversing legs on their original date, nothing is updated or deleted.
+    `rows` maps transaction ids to transaction row dicts, None only reverses the transaction's legs. With replace=False the transactions
+    are new and no old legs are looked up.
+    """
+    deltas = {}
+    postings = []
+    if replace:
+        # The legs in effect are the ones not reversed yet, per account and date they do not add up to zero
+        old_legs = session.query(Posting.transaction_id, Posting.account_id, Posting.currency, Posting.date, func.sum(Posting.amount)).filter(
+            Posting.user_id == user_id,
+            Posting.transaction_id.in_(list(rows))
+        ).group_by(Posting.transaction_id, Posting.account_id, Posting.currency, Posting.date).having(func.sum(Posting.amount) != 0).all()
+        for transaction_id, account_id, currency, date, amount in old_legs:
+            postings.append({'user_id': user_id, 'account_id': account_id, 'transaction_id': transaction_id, 'amount': -amount,
+                             'currency': currency, 'date': date})
+            deltas[account_id] = deltas.get(account_id, Decimal(0)) - amount
+    new_rows = [r for r in rows.values() if r is not None]
+    if new_rows:
+        preload_exchange_rates(new_rows, accounts, session)
+    for transaction_id, r in rows.items():
+        if r is None:
+            continue
+        for account_id, amount in transaction_balance_deltas(r, accounts, session):
+            postings.append({'user_id': user_id, 'account_id': account_id, 'transaction_id': transaction_id, 'amount': amount,
+                             'currency': accounts[account_id].currency, 'date': r['date']})
+            deltas[account_id] = deltas.get(account_id, Decimal(0)) + amount
+    if postings:
+        session.execute(insert(Posting), postings)
+    apply_balance_deltas(user_id, deltas, session)
+
+@instrumented
+def account_balances_from_postings(user_id, session, account_ids=None):
+    """Return {account_id: balance} summed from the postings ledger."""
+    query = session.query(Posting.account_id, func.sum(Posting.amount)).filter(Posting.user_id == user_id)
+    if account_ids is not None:
+        query = query.filter(Posting.account_id.in_(account_ids))
+    return dict(query.group_by(Posting.account_id).all())
+
+@instrumented
+def rebuild_postings(user_id, session):
+    """
+    Regenerate the transaction postings of a user from the transactions table, e.g. for data entered before the ledger existed.
+    This backfill is the one place that deletes legs, reversed ones included, everything else only appends to the ledger.
+    Accounts without adjustment postings get an opening adjustment so the ledger adds up to the current balances. Returns the number of legs written.
+    """
+    session.execute(delete(Posting).where(Posting.user_id == user_id, Posting.transaction_id != None))
+    trxs = session.query(Transaction).filter(Transaction.user_id == user_id).all()
+    accounts = {a.id: a for a in session.query(Account).filter(Account.user_id == user_id).all()}
+    rows = {t.id: {'account_id': t.account_id, 'target_account_id': t.target_account_id, 'transaction_type': t.transaction_type.value,
+                   'date': t.date, 'amount': t.amount, 'currency': t.currency} for t in trxs}
+    postings = []
+    if rows:
+        preload_exchange_rates(list(rows.values()), accounts, session)
+    for transaction_id, r in rows.items():
+        for account_id, amount in transaction_balance_deltas(r, accounts, session):
+            postings.append({'user_id': user_id, 'account_id': account_id, 'transaction_id': transaction_id, 'amount': amount,
+                             'currency': accounts[account_id].currency, 'date': r['date']})
+    if postings:
+        session.execute(insert(Posting), postings)
+    adjusted = {r[0] for r in session.query(Posting.account_id).filter(Posting.user_id == user_id, Posting.transaction_id == None).distinct().all()}
+    ledger = account_balances_from_postings(user_id, session)
+    for balance in session.query(CurrentAccountBalance).filter(CurrentAccountBalance.user_id == user_id).all():
+        opening = balance.balance - ledger.get(balance.account_id, Decimal(0))
+        if balance.account_id not in adjusted and opening != 0:
+            session.add(Posting(user_id=user_id, account_id=balance.account_id, transaction_id=None, amount=opening,
+                                currency=balance.currency, date=datetime.now()))
+    session.flush()
+    return len(postings)
+
+def transaction_balance_deltas(trx, accounts, session):
+    """
+    Return the signed balance change of every account touched by a transaction as (account_id, delta) pairs.
+    `trx` is a transaction row dict and `accounts` maps account ids to Account objects.
+    """
+    source_account = accounts[trx['account_id']]
+    source_amount = currency_conversion(trx['amount'], trx['currency'], source_account.currency, trx['date'], session)
+    if trx['transaction_type'] == 'credit':
+        return [(source_account.id, source_amount)]
+    elif trx['transaction_type'] == 'debit':
+        return [(source_account.id, -source_amount)]
+    elif trx['transaction_type'] == 'transfer':
+        target_account = accounts[trx['target_account_id']]
+        target_amount = currency_conversion(trx['amount'], trx['currency'], target_account.currency, trx['date'], session)
+        # Paying into a loan account decreases the outstanding balance
+        if target_account.account_type == 'loan':
+            return [(source_account.id, -source_amount), (target_account.id, -target_amount)]
+        return [(source_account.id, -source_amount), (target_account.id, target_amount)]
     else:
-        account_currency = session.query(Account).filter_by(id=account_id).first().currency
-    if transaction_type == 'transfer' and not target_account_id:
-        raise ValueError("target_account_id must be provided for transfer transactions")
-    
-    amount = Decimal(amount)
-    #Validate category_id is a valid category in the transaction_categories table
-    if not session.query(TransactionCategory).filter_by(id=category_id, user_id=user_id).first():
-        raise ValueError(f"Category ID {category_id} does not exist for user ID {user_id}")
-    
-    # Validate if transaction date is not for a closed month
-    date = datetime.strptime(date, "%Y-%m-%d") if isinstance(date, str) else date
-    if session.query(ClosedMonth).filter_by(user_id=user_id, month=date.month, year=date.year).first():
-        raise ValueError(f"Transaction date {date} is in a closed month.")
-
-    # Create a new transaction record
-
-    new_transaction = Transaction(
-        user_id=user_id,
-        account_id=account_id,
-        category_id=category_id,
-        target_account_id=target_account_id,
-        transaction_type=transaction_type,
-        date=date,
-        amount=amount,
-        currency=trx_currency,
-        comment=comment
-    )
-    session.add(new_transaction)
-    session.flush()  # Ensure new_transaction.id is available for further operations
-    balance_calculation(amount, trx_currency, account_currency, date, transaction_type, user_id, account_id, session, target_account_id)
-    
-    return new_transaction.id
+        raise ValueError("Invalid transaction type. Use 'debit', 'credit', or 'transfer'.")
 
+@instrumented
 def modify_transaction(transaction_id, user_id, session, **kwargs):
     modifiable_fields = ['account_id', 'category_id', 'target_account_id', 'transaction_type', 'date', 'amount', 'currency', 'comment']
 
@@ -275,67 +579,58 @@ def modify_transaction(transaction_id, user_id, session, **kwargs):
                 raise ValueError("Invalid transaction type. Use 'debit', 'credit', or 'transfer'.")
             if (key == 'transaction_type' and value == 'transfer') and (not kwargs.get('target_account_id') or not trx.target_account_id):
                 raise ValueError("target_account_id must be provided for transfer transactions")
-            if key == 'date':
-                value = datetime.strptime(value, "%Y-%m-%d") if isinstance(value, str) else value
-                if session.query(ClosedMonth).filter_by(user_id=user_id, month=value.month, year=value.year).first():
-                    raise ValueError(f"Transaction date {value} is in a closed month.")
-            if key == 'category_id':
-                if not session.query(TransactionCategory).filter_by(id=value, user_id=user_id).first():
-                    raise ValueError(f"Category ID {value} does not exist for user ID {user_id}")
         else:
             raise ValueError(f"Field '{key}' cannot be modified.")
 
-    # Update transaction fields
-    if 'amount' in kwargs.keys():
-        recalculate_balances(trx, user_id, session, **kwargs)
-    for key, value in kwargs.items():
-        setattr(trx, key, value)
-    session.flush()  # Ensure changes are saved
+    # Replaces the transaction's postings, whichever field changed
+    modify_transactions_bulk(user_id, [{'id': transaction_id, **kwargs}], session)
     return trx.id
 
-def recalculate_balances(trx, user_id, session, **kwargs):  
-    # Recalculate account balances
-    # First, reverse the original transaction
-    original_amount = trx.amount
-    original_currency = trx.currency
-    original_date = trx.date
-    original_account_id = trx.account_id
-    original_target_account_id = trx.target_account_id
-    original_transaction_type = trx.transaction_type.value
-
-    balance_calculation(
-        original_amount, 
-        original_currency, 
-        session.query(Account).filter_by(id=original_account_id).first().currency, 
-        original_date, 
-        original_transaction_type, 
-        user_id, 
-        original_account_id, 
-        session, 
-        original_target_account_id, 
-        reverse=True)
- 
-    # Now apply the modified transaction
-    new_amount = kwargs.get('amount', trx.amount)
-    new_currency = kwargs.get('currency', trx.currency)
-    new_date = kwargs.get('date', trx.date)
-    new_account_id = kwargs.get('account_id', trx.account_id)
-    new_target_account_id = kwargs.get('target_account_id', trx.target_account_id)
-    new_transaction_type = kwargs.get('transaction_type', trx.transaction_type)
-    balance_calculation(
-        new_amount, 
-        new_currency, 
-        session.query(Account).filter_by(id=new_account_id).first().currency, 
-        new_date, 
-        new_transaction_type, 
-        user_id, 
-        new_account_id, 
-        session, 
-        new_target_account_id)
-    
-    session.flush()  # Ensure changes are saved
-    return trx.id
+def month_bounds(year, month):
+    """Return the first moment of the month and of the following month."""
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    return start, end
 
+@instrumented
+def get_transactions_for_period(user_id, start, end, session, limit=None, after=None):
+    """
+    Return the user's transactions with start <= date < end ordered by date and id.
+    The range is applied to the partition key, so Postgres only scans the monthly partitions of the period.
+    For keyset pagination pass a limit and the (date, id) of the last row of the previous page as `after`.
+    """
+    query = session.query(Transaction).filter(
+        Transaction.user_id == user_id,
+        Transaction.date >= start,
+        Transaction.date < end
+    )
+    if after is not None:
+        query = query.filter(tuple_(Transaction.date, Transaction.id) > tuple_(*after))
+    query = query.order_by(Transaction.date, Transaction.id)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+@instrumented
+def get_planned_transactions_for_period(user_id, start, end, session, statuses=None):
+    """Return the user's planned transactions due in start <= due_date < end, optionally only the given statuses."""
+    query = session.query(PlannedTransaction).filter(
+        PlannedTransaction.user_id == user_id,
+        PlannedTransaction.due_date >= (start.date() if isinstance(start, datetime) else start),
+        PlannedTransaction.due_date < (end.date() if isinstance(end, datetime) else end)
+    )
+    if statuses is not None:
+        query = query.filter(PlannedTransaction.transaction_status.in_(statuses))
+    return query.order_by(PlannedTransaction.due_date, PlannedTransaction.id).all()
+
+def account_balances(user_id, session, active_only=False):
+    """(CurrentAccountBalance, account) pairs of a user in account order, the accounts come from the reference data cache"""
+    reference = get_reference_data(user_id, session)
+    accounts = reference.active_accounts if active_only else reference.accounts
+    balances = {b.account_id: b for b in session.query(CurrentAccountBalance).filter_by(user_id=user_id).all()}
+    return [(balances[a.id], a) for a in accounts if a.id in balances]
+
+@instrumented
 def link_transaction_with_planned_transaction(transaction_id, planned_transaction_id, session):
     trx = session.query(Transaction).filter_by(id=transaction_id).first()
     if not trx:
@@ -350,167 +645,115 @@ def link_transaction_with_planned_transaction(transaction_id, planned_transactio
         planned_trx.realized_date = trx.date
         session.flush()
 
-def currency_conversion(amount, from_currency, to_currency, date, session):
+def currency_conversion(amount, from_currency, to_currency, date, session, nearest_prior=False):
     """
     Convert amount from one currency to another using exchange rates.
+    Rates are served from the in-process rate cache. With nearest_prior the latest rate before the date is used if the day has none.
     """
     if from_currency == to_currency:
         return amount
-    xrate = session.query(ExchangeRate).filter_by(from_currency=from_currency, to_currency=to_currency, date=date).first()
-    if not xrate:
+    rate = get_exchange_rate_cache(session).get_rate(from_currency, to_currency, date, session, nearest_prior=nearest_prior)
+    if rate is None:
         raise ValueError(f"No exchange rate found for {from_currency} to {to_currency} on {date}")
-    return amount * xrate.rate
+    return amount * rate
 
-def load_exchange_rates(session):
-    default_symbols = ['EUR', 'GBP', 'HUF', 'USD']
+DEFAULT_CURRENCY_SYMBOLS = ['EUR', 'GBP', 'HUF', 'USD']
+
+def exchange_rate_symbols(session):
     db_symbols = [s[0] for s in session.query(ExchangeRate.from_currency).distinct().all()]
-    if not db_symbols:
-        rates = fetch_exchange_rates(default_symbols)
-    else:
-        rates = fetch_exchange_rates(db_symbols)
-    if rates:
-        for rate in rates:
-            # Check if the exchange rate already exists
-            existing_rate = session.query(ExchangeRate).filter_by(
-            from_currency=rate['from_currency'],
-            to_currency=rate['to_currency'],
-            date=rate['date']
-            ).first()
-            if existing_rate:
-                # Update the existing rate
-                existing_rate.rate = rate['rate']
-            else:
-                # Create a new exchange rate record
-                new_rate = ExchangeRate(
-                    from_currency=rate['from_currency'],
-                    to_currency=rate['to_currency'],
-                    rate=rate['rate'],
-                    date=rate['date']
-                )
-                session.add(new_rate)
+    return db_symbols or DEFAULT_CURRENCY_SYMBOLS
 
-def close_month(year, month, user_id, session):
+@instrumented
+def upsert_exchange_rates(rates, session):
     """
-    Close the month indicated by the parameters by moving balances to balance history and creating planned transactions for the next month.
+    Insert or update rates given as dicts of from_currency, to_currency, rate and date with one INSERT ... ON CONFLICT statement
+    against the unique (from_currency, to_currency, date) index. Empty dicts, as returned by a failed fetch, are ignored. Returns the number of rates written.
     """
+    # A row may only be upserted once per statement, the last value of a duplicated key wins
+    rows = list({(r['from_currency'], r['to_currency'], r['date']): r for r in rates if r}.values())
+    if not rows:
+        return 0
+    stmt = pg_insert(ExchangeRate)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ExchangeRate.from_currency, ExchangeRate.to_currency, ExchangeRate.date],
+        set_={'rate': stmt.excluded.rate, 'loaded_at': func.now()}
+    )
+    session.execute(stmt, [{k: r[k] for k in ('from_currency', 'to_currency', 'rate', 'date')} for r in rows])
+    # Cached rates may have been overwritten
+    get_exchange_rate_cache(session).clear()
+    return len(rows)
+
+@instrumented
+def load_exchange_rates(session):
+    return upsert_exchange_rates(fetch_exchange_rates(exchange_rate_symbols(session)), session)
+
+@instrumented
+def backfill_exchange_rates(start_date, end_date, session, symbols=None):
+    """Fetch and store the historical rates of every day between start_date and end_date (inclusive), e.g. for back-dated transactions."""
+    start_date, end_date = [datetime.strptime(d, "%Y-%m-%d").date() if isinstance(d, str) else d for d in (start_date, end_date)]
+    rates = fetch_historical_exchange_rates(symbols or exchange_rate_symbols(session), start_date, end_date)
+    written = upsert_exchange_rates(rates, session)
+    LOGGER.info(f"Backfilled {written} exchange rates between {start_date} and {end_date}")
+    return written
+
+def _close_month_for_users(year, month, user_ids, session):
+    """
+    Close the month for the given users with one statement per step: balance snapshot, cancelling the unrealized planned transactions and
+    generating the planned transactions of the next month. Users who already closed the month are skipped. Returns the ids of the users closed.
+    """
+    already_closed = {r[0] for r in session.query(ClosedMonth.user_id).filter(
+        ClosedMonth.user_id.in_(user_ids),
+        ClosedMonth.year == year,
+        ClosedMonth.month == month
+    ).all()}
+    if already_closed:
+        LOGGER.warning(f"Month {year}-{month:02d} is already closed for users {sorted(already_closed)}")
+    user_ids = [u for u in user_ids if u not in already_closed]
+    if not user_ids:
+        return []
+    month_start, month_end = month_bounds(year, month)
     # Get the first day of the next month
-    first_day_next_month = (datetime(year, month, 1) + timedelta(days=32)).replace(day=1)
-
-    # Move current account balances to balance history
-    balances = session.query(CurrentAccountBalance).all()
-    for balance in balances:
-        history_entry = BalanceHistory(
-            user_id=balance.user_id,
-            account_id=balance.account_id,
-            balance=balance.balance,
-            currency=balance.currency,
-            month=datetime(year, month, 1),
-            created_at=datetime.now().date()
-        )
-        session.add(history_entry)
+    first_day_next_month = month_end
+
+    # Move current account balances of the users to balance history
+    session.execute(insert(BalanceHistory).from_select(
+        ['user_id', 'account_id', 'balance', 'currency', 'month', 'created_at'],
+        session.query(
+            CurrentAccountBalance.user_id,
+            CurrentAccountBalance.account_id,
+            CurrentAccountBalance.balance,
+            CurrentAccountBalance.currency,
+            literal(month_start.date()),
+            literal(datetime.now().date())
+        ).filter(CurrentAccountBalance.user_id.in_(user_ids)).statement
+    ))
 
     # Mark any planned and overdue transactions in month as cancelled
-    
-    overdue_transactions = session.query(PlannedTransaction).filter(
-        PlannedTransaction.user_id == user_id,
-        extract('month', PlannedTransaction.due_date) == month,
-        PlannedTransaction.transaction_status != 'realized'
-    ).all()
-    for trx in overdue_transactions:
-        trx.transaction_status = 'cancelled'
+    session.execute(update(PlannedTransaction).where(
+        PlannedTransaction.user_id.in_(user_ids),
+        PlannedTransaction.due_date >= month_start.date(),
+        PlannedTransaction.due_date < month_end.date(),
+        PlannedTransaction.transaction_status != TransactionStatusEnum.realized
+    ).values(transaction_status=TransactionStatusEnum.cancelled))
 
     # Create planned transactions for the next month
-    recurring_transactions = session.query(RecurringTransaction).filter(
-        RecurringTransaction.user_id == user_id,
-    ).all()
-
-    for rt in recurring_transactions:
-        active_category = session.query(TransactionCategory).filter(TransactionCategory.id == rt.category_id, TransactionCategory.effective_to == None).first()
-        if not active_category:
-            LOGGER.warning(f"Skipping recurring transaction {rt.id}: category {rt.category_id} is no longer active")
-            continue
-        if rt.recurrence.value == 'monthly':
-            # Create a planned transaction for the first day of the next month
-            if rt.due_date_day > 0:
-                due_date = first_day_next_month.replace(day=rt.due_date_day)
-            else:
-                due_date = first_day_next_month
-            new_planned_trx = PlannedTransaction(
-                user_id=user_id,
-                category_id=rt.category_id,
-                transaction_status=TransactionStatusEnum.planned,
-                amount=Decimal(rt.amount),
-                currency='HUF',  # Assuming default currency is HUF
-                due_date=due_date
-            )
-            session.add(new_planned_trx)
-        elif rt.recurrence.value == 'yearly':
-            # Find the previous realized transaction for the same category. If none add one for the next month
-            previous_trx = session.query(PlannedTransaction).filter(
-                PlannedTransaction.user_id == user_id,
-                PlannedTransaction.category_id == rt.category_id,
-                PlannedTransaction.transaction_status == 'realized'
-            ).order_by(PlannedTransaction.due_date.desc()).first()
-            if not previous_trx:
-                new_planned_trx = PlannedTransaction(
-                    user_id=user_id,
-                    category_id=rt.category_id,
-                    transaction_status=TransactionStatusEnum.planned,
-                    amount=previous_trx.amount,
-                    currency=previous_trx.currency,
-                    due_date=first_day_next_month.replace(day=rt.due_date_day)
-                )
-            else:
-                new_planned_trx = PlannedTransaction(
-                    user_id=user_id,
-                    category_id=rt.category_id,
-                    transaction_status=TransactionStatusEnum.planned,
-                    amount=previous_trx.amount,
-                    currency=previous_trx.currency,
-                    due_date=first_day_next_month.replace(day=rt.due_date_day).replace(year=previous_trx.realized_date.year + 1)
-                )
-            session.add(new_planned_trx)
-        elif rt.recurrence.value == 'weekly':
-            previous_trx = session.query(PlannedTransaction).filter(
-                PlannedTransaction.user_id == user_id,
-                PlannedTransaction.category_id == rt.category_id,
-                PlannedTransaction.transaction_status == 'realized'
-            ).order_by(PlannedTransaction.due_date.desc()).first()
-            # Generate a list of weekly due dates that fall into next month starting from previous_trx.realized_date
-            if previous_trx:
-                start_date = previous_trx.realized_date
-            else:
-                start_date = first_day_next_month.replace(day=rt.due_date_day)
-            for i in range(6):  # Generate 6 weekly transactions
-                due_date = start_date + timedelta(weeks=i)
-                if due_date.month == first_day_next_month.month:
-                    new_planned_trx = PlannedTransaction(
-                        user_id=user_id,
-                        category_id=rt.category_id,
-                        transaction_status=TransactionStatusEnum.planned,
-                        amount=rt.amount,
-                        currency='HUF',
-                        due_date=due_date
-                    )
-                    session.add(new_planned_trx)
-        elif rt.recurrence.value == 'daily':
-            for i in range(32):  # Generate 33 daily transactions
-                due_date = first_day_next_month + timedelta(days=i)
-                if due_date.month == first_day_next_month.month:
-                    new_planned_trx = PlannedTransaction(
-                        user_id=user_id,
-                        category_id=rt.category_id,
-                        transaction_status=TransactionStatusEnum.planned,
-                        amount=rt.amount,
-                        currency='HUF',
-                        due_date=due_date
-                    )
-                    session.add(new_planned_trx)
-
-    closed_month = ClosedMonth(
-        user_id=user_id,
-        month=month,
-        year=year
-    )
-    session.add(closed_month)
+    plan_recurring_transactions(user_ids, first_day_next_month, month_bounds(first_day_next_month.year, first_day_next_month.month)[1], session)
+
+    session.execute(insert(ClosedMonth), [{'user_id': u, 'month': month, 'year': year} for u in user_ids])
+    return user_ids
+
+@instrumented
+def close_month(year, month, user_id, session):
+    """
+    Close the month indicated by the parameters by moving balances to balance history and creating planned transactions for the next month.
+    """
+    _close_month_for_users(year, month, [user_id], session)
     session.commit()  # Commit all changes
+
+@instrumented
+def close_month_for_all_users(year, month, session):
+    """Close the month for every user who has not closed it yet. Returns the ids of the users closed."""
+    user_ids = [r[0] for r in session.query(User.id).order_by(User.id).all()]
+    closed = _close_month_for_users(year, month, user_ids, session)
+    session.commit()
+    return closed
@@ -0,0 +1,58 @@
+import logging
+import os
+
+from contextlib import contextmanager
+from functools import lru_cache
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from urllib.parse import quote_plus
+from src.instrumentation import instrument_engine
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_database_engine")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+load_dotenv()  # Load environment variables from .env file
+
+def database_url():
+    DB_USER = quote_plus(os.getenv('DB_USER', '').encode())
+    DB_PASSWORD = quote_plus(os.getenv('DB_PASSWORD', '').encode())
+    DB_HOST = quote_plus(os.getenv('DB_HOST', '').encode())
+    DB_PORT = quote_plus(os.getenv('DB_PORT', '').encode())
+    DB_NAME = quote_plus(os.getenv('DB_NAME', '').encode())
+    return f"postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+@lru_cache(maxsize=None)
+def get_engine(url=None):
+    """
+    Return the process-wide engine. Streamlit re-executes the page script on every rerun but imported modules stay loaded,
+    so the engine and its connection pool are created once per process.
+    Pool settings come from DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE (seconds) and DB_POOL_PRE_PING.
+    """
+    engine = create_engine(
+        url or database_url(),
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+    )
+    # Statement counting only does work while collect_query_stats is active
+    instrument_engine(engine)
+    LOGGER.info(f"Created database engine for {engine.url.host}:{engine.url.port}/{engine.url.database}")
+    return engine
+
+@contextmanager
+def session_scope(engine=None):
+    """
+    Short-lived session for one action. Commits when the block finishes and rolls back if it raises.
+    Components may commit on their own as well, e.g. before st.rerun().
+    """
+    with Session(engine or get_engine()) as session:
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
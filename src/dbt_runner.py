@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from sqlalchemy import text
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_dbt_runner")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+DBT_SOURCE_NAME = 'budget_app'
+DBT_SOURCE_SCHEMA = 'app'
+# Tables declared in dbt_budget/models/stg/_src_budget_app.yml
+DBT_SOURCE_TABLES = ['accounts', 'balance_history', 'current_account_balance', 'exchange_rates', 'monthly_totals', 'transaction_categories', 'transactions']
+# Files whose changes make dbt rebuild the modified models, compared through a fingerprint instead of running dbt to find out
+DBT_PROJECT_PATHS = ['dbt_project.yml', 'packages.yml', 'models', 'macros', 'seeds', 'snapshots', 'tests']
+
+def last_build_state_dir(project_dir):
+    """Artifacts of the last successful build, used as the --state of the next selective build."""
+    return os.path.join(project_dir, "target", "last_successful_build")
+
+def load_last_build(project_dir):
+    """Return the build state saved by the last successful build, {"write_counts": ..., "fingerprint": ...}, or None if there was none."""
+    path = os.path.join(last_build_state_dir(project_dir), "build_state.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_last_build(project_dir, build_state):
+    state_dir = last_build_state_dir(project_dir)
+    os.makedirs(state_dir, exist_ok=True)
+    manifest = os.path.join(project_dir, "target", "manifest.json")
+    if os.path.exists(manifest):
+        shutil.copyfile(manifest, os.path.join(state_dir, "manifest.json"))
+    with open(os.path.join(state_dir, "build_state.json"), "w") as f:
+        json.dump(build_state, f)
+
+def source_write_counts(session):
+    """
+    Rows inserted, updated and deleted so far in every dbt source table, summed over the partitions, from pg_stat_user_tables.
+    The statistics are read at plan time, the writers do not record anything. They reach the view up to a second after the commit,
+    a write that is not counted yet is picked up by the next build.
+    """
+    session.execute(text("SELECT pg_stat_clear_snapshot()"))
+    rows = session.execute(text("""
+        SELECT t.table_name, sum(s.n_tup_ins + s.n_tup_upd + s.n_tup_del)
+        FROM unnest(CAST(:tables AS text[])) AS t(table_name)
+        CROSS JOIN LATERAL (
+            SELECT to_regclass(:schema || '.' || t.table_name) AS relid
+            UNION
+            SELECT relid FROM pg_partition_tree(to_regclass(:schema || '.' || t.table_name))
+        ) AS p
+        JOIN pg_stat_user_tables s ON s.relid = p.relid
+        GROUP BY t.table_name
+    """), {'tables': DBT_SOURCE_TABLES, 'schema': DBT_SOURCE_SCHEMA}).all()
+    return {table: int(count) for table, count in rows}
+
+def changed_source_tables(write_counts, last_write_counts):
+    """The source tables whose write count moved since the last build. A lower count, e.g. after a statistics reset, counts as a change."""
+    return sorted(t for t in DBT_SOURCE_TABLES if write_counts.get(t) != last_write_counts.get(t))
+
+def project_fingerprint(project_dir):
+    """Hash of the dbt project files, it changes whenever a model, macro or setting does."""
+    digest = hashlib.sha256()
+    for name in DBT_PROJECT_PATHS:
+        path = os.path.join(project_dir, name)
+        files = [path] if os.path.isfile(path) else sorted(os.path.join(root, f) for root, _, fs in os.walk(path) for f in fs)
+        for file in files:
+            digest.update(os.path.relpath(file, project_dir).encode())
+            with open(file, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def selective_build_selectors(changed_tables, with_state=False):
+    """dbt selectors for the models downstream of the changed sources, plus models whose code changed since the last build."""
+    selectors = [f"source:{DBT_SOURCE_NAME}.{table}+" for table in changed_tables]
+    if with_state:
+        selectors.append("state:modified+")
+    return selectors
+
+def dbt_build_command(project_dir, select=None, state_dir=None, full_refresh=False):
+    command = ["uv", "run", "dbt", "build", "--target", "dev", "--profiles-dir", f"{project_dir}/.dbt", "--project-dir", project_dir]
+    if full_refresh:
+        # Rebuilds the incremental models from the whole history
+        command.append("--full-refresh")
+    if select:
+        command += ["--select", *select]
+    if state_dir:
+        command += ["--state", state_dir]
+    return command
+
+def plan_dbt_build(session, project_dir, selective=True, full_refresh=False):
+    """
+    Return the dbt command to run and the build state to save once it succeeds.
+    A selective build only selects the models downstream of the source tables written since the last successful build, and the models
+    changed since then when the project files differ. The command is None when a selective build has nothing to do.
+    A full refresh always builds every model.
+    """
+    build_state = {"write_counts": source_write_counts(session), "fingerprint": project_fingerprint(project_dir)}
+    last_build = load_last_build(project_dir) if selective and not full_refresh else None
+    if last_build is None:
+        return dbt_build_command(project_dir, full_refresh=full_refresh), build_state
+    state_dir = last_build_state_dir(project_dir)
+    code_changed = build_state["fingerprint"] != last_build["fingerprint"]
+    if code_changed and not os.path.exists(os.path.join(state_dir, "manifest.json")):
+        return dbt_build_command(project_dir), build_state
+    changed_tables = changed_source_tables(build_state["write_counts"], last_build["write_counts"])
+    LOGGER.info(f"Source tables changed since the last build: {changed_tables}, project changed: {code_changed}")
+    selectors = selective_build_selectors(changed_tables, code_changed)
+    if not selectors:
+        return None, build_state
+    return dbt_build_command(project_dir, select=selectors, state_dir=state_dir if code_changed else None), build_state
@@ -0,0 +1,134 @@
+import logging
+import os
+import weakref
+
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import event
+from models import ExchangeRate
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_exchange_rate_cache")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+DEFAULT_MAX_ENTRIES = int(os.getenv("FX_CACHE_MAX_ENTRIES", "20000"))
+
+def _as_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], "%Y-%m-%d").date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+class ExchangeRateCache:
+    """
+    In-process cache of exchange rates keyed by (from_currency, to_currency, date, nearest_prior).
+    The nearest_prior entries hold the rate a nearest_prior lookup fell back to for a day without its own rate, e.g. a weekend.
+    Rates read by a session are kept with that session and only shared with other sessions once its transaction commits,
+    so a rollback never leaves rates behind. Date ranges can be preloaded with one query. Only rates found are cached:
+    a missing rate is looked up again, as another process may have loaded it since.
+    The least recently used entries are evicted once max_entries is reached.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._rates = OrderedDict()
+        self._pending = weakref.WeakKeyDictionary()
+        self._listening = weakref.WeakSet()
+
+    def __len__(self):
+        return len(self._rates)
+
+    def clear(self):
+        self._rates.clear()
+        self._pending.clear()
+
+    def _put(self, key, rate):
+        self._rates[key] = rate
+        self._rates.move_to_end(key)
+        while len(self._rates) > self.max_entries:
+            self._rates.popitem(last=False)
+
+    def _stage(self, session, key, rate):
+        """Keep a rate read by the session until its transaction commits."""
+        if session not in self._listening:
+            self._listening.add(session)
+            event.listen(session, "after_commit", self._publish)
+            event.listen(session, "after_transaction_end", self._discard)
+        self._pending.setdefault(session, {})[key] = rate
+
+    def _publish(self, session):
+        for key, rate in self._pending.pop(session, {}).items():
+            self._put(key, rate)
+
+    def _cached(self, session, key):
+        pending = self._pending.get(session, {})
+        if key in pending:
+            return pending[key]
+        if key in self._rates:
+            self._rates.move_to_end(key)
+            return self._rates[key]
+        return None
+
+    def _discard(self, session, transaction):
+        if transaction.parent is None:
+            self._pending.pop(session, None)
+
+    def preload(self, session, start, end, currencies=None):
+        """Load every rate between start and end (inclusive) with a single query. Returns the number of rates loaded."""
+        start, end = _as_date(start), _as_date(end)
+        query = session.query(ExchangeRate.from_currency, ExchangeRate.to_currency, ExchangeRate.date, ExchangeRate.rate).filter(
+            ExchangeRate.date >= start,
+            ExchangeRate.date <= end
+        )
+        if currencies is not None:
+            query = query.filter(ExchangeRate.from_currency.in_(currencies), ExchangeRate.to_currency.in_(currencies))
+        rates = query.all()
+        if len(rates) > self.max_entries:
+            LOGGER.warning(f"Preloading {len(rates)} rates exceeds the cache size of {self.max_entries}")
+        for from_currency, to_currency, date, rate in rates:
+            self._stage(session, (from_currency, to_currency, date, False), rate)
+        return len(rates)
+
+    def get_rate(self, from_currency, to_currency, date, session, nearest_prior=False):
+        """
+        Return the rate for the given day or None if there is none.
+        With nearest_prior the latest rate published on or before the day is used when the exact day is missing.
+        """
+        date = _as_date(date)
+        rate = self._cached(session, (from_currency, to_currency, date, False))
+        if rate is None and nearest_prior:
+            rate = self._cached(session, (from_currency, to_currency, date, True))
+        if rate is not None:
+            return rate
+        xrate = session.query(ExchangeRate).filter_by(from_currency=from_currency, to_currency=to_currency, date=date).first()
+        if xrate:
+            self._stage(session, (from_currency, to_currency, date, False), xrate.rate)
+            return xrate.rate
+        if not nearest_prior:
+            return None
+        xrate = session.query(ExchangeRate).filter(
+            ExchangeRate.from_currency == from_currency,
+            ExchangeRate.to_currency == to_currency,
+            ExchangeRate.date <= date
+        ).order_by(ExchangeRate.date.desc()).first()
+        if not xrate:
+            return None
+        self._stage(session, (from_currency, to_currency, xrate.date, False), xrate.rate)
+        # Kept under the requested day as well, the next lookup of the same missing day needs no query
+        self._stage(session, (from_currency, to_currency, date, True), xrate.rate)
+        return xrate.rate
+
+_CACHES = weakref.WeakKeyDictionary()
+
+def get_exchange_rate_cache(session):
+    """Return the rate cache of the database the session is bound to."""
+    engine = session.get_bind()
+    cache = _CACHES.get(engine)
+    if cache is None:
+        cache = _CACHES[engine] = ExchangeRateCache()
+    return cache
+
+def clear_exchange_rate_cache(session):
+    get_exchange_rate_cache(session).clear()
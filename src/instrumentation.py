@@ -0,0 +1,115 @@
+import functools
+import logging
+import os
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from sqlalchemy import event
+from src.tracing import span, tracing_enabled
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_instrumentation")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+TOTAL = "(total)"
+UNSCOPED = "(unscoped)"
+
+# Names of the instrumented functions and components currently running, outermost first
+_scopes = ContextVar("query_scopes", default=())
+# Stats of the running collect_query_stats block, None when nothing is collecting
+_collector = ContextVar("query_collector", default=None)
+
+@dataclass
+class QueryStats:
+    """Statements executed within one scope and the time spent waiting for the database."""
+    count: int = 0
+    seconds: float = 0.0
+    statements: list = field(default_factory=list)
+
+    @property
+    def milliseconds(self):
+        return self.seconds * 1000
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _collector.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    collector = _collector.get()
+    if collector is None or not conn.info.get("query_started"):
+        return
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    # A statement counts for every scope it ran in, so a component includes the dml functions it called
+    for scope in (TOTAL,) + (_scopes.get() or (UNSCOPED,)):
+        stats = collector.setdefault(scope, QueryStats())
+        stats.count += 1
+        stats.seconds += elapsed
+        stats.statements.append(statement)
+
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get("query_started") if exception_context.connection is not None else None
+    if started:
+        started.pop()
+
+def instrument_engine(engine):
+    """Attach the statement counting listeners to an engine, once."""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+    return engine
+
+@contextmanager
+def query_scope(name):
+    """Attribute the statements executed in the block to name, on top of the scopes already running."""
+    token = _scopes.set(_scopes.get() + (name,))
+    try:
+        yield
+    finally:
+        _scopes.reset(token)
+
+def instrumented(fn=None, name=None):
+    """
+    Decorator counting the statements of a function under its module and name, e.g. database_dml.add_transaction.
+    The same name is used for its wall time span when tracing is enabled.
+    """
+    if fn is None:
+        return lambda f: instrumented(f, name)
+    scope = name or f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _collector.get() is None and not tracing_enabled():
+            return fn(*args, **kwargs)
+        with query_scope(scope), span(scope):
+            return fn(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def collect_query_stats():
+    """Collect {scope: QueryStats} of the statements executed in the block on instrumented engines, in this thread or task."""
+    stats = {}
+    token = _collector.set(stats)
+    try:
+        yield stats
+    finally:
+        _collector.reset(token)
+
+@contextmanager
+def assert_max_queries(engine, limit, scope=TOTAL):
+    """
+    Fail when the block executes more than limit statements, in total or within one scope. Used by the tests to catch N+1 regressions:
+
+        with assert_max_queries(pg.engine, 8):
+            add_transactions_bulk(user_id, rows, session)
+    """
+    instrument_engine(engine)
+    with collect_query_stats() as stats:
+        yield stats
+    executed = stats.get(scope, QueryStats())
+    if executed.count > limit:
+        listing = "\n".join(f"  {i + 1}. {' '.join(s.split())[:200]}" for i, s in enumerate(executed.statements))
+        raise AssertionError(f"{executed.count} statements executed in {scope}, expected at most {limit}:\n{listing}")
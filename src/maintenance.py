@@ -0,0 +1,71 @@
+import argparse
+import logging
+import os
+
+from datetime import datetime
+from sqlalchemy import func, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from models import MaintenanceRun, PlannedTransaction, TransactionStatusEnum
+from src.database_engine import session_scope
+from src.instrumentation import instrumented
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_maintenance")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+OVERDUE_TASK = "overdue_planned_transactions"
+# Transaction level advisory lock, so only one process runs the overdue maintenance at a time
+OVERDUE_LOCK_ID = 7_301_002
+
+@instrumented
+def mark_overdue_planned_transactions(session, today=None, user_id=None):
+    """Mark every planned transaction due before today as overdue with one statement, optionally of one user. Returns the number marked."""
+    today = today or session.execute(func.current_date()).scalar()
+    query = update(PlannedTransaction).where(
+        PlannedTransaction.transaction_status == TransactionStatusEnum.planned,
+        PlannedTransaction.due_date < today
+    )
+    if user_id is not None:
+        query = query.where(PlannedTransaction.user_id == user_id)
+    return session.execute(query.values(transaction_status=TransactionStatusEnum.overdue)).rowcount
+
+def last_watermark(task, session):
+    """The day the task last covered, None if it never ran."""
+    return session.query(MaintenanceRun.watermark).filter_by(task=task).scalar()
+
+def record_run(task, watermark, rows_affected, session):
+    stmt = pg_insert(MaintenanceRun).values(task=task, watermark=watermark, last_run_at=datetime.now(), rows_affected=rows_affected)
+    session.execute(stmt.on_conflict_do_update(index_elements=[MaintenanceRun.task], set_={
+        'watermark': stmt.excluded.watermark, 'last_run_at': stmt.excluded.last_run_at, 'rows_affected': stmt.excluded.rows_affected
+    }))
+
+@instrumented
+def run_overdue_maintenance(session, today=None, force=False):
+    """
+    Mark the overdue planned transactions unless that was already done today, according to the watermark in app.maintenance_runs.
+    Meant for startup and schedulers, the pages never recompute statuses while rendering. Returns the number marked, None if skipped.
+    """
+    today = today or session.execute(func.current_date()).scalar()
+    if not session.execute(text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": OVERDUE_LOCK_ID}).scalar():
+        LOGGER.info("Overdue maintenance is already running in another session")
+        return None
+    watermark = last_watermark(OVERDUE_TASK, session)
+    if watermark is not None and watermark >= today and not force:
+        return None
+    marked = mark_overdue_planned_transactions(session, today)
+    record_run(OVERDUE_TASK, today, marked, session)
+    LOGGER.info(f"Marked {marked} planned transactions due before {today} as overdue")
+    return marked
+
+def main():
+    """Run the maintenance from a scheduler, e.g. a daily cron job: python -m src.maintenance"""
+    parser = argparse.ArgumentParser(description="Overdue planned transaction maintenance")
+    parser.add_argument("--force", action="store_true", help="run even if the watermark says it already ran today")
+    args = parser.parse_args()
+    with session_scope() as session:
+        marked = run_overdue_maintenance(session, force=args.force)
+    print("already up to date" if marked is None else f"{marked} planned transactions marked overdue")
+
+if __name__ == "__main__":
+    main()
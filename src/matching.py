@@ -0,0 +1,149 @@
+import bisect
+import logging
+import os
+
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import bindparam, exists, or_, update
+from models import Transaction, PlannedTransaction, TransactionStatusEnum
+from src.database_dml import month_bounds
+from src.instrumentation import instrumented
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_matching")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+# Relative difference allowed between the transaction and the planned amount, and days allowed between the date and the due date
+MATCH_AMOUNT_TOLERANCE = Decimal(os.getenv("MATCH_AMOUNT_TOLERANCE", "0.1"))
+MATCH_DATE_WINDOW_DAYS = int(os.getenv("MATCH_DATE_WINDOW_DAYS", "7"))
+OPEN_STATUSES = [TransactionStatusEnum.planned, TransactionStatusEnum.overdue]
+
+@dataclass
+class Match:
+    """A transaction proposed as the realization of a planned transaction of the same category and currency."""
+    transaction_id: int
+    planned_transaction_id: int
+    category_id: int
+    currency: str
+    date: datetime
+    due_date: date
+    amount: Decimal
+    planned_amount: Decimal
+
+    @property
+    def days_apart(self):
+        return abs((self.date.date() - self.due_date).days)
+
+    @property
+    def amount_difference(self):
+        return abs(self.amount - self.planned_amount)
+
+def unlinked_transactions(user_id, start, end, session):
+    """The user's transactions with start <= date < end that no planned transaction refers to yet."""
+    linked = exists().where(PlannedTransaction.transaction_id == Transaction.id)
+    return session.query(Transaction).filter(
+        Transaction.user_id == user_id,
+        Transaction.date >= start,
+        Transaction.date < end,
+        ~linked
+    ).order_by(Transaction.date, Transaction.id).all()
+
+def open_planned_transactions(user_id, start, end, session):
+    """The user's planned and overdue planned transactions without a transaction, due in start <= due_date < end."""
+    return session.query(PlannedTransaction).filter(
+        PlannedTransaction.user_id == user_id,
+        PlannedTransaction.due_date >= start,
+        PlannedTransaction.due_date < end,
+        PlannedTransaction.transaction_status.in_(OPEN_STATUSES),
+        PlannedTransaction.transaction_id == None
+    ).order_by(PlannedTransaction.due_date, PlannedTransaction.id).all()
+
+def pair_transactions(transactions, planned, amount_tolerance=MATCH_AMOUNT_TOLERANCE, date_window=MATCH_DATE_WINDOW_DAYS):
+    """
+    Pair transactions with planned transactions of the same category and currency whose due date is at most date_window days away
+    and whose amount differs by at most amount_tolerance of the planned amount. A planned amount of 0 matches any amount.
+    The candidates of each transaction are found by bisecting the planned due dates of its category, then the closest pairs,
+    by days and then by amount, are taken first so every transaction and planned transaction is used once.
+    """
+    due_dates = {}
+    for p in sorted(planned, key=lambda p: (p.due_date, p.id)):
+        dates, rows = due_dates.setdefault((p.category_id, p.currency), ([], []))
+        dates.append(p.due_date)
+        rows.append(p)
+    window = timedelta(days=date_window)
+    candidates = []
+    for t in transactions:
+        dates, rows = due_dates.get((t.category_id, t.currency), ([], []))
+        day = t.date.date()
+        for p in rows[bisect.bisect_left(dates, day - window):bisect.bisect_right(dates, day + window)]:
+            difference = abs(t.amount - (p.amount or 0))
+            if p.amount and difference > amount_tolerance * abs(p.amount):
+                continue
+            candidates.append((abs((day - p.due_date).days), difference, t.id, p.id, t, p))
+    candidates.sort(key=lambda c: c[:4])
+    matches, used_transactions, used_planned = [], set(), set()
+    for _, _, transaction_id, planned_id, t, p in candidates:
+        if transaction_id in used_transactions or planned_id in used_planned:
+            continue
+        used_transactions.add(transaction_id)
+        used_planned.add(planned_id)
+        matches.append(Match(t.id, p.id, p.category_id, p.currency, t.date, p.due_date, t.amount, p.amount or Decimal(0)))
+    return sorted(matches, key=lambda m: (m.due_date, m.planned_transaction_id))
+
+@instrumented
+def propose_matches(user_id, year, month, session, amount_tolerance=MATCH_AMOUNT_TOLERANCE, date_window=MATCH_DATE_WINDOW_DAYS):
+    """
+    Propose a planned transaction for each unlinked transaction of the month, see pair_transactions.
+    Planned transactions due up to date_window days around the month are candidates as well. Nothing is written.
+    """
+    start, end = month_bounds(year, month)
+    transactions = unlinked_transactions(user_id, start, end, session)
+    if not transactions:
+        return []
+    window = timedelta(days=date_window)
+    planned = open_planned_transactions(user_id, (start - window).date(), (end + window).date(), session)
+    return pair_transactions(transactions, planned, amount_tolerance, date_window)
+
+@instrumented
+def apply_matches(user_id, matches, session):
+    """
+    Link every match in one bulk update: the planned transaction is realized with the transaction's amount and date.
+    Proposals are reviewed across reruns, so a planned transaction that is no longer open, or a transaction linked in the meantime, is skipped.
+    So is a match whose planned transaction or transaction does not belong to the user. Returns the number linked.
+    """
+    if not matches:
+        return 0
+    planned = PlannedTransaction.__table__
+    linked = planned.alias("linked")
+    transactions = Transaction.__table__
+    stmt = update(planned).where(
+        planned.c.id == bindparam('planned_transaction_id'),
+        planned.c.user_id == user_id,
+        planned.c.transaction_id == None,
+        # IN () would need an expanding parameter, which executemany does not take
+        or_(*[planned.c.transaction_status == status for status in OPEN_STATUSES]),
+        ~exists().where(linked.c.transaction_id == bindparam('matched_transaction_id')),
+        # The date is part of the transactions key, the lookup only reads the partition of the transaction
+        exists().where(
+            transactions.c.id == bindparam('matched_transaction_id'),
+            transactions.c.date == bindparam('matched_date'),
+            transactions.c.user_id == user_id
+        )
+    ).values(
+        transaction_id=bindparam('matched_transaction_id'),
+        transaction_status=TransactionStatusEnum.realized,
+        amount=bindparam('matched_amount'),
+        realized_date=bindparam('matched_date')
+    )
+    result = session.execute(stmt, [{
+        'planned_transaction_id': m.planned_transaction_id,
+        'matched_transaction_id': m.transaction_id,
+        'matched_amount': m.amount,
+        'matched_date': m.date
+    } for m in matches], execution_options={'preserve_rowcount': True})
+    if result.rowcount < len(matches):
+        LOGGER.warning(f"Skipped {len(matches) - result.rowcount} matches linked since they were proposed")
+    LOGGER.info(f"Linked {result.rowcount} transactions to planned transactions")
+    return result.rowcount
@@ -0,0 +1,98 @@
+import argparse
+import logging
+import os
+
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import Date, cast, delete, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from models import MonthlyTotal, Transaction
+from src.database_engine import session_scope
+from src.instrumentation import instrumented
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_monthly_totals")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+GROUP_COLUMNS = ['month', 'category_id', 'account_id', 'target_account_id', 'transaction_type', 'currency']
+
+def _group(row):
+    transaction_type = row['transaction_type']
+    return (
+        date(row['date'].year, row['date'].month, 1),
+        row['category_id'],
+        row['account_id'],
+        row.get('target_account_id'),
+        getattr(transaction_type, 'value', transaction_type),
+        row.get('currency') or 'HUF'
+    )
+
+@instrumented
+def apply_monthly_totals(user_id, old_rows, new_rows, session):
+    """
+    Move transaction rows out of and into app.monthly_totals, called by the dml functions writing transactions.
+    The rows are transaction row dicts: old_rows are the deleted or previous versions, new_rows the inserted or new versions.
+    The differences are summed per group and added in one statement, groups left without transactions are removed.
+    """
+    deltas = {}
+    for rows, sign in ((old_rows, -1), (new_rows, 1)):
+        for r in rows:
+            amount, count = deltas.get(_group(r), (Decimal(0), 0))
+            deltas[_group(r)] = (amount + sign * Decimal(r['amount']), count + sign)
+    deltas = {group: delta for group, delta in deltas.items() if delta != (0, 0)}
+    if not deltas:
+        return
+    # Groups are written in a fixed order so concurrent writers lock them in the same order
+    stmt = pg_insert(MonthlyTotal).values([
+        {'user_id': user_id, **dict(zip(GROUP_COLUMNS, group)), 'amount': amount, 'transaction_count': count}
+        for group, (amount, count) in sorted(deltas.items(), key=lambda d: tuple('' if v is None else str(v) for v in d[0]))
+    ])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[MonthlyTotal.user_id] + [getattr(MonthlyTotal, c) for c in GROUP_COLUMNS],
+        set_={'amount': MonthlyTotal.amount + stmt.excluded.amount, 'transaction_count': MonthlyTotal.transaction_count + stmt.excluded.transaction_count}
+    ))
+    if any(count < 0 for _, count in deltas.values()):
+        session.execute(delete(MonthlyTotal).where(MonthlyTotal.user_id == user_id, MonthlyTotal.transaction_count <= 0))
+
+@instrumented
+def rebuild_monthly_totals(session, user_id=None):
+    """Recompute app.monthly_totals from the transactions, of one user or of everybody, e.g. to backfill it. Returns the number of groups written."""
+    query = delete(MonthlyTotal)
+    if user_id is not None:
+        query = query.where(MonthlyTotal.user_id == user_id)
+    session.execute(query)
+    month = cast(func.date_trunc('month', Transaction.date), Date)
+    totals = select(
+        Transaction.user_id, month, Transaction.category_id, Transaction.account_id, Transaction.target_account_id,
+        Transaction.transaction_type, Transaction.currency, func.sum(Transaction.amount), func.count()
+    ).group_by(
+        Transaction.user_id, month, Transaction.category_id, Transaction.account_id, Transaction.target_account_id,
+        Transaction.transaction_type, Transaction.currency
+    )
+    if user_id is not None:
+        totals = totals.where(Transaction.user_id == user_id)
+    columns = ['user_id'] + GROUP_COLUMNS + ['amount', 'transaction_count']
+    return session.execute(insert(MonthlyTotal).from_select(columns, totals), execution_options={'preserve_rowcount': True}).rowcount
+
+@instrumented
+def get_monthly_totals(user_id, session, start=None, end=None):
+    """The user's monthly totals with start <= month < end ordered by month, category and account. Reads one row per group, not the transactions."""
+    query = session.query(MonthlyTotal).filter(MonthlyTotal.user_id == user_id)
+    if start is not None:
+        query = query.filter(MonthlyTotal.month >= start)
+    if end is not None:
+        query = query.filter(MonthlyTotal.month < end)
+    return query.order_by(MonthlyTotal.month, MonthlyTotal.category_id, MonthlyTotal.account_id, MonthlyTotal.id).all()
+
+def main():
+    """Backfill the monthly totals, e.g. after loading transactions outside of the dml functions: python -m src.monthly_totals"""
+    parser = argparse.ArgumentParser(description="Rebuild app.monthly_totals from the transactions")
+    parser.add_argument("--user-id", type=int, default=None, help="only rebuild the totals of this user")
+    args = parser.parse_args()
+    with session_scope() as session:
+        groups = rebuild_monthly_totals(session, args.user_id)
+    print(f"{groups} monthly total rows written")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import logging
+import os
+import re
+
+from dataclasses import dataclass
+from datetime import date, datetime
+from sqlalchemy import func, text
+from src.database_engine import session_scope
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_partitions")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# Partitions ending this many months before the current month are detached, unset keeps every partition attached
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS")) if os.getenv("PARTITION_RETENTION_MONTHS") else None
+PARTITION_ARCHIVE_SCHEMA = os.getenv("PARTITION_ARCHIVE_SCHEMA") or None
+
+SCHEMA = "app"
+TABLE = "transactions"
+# Serialises maintenance between app processes started at the same time
+MAINTENANCE_LOCK_ID = 7_301_001
+BOUND = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+IDENTIFIER = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+@dataclass
+class Partition:
+    """One monthly partition of app.transactions. start and end are None for a default partition."""
+    name: str
+    start: date | None
+    end: date | None
+    size_bytes: int = 0
+    estimated_rows: int = 0
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month):
+    return f"{TABLE}_{month:%Y_%m}"
+
+def is_partitioned(session, schema=SCHEMA, table=TABLE):
+    return bool(session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = :schema AND c.relname = :table"
+    ), {"schema": schema, "table": table}).first())
+
+def list_partitions(session):
+    """Attached partitions of app.transactions in date order, with their total size and the planner's row estimate."""
+    rows = session.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), pg_total_relation_size(c.oid), greatest(c.reltuples, 0)::bigint "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:parent)"
+    ), {"parent": f"{SCHEMA}.{TABLE}"}).all()
+    partitions = []
+    for name, bound, size, estimated_rows in rows:
+        match = BOUND.search(bound or "")
+        start, end = [datetime.fromisoformat(b).date() for b in match.groups()] if match else (None, None)
+        partitions.append(Partition(name, start, end, size, estimated_rows))
+    return sorted(partitions, key=lambda p: (p.start is None, p.start or date.min))
+
+def _lock(session):
+    return session.execute(text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": MAINTENANCE_LOCK_ID}).scalar()
+
+def ensure_partitions(start_month, end_month, session):
+    """
+    Create the missing monthly partitions from start_month up to, not including, end_month, each with its (user_id, date) index,
+    like app.create_monthly_transaction_partitions. Months already covered by a partition are skipped. Returns the names created.
+    """
+    covered = [(p.start, p.end) for p in list_partitions(session) if p.start]
+    month = date(start_month.year, start_month.month, 1)
+    created = []
+    while month < end_month:
+        next_month = add_months(month, 1)
+        if not any(start < next_month and month < end for start, end in covered):
+            name = partition_name(month)
+            session.execute(text(
+                f'CREATE TABLE IF NOT EXISTS "{SCHEMA}"."{name}" PARTITION OF "{SCHEMA}"."{TABLE}" '
+                f"FOR VALUES FROM ('{month}') TO ('{next_month}')"
+            ))
+            session.execute(text(f'CREATE INDEX IF NOT EXISTS "{name}_user_id_date_idx" ON "{SCHEMA}"."{name}" (user_id, date)'))
+            created.append(name)
+        month = next_month
+    if created:
+        LOGGER.info(f"Created transaction partitions {', '.join(created)}")
+    return created
+
+def detach_partitions(before_month, session, archive_schema=None):
+    """
+    Detach the partitions that end on or before before_month. Their rows stay in the detached tables, which are moved to
+    archive_schema when given. Returns the names detached.
+    """
+    if archive_schema and not IDENTIFIER.match(archive_schema):
+        raise ValueError(f"Invalid archive schema name: {archive_schema}")
+    detached = []
+    for partition in list_partitions(session):
+        if partition.end is None or partition.end > before_month:
+            continue
+        session.execute(text(f'ALTER TABLE "{SCHEMA}"."{TABLE}" DETACH PARTITION "{SCHEMA}"."{partition.name}"'))
+        if archive_schema:
+            session.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{archive_schema}"'))
+            session.execute(text(f'ALTER TABLE "{SCHEMA}"."{partition.name}" SET SCHEMA "{archive_schema}"'))
+        detached.append(partition.name)
+    if detached:
+        LOGGER.info(f"Detached transaction partitions {', '.join(detached)}" + (f" into schema {archive_schema}" if archive_schema else ""))
+    return detached
+
+def maintain_partitions(session, months_ahead=PARTITION_MONTHS_AHEAD, retention_months=PARTITION_RETENTION_MONTHS,
+                        archive_schema=PARTITION_ARCHIVE_SCHEMA, today=None):
+    """
+    Make sure the current month and the next months_ahead months have partitions and, with retention_months, detach the ones
+    older than that. Does nothing if app.transactions is not partitioned or another process is already maintaining it.
+    Returns the names of the created and detached partitions.
+    """
+    if not is_partitioned(session):
+        LOGGER.debug("app.transactions is not partitioned, skipping partition maintenance")
+        return [], []
+    if not _lock(session):
+        LOGGER.info("Partition maintenance is already running in another session")
+        return [], []
+    current_month = (today or session.execute(func.current_date()).scalar()).replace(day=1)
+    created = ensure_partitions(current_month, add_months(current_month, months_ahead + 1), session)
+    detached = []
+    if retention_months is not None:
+        detached = detach_partitions(add_months(current_month, -retention_months), session, archive_schema)
+    return created, detached
+
+def main():
+    """Run the maintenance from a scheduler, e.g. a daily cron job: python -m src.partitions --months-ahead 3"""
+    parser = argparse.ArgumentParser(description="Transaction partition maintenance")
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    parser.add_argument("--retention-months", type=int, default=PARTITION_RETENTION_MONTHS)
+    parser.add_argument("--archive-schema", default=PARTITION_ARCHIVE_SCHEMA)
+    parser.add_argument("--sizes", action="store_true", help="print the partition sizes after the maintenance")
+    args = parser.parse_args()
+    with session_scope() as session:
+        created, detached = maintain_partitions(session, args.months_ahead, args.retention_months, args.archive_schema)
+        print(f"created: {created or '-'}, detached: {detached or '-'}")
+        if args.sizes:
+            for p in list_partitions(session):
+                print(f"{p.name:<24} {str(p.start or 'default'):<10} {p.size_bytes / 1024:>10.0f} kB {p.estimated_rows:>10} rows (est.)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import Date, DateTime, and_, case, cast, func, literal, literal_column, select, union_all
+from sqlalchemy.dialects.postgresql import distinct_on
+from sqlalchemy.orm import Session
+from src.database_dml import account_balances_from_postings, apply_balance_deltas
+from src.instrumentation import instrumented
+from models import User, Account, CurrentAccountBalance, BalanceHistory, Transaction, ExchangeRate, Posting, TransactionTypeEnum
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_reconciliation")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "4"))
+RECONCILE_TOLERANCE = Decimal(os.getenv("RECONCILE_TOLERANCE", "0.01"))
+
+@dataclass
+class BalanceDrift:
+    """Stored and recomputed balance of one account. expected_balance is None when a transaction has no exchange rate for its day."""
+    user_id: int
+    account_id: int
+    account_name: str
+    currency: str
+    stored_balance: Decimal
+    expected_balance: Decimal | None
+    missing_rates: int = 0
+
+    @property
+    def difference(self):
+        if self.expected_balance is None:
+            return None
+        return self.stored_balance - self.expected_balance
+
+def expected_balances_query(user_id):
+    """
+    One aggregate over the user's accounts: the latest BalanceHistory snapshot of each account plus every transaction leg and balance
+    adjustment made after the snapshot, converted to the account currency with the rate of the transaction day.
+    """
+    snapshot = select(BalanceHistory.account_id, BalanceHistory.balance, BalanceHistory.month, BalanceHistory.created_at).where(
+        BalanceHistory.user_id == user_id
+    ).ext(distinct_on(BalanceHistory.account_id)).order_by(BalanceHistory.account_id, BalanceHistory.month.desc()).subquery('snapshot')
+
+    target_account = select(Account.id, Account.account_type).subquery('target_account')
+    source_legs = select(
+        Transaction.account_id.label('account_id'),
+        case((Transaction.transaction_type == TransactionTypeEnum.credit, Transaction.amount), else_=-Transaction.amount).label('amount'),
+        Transaction.currency.label('currency'),
+        Transaction.date.label('date'),
+        literal(None, DateTime).label('created_at')
+    ).where(Transaction.user_id == user_id)
+    # Paying into a loan account decreases the outstanding balance
+    target_legs = select(
+        Transaction.target_account_id,
+        case((target_account.c.account_type == 'loan', -Transaction.amount), else_=Transaction.amount),
+        Transaction.currency,
+        Transaction.date,
+        literal(None, DateTime)
+    ).join(target_account, target_account.c.id == Transaction.target_account_id).where(
+        Transaction.user_id == user_id,
+        Transaction.transaction_type == TransactionTypeEnum.transfer
+    )
+    # The reconciliation's own adjustments bring the ledger to this expected balance, they are not movements
+    adjustments = select(Posting.account_id, Posting.amount, Posting.currency, Posting.date, Posting.created_at).where(
+        Posting.user_id == user_id,
+        Posting.transaction_id == None,
+        Posting.reconciliation == False
+    )
+    legs = union_all(source_legs, target_legs, adjustments).subquery('legs')
+
+    leg_account = select(Account.id, Account.currency).subquery('leg_account')
+    # The snapshot is the balance at the end of its month, adjustments are dated when they were made so they count from the day after the snapshot was taken
+    after_snapshot = case(
+        (snapshot.c.month == None, True),
+        (legs.c.created_at != None, cast(legs.c.created_at, Date) > snapshot.c.created_at),
+        else_=legs.c.date >= snapshot.c.month + literal_column("interval '1 month'")
+    )
+    same_currency = legs.c.currency == leg_account.c.currency
+    totals = select(
+        legs.c.account_id,
+        func.sum(legs.c.amount * case((same_currency, literal(1)), else_=ExchangeRate.rate)).label('movement'),
+        func.count().filter(and_(~same_currency, ExchangeRate.rate == None)).label('missing_rates')
+    ).join(leg_account, leg_account.c.id == legs.c.account_id).outerjoin(
+        snapshot, snapshot.c.account_id == legs.c.account_id
+    ).outerjoin(ExchangeRate, and_(
+        ExchangeRate.from_currency == legs.c.currency,
+        ExchangeRate.to_currency == leg_account.c.currency,
+        ExchangeRate.date == cast(legs.c.date, Date)
+    )).where(after_snapshot).group_by(legs.c.account_id).subquery('totals')
+
+    return select(
+        Account.id,
+        Account.account_name,
+        Account.currency,
+        func.coalesce(CurrentAccountBalance.balance, 0),
+        func.coalesce(snapshot.c.balance, 0) + func.coalesce(totals.c.movement, 0),
+        func.coalesce(totals.c.missing_rates, 0)
+    ).outerjoin(CurrentAccountBalance, CurrentAccountBalance.account_id == Account.id).outerjoin(
+        snapshot, snapshot.c.account_id == Account.id
+    ).outerjoin(totals, totals.c.account_id == Account.id).where(Account.user_id == user_id).order_by(Account.id)
+
+@instrumented
+def reconcile_user(user_id, session, fix=False, tolerance=RECONCILE_TOLERANCE):
+    """
+    Compare every account balance of a user with the balance recomputed from history and transactions. Returns the drifting accounts.
+    With fix a reconciliation adjustment brings the postings of each account to the expected balance and the difference is added to the
+    stored balance, so the summary stays the sum of the postings. Accounts with missing exchange rates are left alone.
+    """
+    drifts = []
+    for account_id, account_name, currency, stored, expected, missing_rates in session.execute(expected_balances_query(user_id)).all():
+        drift = BalanceDrift(user_id, account_id, account_name, currency, Decimal(stored), Decimal(expected) if not missing_rates else None, missing_rates)
+        if drift.expected_balance is not None and abs(drift.difference) <= tolerance:
+            continue
+        drifts.append(drift)
+    if fix:
+        for drift in drifts:
+            if drift.expected_balance is None:
+                LOGGER.warning(f"Not fixing account {drift.account_id}: {drift.missing_rates} transactions have no exchange rate")
+        fixable = {d.account_id: d for d in drifts if d.expected_balance is not None}
+        if fixable:
+            ledger = account_balances_from_postings(user_id, session, list(fixable))
+            for account_id, drift in fixable.items():
+                adjustment = drift.expected_balance - ledger.get(account_id, Decimal(0))
+                if adjustment != 0:
+                    session.add(Posting(user_id=user_id, account_id=account_id, transaction_id=None, amount=adjustment,
+                                        currency=drift.currency, date=datetime.now(), reconciliation=True))
+            # Added under the row lock like every other balance change, concurrent writers keep their deltas
+            apply_balance_deltas(user_id, {a: -d.difference for a, d in fixable.items()}, session, {a: d.currency for a, d in fixable.items()})
+        session.flush()
+    return drifts
+
+def _reconcile_in_own_session(engine, user_id, fix, tolerance):
+    with Session(engine) as session:
+        drifts = reconcile_user(user_id, session, fix=fix, tolerance=tolerance)
+        if fix:
+            session.commit()
+        return drifts
+
+def reconcile_all(engine, user_ids=None, fix=False, tolerance=RECONCILE_TOLERANCE, max_workers=RECONCILE_WORKERS):
+    """Reconcile the given users, or all of them, in parallel with one session and one aggregate query per user."""
+    if user_ids is None:
+        with Session(engine) as session:
+            user_ids = [r[0] for r in session.query(User.id).order_by(User.id).all()]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(lambda u: _reconcile_in_own_session(engine, u, fix, tolerance), user_ids)
+        drifts = [d for user_drifts in results for d in user_drifts]
+    LOGGER.info(f"Reconciled {len(user_ids)} users, {len(drifts)} accounts drifted")
+    return drifts
@@ -0,0 +1,149 @@
+import logging
+import os
+import pandas as pd
+
+from collections import Counter
+from decimal import Decimal
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import distinct_on
+from models import RecurringTransaction, PlannedTransaction, TransactionCategory, TransactionStatusEnum
+from src.instrumentation import instrumented
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_recurrence")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+RECURRENCE_COLUMNS = ['recurring_id', 'user_id', 'category_id', 'recurrence', 'amount', 'due_date_day', 'anchor_date', 'anchor_amount', 'anchor_currency']
+
+def _clamped(month_starts, day):
+    """The given day of each month, moved back to the last day of shorter months."""
+    day = day.clip(lower=1)
+    days_in_month = month_starts.dt.days_in_month
+    return month_starts + pd.to_timedelta(day.where(day <= days_in_month, days_in_month) - 1, unit='D')
+
+def expand_recurrences(recurring, start, end):
+    """
+    Expand recurring transactions into due dates with start <= due_date < end in one pass per recurrence type.
+
+    `recurring` is a frame with RECURRENCE_COLUMNS, the anchor columns describe the last realized planned transaction of the category (or NaN).
+    - monthly: every month on due_date_day, clamped to the last day of shorter months
+    - yearly: every year in the month of the anchor, or the first month of the horizon without one. The anchor's amount and currency are repeated
+    - weekly: every 7 days counted from the anchor, or from due_date_day of the first month of the horizon
+    - daily: every day
+    Returns a frame with user_id, category_id, due_date, amount and currency.
+    """
+    columns = ['user_id', 'category_id', 'due_date', 'amount', 'currency']
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    if recurring.empty or start >= end:
+        return pd.DataFrame(columns=columns)
+    recurring = recurring.copy()
+    recurring['due_date_day'] = recurring['due_date_day'].fillna(1).astype(int)
+    recurring['anchor_date'] = pd.to_datetime(recurring['anchor_date']).dt.normalize()
+    months = pd.DataFrame({'month_start': pd.date_range(start.replace(day=1), end - pd.Timedelta(days=1), freq='MS')})
+    days = pd.DataFrame({'due_date': pd.date_range(start, end - pd.Timedelta(days=1), freq='D')})
+    by_type = {r: recurring[recurring['recurrence'] == r] for r in ['daily', 'weekly', 'monthly', 'yearly']}
+    frames = []
+
+    monthly = by_type['monthly'].merge(months, how='cross')
+    monthly['due_date'] = _clamped(monthly['month_start'], monthly['due_date_day'])
+    frames.append(monthly)
+
+    yearly = by_type['yearly'].copy()
+    yearly['anchor_month'] = yearly['anchor_date'].dt.month.fillna(start.month).astype(int)
+    yearly = yearly.merge(months, how='cross')
+    # Without an anchor only the first month of the horizon is planned, the realized transaction anchors the next years
+    yearly = yearly[(yearly['month_start'].dt.month == yearly['anchor_month']) & (
+        (yearly['month_start'] > yearly['anchor_date']) | (yearly['anchor_date'].isna() & (yearly['month_start'] == months['month_start'].iloc[0]))
+    )].copy()
+    yearly['due_date'] = _clamped(yearly['month_start'], yearly['due_date_day'])
+    has_anchor = yearly['anchor_date'].notna()
+    yearly.loc[has_anchor, 'amount'] = yearly.loc[has_anchor, 'anchor_amount']
+    yearly['currency'] = yearly['anchor_currency'].where(has_anchor, 'HUF')
+    frames.append(yearly)
+
+    weekly = by_type['weekly'].copy()
+    first_month = pd.Series(start.replace(day=1), index=weekly.index)
+    origin = weekly['anchor_date'].fillna(_clamped(first_month, weekly['due_date_day']))
+    # First occurrence on or after the start of the horizon
+    weeks_behind = ((start - origin).dt.days.clip(lower=0) + 6) // 7
+    weekly['first_due'] = origin + pd.to_timedelta(weeks_behind * 7, unit='D')
+    offsets = pd.DataFrame({'offset': range(0, (end - start).days // 7 + 1)})
+    weekly = weekly.merge(offsets, how='cross')
+    weekly['due_date'] = weekly['first_due'] + pd.to_timedelta(weekly['offset'] * 7, unit='D')
+    frames.append(weekly)
+
+    frames.append(by_type['daily'].merge(days, how='cross'))
+
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    planned = pd.concat(frames, ignore_index=True).reindex(columns=['recurring_id'] + columns)
+    planned = planned[(planned['due_date'] >= start) & (planned['due_date'] < end)]
+    planned['currency'] = planned['currency'].fillna('HUF')
+    return planned.sort_values(['user_id', 'recurring_id', 'due_date'])[columns].reset_index(drop=True)
+
+def load_recurrences(user_ids, session):
+    """Recurring transactions of the users with active categories, joined to the last realized planned transaction of their category."""
+    recurring = session.query(RecurringTransaction, TransactionCategory.effective_to).outerjoin(
+        TransactionCategory, TransactionCategory.id == RecurringTransaction.category_id
+    ).filter(RecurringTransaction.user_id.in_(user_ids)).order_by(RecurringTransaction.id).all()
+    # Last realized planned transaction per user and category
+    anchors = {(a.user_id, a.category_id): a for a in session.query(PlannedTransaction).filter(
+        PlannedTransaction.user_id.in_(user_ids),
+        PlannedTransaction.transaction_status == TransactionStatusEnum.realized
+    ).ext(distinct_on(PlannedTransaction.user_id, PlannedTransaction.category_id)).order_by(
+        PlannedTransaction.user_id, PlannedTransaction.category_id, PlannedTransaction.due_date.desc()
+    ).all()}
+    rows = []
+    for rt, category_effective_to in recurring:
+        if category_effective_to is not None:
+            LOGGER.warning(f"Skipping recurring transaction {rt.id}: category {rt.category_id} is no longer active")
+            continue
+        anchor = anchors.get((rt.user_id, rt.category_id))
+        rows.append({
+            'recurring_id': rt.id,
+            'user_id': rt.user_id,
+            'category_id': rt.category_id,
+            'recurrence': rt.recurrence.value,
+            'amount': rt.amount,
+            'due_date_day': rt.due_date_day,
+            'anchor_date': (anchor.realized_date or anchor.due_date) if anchor else None,
+            'anchor_amount': anchor.amount if anchor else None,
+            'anchor_currency': anchor.currency if anchor else None
+        })
+    return pd.DataFrame(rows, columns=RECURRENCE_COLUMNS)
+
+@instrumented
+def plan_recurring_transactions(user_ids, start, end, session):
+    """
+    Create the planned transactions of the users' recurring transactions due between start (inclusive) and end (exclusive), e.g. a whole year at once.
+    Due dates already planned for the same category and amount are skipped, so overlapping horizons can be planned again. Returns the number of rows created.
+    """
+    planned = expand_recurrences(load_recurrences(user_ids, session), start, end)
+    if planned.empty:
+        return 0
+    # Each already planned row with the same category, due date and amount stands in for one expanded row
+    existing = Counter(session.query(PlannedTransaction.user_id, PlannedTransaction.category_id, PlannedTransaction.due_date, PlannedTransaction.amount).filter(
+        PlannedTransaction.user_id.in_(user_ids),
+        PlannedTransaction.due_date >= pd.Timestamp(start).date(),
+        PlannedTransaction.due_date < pd.Timestamp(end).date()
+    ).all())
+    rows = []
+    for r in planned.itertuples(index=False):
+        key = (int(r.user_id), int(r.category_id), r.due_date.date(), Decimal(r.amount))
+        if existing[key]:
+            existing[key] -= 1
+            continue
+        rows.append({
+            'user_id': key[0],
+            'category_id': key[1],
+            'transaction_status': TransactionStatusEnum.planned,
+            'amount': key[3],
+            'currency': r.currency,
+            'due_date': key[2]
+        })
+    if rows:
+        session.execute(insert(PlannedTransaction), rows)
+    LOGGER.info(f"Planned {len(rows)} recurring transactions between {start:%Y-%m-%d} and {end:%Y-%m-%d}")
+    return len(rows)
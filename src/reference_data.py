@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import weakref
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from models import Account, RecurringTransaction, TransactionCategory, UserDataVersion
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_reference_data")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+DEFAULT_MAX_USERS = int(os.getenv("REFERENCE_CACHE_MAX_USERS", "1000"))
+
+# {user_id: version} read in the running pinned_versions block, None outside of one
+_pinned = ContextVar("pinned_data_versions", default=None)
+
+@dataclass(frozen=True)
+class ReferenceData:
+    """
+    The accounts, active categories and recurring transactions of a user at one data version.
+    The rows are plain tuples with attribute access, they stay usable after the session that loaded them is closed.
+    """
+    user_id: int
+    version: int
+    categories: tuple
+    accounts: tuple
+    recurring: tuple
+
+    @property
+    def category_names(self):
+        return {c.id: c.category for c in self.categories}
+
+    @property
+    def account_names(self):
+        """Names of every account, also the deactivated ones that older transactions still refer to."""
+        return {a.id: a.account_name for a in self.accounts}
+
+    @property
+    def active_accounts(self):
+        return [a for a in self.accounts if a.effective_to is None]
+
+def data_version(user_id, session):
+    """The committed data version of a user, 0 until the first change."""
+    return session.query(UserDataVersion.version).filter_by(user_id=user_id).scalar() or 0
+
+def bump_data_version(user_id, session):
+    """Invalidate the cached reference data of a user, called by every dml function changing it. Takes effect on commit."""
+    stmt = pg_insert(UserDataVersion).values(user_id=user_id, version=1)
+    session.execute(stmt.on_conflict_do_update(index_elements=[UserDataVersion.user_id], set_={'version': UserDataVersion.version + 1}))
+    pinned = _pinned.get()
+    if pinned is not None:
+        pinned.pop(user_id, None)
+    get_reference_cache(session).discard(user_id)
+
+def load_reference_data(user_id, version, session):
+    categories = session.query(TransactionCategory.id, TransactionCategory.category).filter_by(
+        user_id=user_id, effective_to=None
+    ).order_by(TransactionCategory.id).all()
+    accounts = session.query(Account.id, Account.account_name, Account.account_type, Account.currency, Account.effective_to).filter_by(
+        user_id=user_id
+    ).order_by(Account.id).all()
+    recurring = session.query(
+        RecurringTransaction.id, RecurringTransaction.user_id, RecurringTransaction.category_id, RecurringTransaction.recurrence,
+        RecurringTransaction.amount, RecurringTransaction.due_date_day
+    ).filter_by(user_id=user_id).order_by(RecurringTransaction.id).all()
+    return ReferenceData(user_id, version, tuple(categories), tuple(accounts), tuple(recurring))
+
+class ReferenceDataCache:
+    """ReferenceData of the most recently used users, an entry is only returned while its version is the current one."""
+
+    def __init__(self, max_users=DEFAULT_MAX_USERS):
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def get(self, user_id, version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry.version != version:
+                return None
+            self._entries.move_to_end(user_id)
+            return entry
+
+    def put(self, entry):
+        with self._lock:
+            self._entries[entry.user_id] = entry
+            self._entries.move_to_end(entry.user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+_CACHES = weakref.WeakKeyDictionary()
+
+def get_reference_cache(session):
+    """Return the reference data cache of the database the session is bound to."""
+    engine = session.get_bind()
+    cache = _CACHES.get(engine)
+    if cache is None:
+        cache = _CACHES[engine] = ReferenceDataCache()
+    return cache
+
+@contextmanager
+def pinned_versions():
+    """Read the data version of every user at most once in the block, e.g. during one rerun of a page."""
+    token = _pinned.set({})
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+def get_reference_data(user_id, session):
+    """
+    The ReferenceData of a user. The data version is checked with one primary key lookup, once per pinned_versions block,
+    the accounts, categories and recurring transactions are only queried again after a change.
+    """
+    pinned = _pinned.get()
+    version = pinned.get(user_id) if pinned is not None else None
+    if version is None:
+        version = data_version(user_id, session)
+        if pinned is not None:
+            pinned[user_id] = version
+    cache = get_reference_cache(session)
+    entry = cache.get(user_id, version)
+    if entry is None:
+        # Read after the version, so a change committed in between is at worst loaded again on the next check
+        entry = load_reference_data(user_id, version, session)
+        cache.put(entry)
+    return entry
@@ -6,14 +6,72 @@ import datetime
 import subprocess
 import re
 
-from src.database_dml import add_new_user, add_transaction, mark_transaction_as_recurring, add_modify_planned_transaction, add_modify_account, add_modify_transaction_category, close_month, link_transaction_with_planned_transaction, load_exchange_rates, modify_transaction
+from src.database_dml import add_new_user, add_transactions_bulk, modify_transactions_bulk, delete_transactions, mark_transaction_as_recurring, add_modify_planned_transactions_bulk, cancel_planned_transactions, add_modify_account, deactivate_accounts, add_modify_transaction_category, close_month, close_month_for_all_users, link_transaction_with_planned_transaction, load_exchange_rates, backfill_exchange_rates, month_bounds, get_transactions_for_period, get_planned_transactions_for_period, account_balances
+from src.changeset import apply_editor_state, diff_frames, invert
+from src.dbt_runner import plan_dbt_build, save_last_build
+from src.recurrence import plan_recurring_transactions
+from src.reconciliation import reconcile_user
+from src.partitions import is_partitioned, list_partitions, maintain_partitions
+from src.reference_data import get_reference_data
+from src.matching import unlinked_transactions, propose_matches, apply_matches
+from src.maintenance import mark_overdue_planned_transactions
+from src.monthly_totals import get_monthly_totals
+from src.database_engine import session_scope
 
-from models import User, TransactionCategory, TransactionTypeEnum, Account, CurrentAccountBalance, Transaction, RecurringTransaction, PlannedTransaction
+from models import User, TransactionTypeEnum
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 LOGGER = logging.getLogger("budget_main")
 LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
 
+TRANSACTION_PAGE_SIZE = int(os.getenv("TRANSACTION_PAGE_SIZE", "500"))
+# Months shown by the monthly totals panel, ending with the selected period
+MONTHLY_TOTALS_MONTHS = int(os.getenv("MONTHLY_TOTALS_MONTHS", "12"))
+
+# data_editor column -> dml field
+TRANSACTION_EDITOR_FIELDS = {
+    "ID": "id",
+    "Transaction Type": "transaction_type",
+    "Category": "category_id",
+    "Amount": "amount",
+    "Currency": "currency",
+    "Account": "account_id",
+    "Target Account": "target_account_id",
+    "Date": "date",
+    "Comment": "comment"
+}
+# Cleared in the editor these are saved as NULL, the other fields keep their value when a cell is empty
+NULLABLE_TRANSACTION_FIELDS = ["target_account_id", "comment"]
+# Every panel of the data entry page is a fragment keyed by its component name: its widgets only rerun the panel itself.
+# A save reruns the panel and the panels showing what it wrote, the selected user and period rerun the whole page.
+PANEL_DEPENDENTS = {
+    "account_balance_overview": ["balance_checker_ui", "transaction_overview"],
+    "transaction_overview": ["balance_checker_ui", "account_balance_overview", "planned_transactions_ui", "monthly_totals_ui"],
+    "transaction_category_ui": ["transaction_overview", "planned_transactions_ui"],
+    "planned_transactions_ui": [],
+    "close_month_ui": ["planned_transactions_ui"],
+    "balance_checker_ui": ["account_balance_overview"]
+}
+PLANNED_EDITOR_FIELDS = {
+    "ID": "id",
+    "Status": "trx_status",
+    "Category": "category_id",
+    "Amount": "amount",
+    "Currency": "trx_currency",
+    "Due Date": "due_date"
+}
+
+def rerun_panels(panel, message=None, level="success"):
+    """Called from the save callback of a panel: rerun it and its dependents, showing message in the panel"""
+    if message:
+        st.session_state[f"{panel}_message"] = (level, message)
+    st.rerun(scope=[panel] + PANEL_DEPENDENTS.get(panel, []))
+
+def show_panel_message(panel):
+    level, message = st.session_state.pop(f"{panel}_message", (None, None))
+    if message:
+        getattr(st, level)(message)
+
 def user_selector(session):
 
     with st.sidebar:
@@ -42,7 +100,7 @@ def account_balance_overview(session):
         st.stop()
 
     st.write("Account balances")
-    balances = session.query(CurrentAccountBalance, Account).join(Account, CurrentAccountBalance.account_id == Account.id).filter(Account.user_id == user_id).all()
+    balances = account_balances(user_id, session, active_only=True)
     data = []
     for t1, t2 in balances:
         data.append({"Account ID": t2.id, 
@@ -55,49 +113,41 @@ def account_balance_overview(session):
         "Account ID": st.column_config.Column("Account ID", disabled=True),
         "Balance": st.column_config.NumberColumn("Balance", format="localized"),
     }
+    editor_key = f"account_editor_{user_id}"
     edited_df = st.data_editor(
         df,
         column_config=column_config,
         hide_index=True,
         use_container_width=True,
-        num_rows="dynamic"
+        num_rows="dynamic",
+        key=editor_key
     )
     
-    if st.button("Save Accounts"):
-        # Iterate over all rows in the edited DataFrame
-        for idx, row in edited_df.iterrows():
-            # Find the original row by Account ID
-            account_id = row.get("Account ID")
-            if pd.isna(account_id):
-                # New account, always add
-                changed = True
-            else:
-                orig_row = df[df["Account ID"] == account_id]
-                if orig_row.empty:
-                    changed = True
-                else:
-                    orig_row = orig_row.iloc[0]
-                    changed = any(
-                        row.get(col) != orig_row.get(col)
-                        for col in ["Account Name", "Account Type", "Account Currency", "Balance"]
-                    )
-            if changed:
-                add_modify_account(
-                    user_id=user_id,
-                    account_name=row.get("Account Name"),
-                    account_type=row.get("Account Type", "bank"),
-                    session=session,
-                    currency=row.get("Account Currency", "HUF"),
-                    amount=row.get("Balance", 0.0),
-                    account_id=account_id if not pd.isna(account_id) else None
-                )
-        session.commit()
-        st.success("Accounts saved.")
-        st.rerun()
+    st.button("Save Accounts", on_click=save_accounts, args=(session.get_bind(), user_id, df, editor_key))
+    show_panel_message("account_balance_overview")
+
+    return dict(zip(edited_df["Account ID"], edited_df["Account Name"]))
 
-    return {row["Account ID"]: row["Account Name"] for idx, row in edited_df.iterrows()}
+def save_accounts(engine, user_id, df, editor_key):
+    # The edits are read from the editor state, the frame returned in the previous run misses an edit made right before the click
+    edited_df = apply_editor_state(df, st.session_state.get(editor_key, {}))
+    changes = diff_frames(df, edited_df, key="Account ID", columns=["Account Name", "Account Type", "Account Currency", "Balance"])
+    with session_scope(engine) as session:
+        for row in changes.inserts + changes.updates:
+            add_modify_account(
+                user_id=user_id,
+                account_name=row.get("Account Name"),
+                account_type=row.get("Account Type") or "bank",
+                session=session,
+                currency=row.get("Account Currency") or "HUF",
+                amount=row.get("Balance") or 0.0,
+                account_id=int(row["Account ID"]) if row.get("Account ID") is not None else None
+            )
+        deactivate_accounts(user_id, changes.deletes, session)
+    st.session_state.pop(editor_key, None)
+    rerun_panels("account_balance_overview", "Accounts saved.")
             
-def period_selector(transactions):
+def period_selector():
     with st.sidebar:
             with st.expander("Period selector"):
                 default_month = datetime.datetime.now().month
@@ -119,26 +169,31 @@ def transaction_overview(session):
         st.warning("Please select a user from the sidebar.")
         st.stop()
 
-    transactions = session.query(Transaction).filter_by(user_id=user_id).all()
-    categories = dict(session.query(*[getattr(TransactionCategory, col) for col in ["id", "category"]]).filter_by(user_id=user_id, effective_to=None).all())
-    account_dict = dict(session.query(*[getattr(Account, col) for col in ["id", "account_name"]]).filter_by(user_id=user_id).all())
+    reference = get_reference_data(user_id, session)
+    categories = reference.category_names
+    account_dict = reference.account_names
 
-    period = period_selector(transactions)
+    period = st.session_state.get("period", datetime.datetime.now())
+    # Keyset pagination: the cursor of every visited page is kept so the user can step back
+    page_key = f"transaction_pages_{user_id}_{period.year}_{period.month}"
+    cursors = st.session_state.setdefault(page_key, [None])
+    transactions = get_transactions_for_period(user_id, *month_bounds(period.year, period.month), session, limit=TRANSACTION_PAGE_SIZE + 1, after=cursors[-1])
+    has_next_page = len(transactions) > TRANSACTION_PAGE_SIZE
+    transactions = transactions[:TRANSACTION_PAGE_SIZE]
     st.write("Transaction Overview")
     data = []
     for t1 in transactions:
-        if t1.date.year == period.year and t1.date.month == period.month:
-            data.append({
-                "ID": t1.id, 
-                "Transaction Type": t1.transaction_type.value, 
-                "Category": categories.get(t1.category_id),
-                "Amount": float(t1.amount),
-                "Currency": t1.currency,
-                "Account": account_dict.get(t1.account_id),
-                "Target Account": account_dict.get(t1.target_account_id),
-                "Date": t1.date,
-                "Comment": t1.comment
-            })
+        data.append({
+            "ID": t1.id, 
+            "Transaction Type": t1.transaction_type.value, 
+            "Category": categories.get(t1.category_id),
+            "Amount": float(t1.amount),
+            "Currency": t1.currency,
+            "Account": account_dict.get(t1.account_id),
+            "Target Account": account_dict.get(t1.target_account_id),
+            "Date": t1.date,
+            "Comment": t1.comment
+        })
     if not data:
         df = pd.DataFrame([{
             "ID": None,
@@ -167,66 +222,77 @@ def transaction_overview(session):
         "Date": st.column_config.DateColumn("Date", default=datetime.datetime.strptime(f"{period.year}-{period.month:02d}-{datetime.datetime.now().day}", "%Y-%m-%d")),
         "Comment": st.column_config.Column("Comment"),
     }
-    edited_df = st.data_editor(
+    editor_key = f"{page_key}_{len(cursors)}_editor"
+    st.data_editor(
         df,
         column_config=column_config,
         hide_index=True,
         use_container_width=True,
-        num_rows="dynamic"
+        num_rows="dynamic",
+        key=editor_key
     )
+    if len(cursors) > 1 or has_next_page:
+        col1, col2 = st.columns(2)
+        # The click itself reruns the panel, the callbacks only move the cursor before that
+        with col1:
+            st.button("Previous page", disabled=len(cursors) == 1, on_click=cursors.pop)
+        with col2:
+            st.button("Next page", disabled=not has_next_page, on_click=cursors.append,
+                      args=((transactions[-1].date, transactions[-1].id) if transactions else None,))
 
-    if st.button("Save Transactions"):
-        # Iterate over all rows in the edited DataFrame
-        for idx, row in edited_df.iterrows():
-            # Find the original row by Transaction ID
-            trx_id = row.get("ID")
-            if pd.isna(trx_id):
-                # New transaction, always add
-                add_transaction(
-                    user_id=user_id, 
-                    category_id=next((k for k, v in categories.items() if v == row.get("Category")), None),
-                    transaction_type=row.get("Transaction Type"),
-                    date=row.get("Date", datetime.datetime.now()),
-                    amount=row.get("Amount"),
-                    session=session,
-                    account_id=next((k for k, v in account_dict.items() if v == row.get("Account")), None),
-                    target_account_id=next((k for k, v in account_dict.items() if v == row.get("Target Account")), None),
-                    trx_currency=row.get("Currency", "HUF"),
-                    comment=row.get("Comment", None)
-                )
-            else:
-                orig_row = df[df["ID"] == trx_id]
-                if orig_row.empty:
-                    #TODO not a likely scenario but in this case a new trx is needed
-                    changed = False
-                else:
-                    orig_row = orig_row.iloc[0]
-                    changed = False
-                    changed = any(
-                        row.get(col) != orig_row.get(col)
-                        for col in ["Amount", "Transaction Type", "Category", "Account", "Target Account", "Date", "Comment", "Currency"]
-                    )
-                if changed:
-                    modify_kwargs = {
-                        "category_id": next((k for k, v in categories.items() if v == row.get("Category")), None),
-                        "transaction_type": row.get("Transaction Type", None),
-                        "date": row.get("Date", None),
-                        "amount": row.get("Amount", None),
-                        "account_id": next((k for k, v in account_dict.items() if v == row.get("Account")), None),
-                        "target_account_id": next((k for k, v in account_dict.items() if v == row.get("Target Account")), None),
-                        "currency": row.get("Currency", "HUF"),
-                        "comment": row.get("Comment", None)
-                    }
-                    modify_transaction(
-                        transaction_id=trx_id,
-                        user_id=user_id,
-                        session=session,
-                        **{k: v for k, v in modify_kwargs.items() if v is not None}
-                    )
-                
-        session.commit()
-        st.success("Transactions saved.")
-        st.rerun()
+    st.button("Save Transactions", on_click=save_transactions, args=(session.get_bind(), user_id, df, editor_key, categories, account_dict))
+    show_panel_message("transaction_overview")
+
+def save_transactions(engine, user_id, df, editor_key, categories, account_dict):
+    changes = diff_frames(
+        df, apply_editor_state(df, st.session_state.get(editor_key, {}), date_columns=["Date"]), key="ID",
+        columns=["Transaction Type", "Category", "Amount", "Currency", "Account", "Target Account", "Date", "Comment"],
+        lookups={"Category": invert(categories), "Account": invert(account_dict), "Target Account": invert(account_dict)},
+        rename=TRANSACTION_EDITOR_FIELDS
+    )
+    with session_scope(engine) as session:
+        modify_transactions_bulk(
+            user_id=user_id,
+            changes=[{k: v for k, v in row.items() if v is not None or k in NULLABLE_TRANSACTION_FIELDS} for row in changes.updates],
+            session=session
+        )
+        add_transactions_bulk(
+            user_id=user_id,
+            transactions=[{**row, "trx_currency": row.get("currency") or "HUF"} for row in changes.inserts],
+            session=session
+        )
+        delete_transactions(user_id=user_id, transaction_ids=changes.deletes, session=session)
+    st.session_state.pop(editor_key, None)
+    rerun_panels("transaction_overview", "Transactions saved.")
+
+def monthly_totals_ui(session):
+    user_id = int(st.session_state.get("selected_user","0:Unknown").split(":")[0])
+    if user_id == 0:
+        st.warning("Please select a user from the sidebar.")
+        st.stop()
+
+    period = st.session_state.get("period", datetime.datetime.now())
+    first_month = period.year * 12 + period.month - MONTHLY_TOTALS_MONTHS
+    start = datetime.date(first_month // 12, first_month % 12 + 1, 1)
+    end = month_bounds(period.year, period.month)[1].date()
+    categories = get_reference_data(user_id, session).category_names
+    # One row per category, account and currency a month from app.monthly_totals, the transactions are not read
+    totals = get_monthly_totals(user_id, session, start, end)
+    st.write("Monthly Totals")
+    if not totals:
+        st.write("No transactions found.")
+        return
+    df = pd.DataFrame([{
+        "Month": t.month.strftime("%Y-%m"),
+        "Category": categories.get(t.category_id, t.category_id),
+        "Transaction Type": t.transaction_type.value,
+        "Currency": t.currency,
+        "Amount": float(t.amount)
+    } for t in totals])
+    st.dataframe(
+        df.pivot_table(index=["Category", "Transaction Type", "Currency"], columns="Month", values="Amount", aggfunc="sum", fill_value=0),
+        use_container_width=True
+    )
 
 def transaction_category_ui(session):
     user_id = int(st.session_state.get("selected_user","0:Unknown").split(":")[0])
@@ -234,8 +300,9 @@ def transaction_category_ui(session):
         st.warning("Please select a user from the sidebar.")
         st.stop()
         
-    categories = session.query(TransactionCategory).filter_by(user_id=user_id, effective_to=None).all()
-    recurring_trx = session.query(RecurringTransaction).filter_by(user_id=user_id).all()
+    reference = get_reference_data(user_id, session)
+    categories = reference.categories
+    recurring_trx = reference.recurring
     recurring_amount_by_category = {
         rt.category_id: rt.amount
         for rt in recurring_trx
@@ -253,16 +320,9 @@ def transaction_category_ui(session):
             due_date_day = st.number_input("Due Date Day", min_value=1, max_value=31, value=10, key="due_date_day")
             amount = st.number_input("Amount", min_value=0.0, step=1.0, key="amount")
 
-        if st.button("Add Category"):
-            if category:
-                new_id = add_modify_transaction_category(user_id=user_id, category_name=cat_name, session=session)
-                st.success(f"Added new category: {cat_name}")
-                if recurring:
-                    mark_transaction_as_recurring(user_id=user_id, category_id=new_id, session=session, recurrence=recurrence, amount=amount, due_date_day=due_date_day) # type: ignore
-                session.commit()
-                st.rerun()
-            else:
-                st.warning("Please enter a category name.")
+        recurrence_settings = (recurrence, amount, due_date_day) if recurring else None # type: ignore
+        st.button("Add Category", on_click=save_category, args=(session.get_bind(), user_id, category, cat_name, recurrence_settings))
+        show_panel_message("transaction_category_ui")
         for cat in categories:
             recurring = cat.id in recurring_amount_by_category
             amount = recurring_amount_by_category.get(cat.id)
@@ -283,20 +343,29 @@ def transaction_category_ui(session):
         #     "Recurring Amount": [recurring_amount_by_category.get(cat.id, 0.0) for cat in categories if cat.effective_to is None or cat.effective_to > datetime.datetime.now()]
         # }, use_container_width=True, height=1000)
 
+def save_category(engine, user_id, category, cat_name, recurrence_settings):
+    if not category:
+        rerun_panels("transaction_category_ui", "Please enter a category name.", level="warning")
+        return
+    with session_scope(engine) as session:
+        new_id = add_modify_transaction_category(user_id=user_id, category_name=cat_name, session=session)
+        if recurrence_settings:
+            recurrence, amount, due_date_day = recurrence_settings
+            mark_transaction_as_recurring(user_id=user_id, category_id=new_id, session=session, recurrence=recurrence, amount=amount, due_date_day=due_date_day)
+    rerun_panels("transaction_category_ui", f"Added new category: {cat_name}")
+
 def planned_transactions_ui(session):
     user_id = int(st.session_state.get("selected_user","0:Unknown").split(":")[0])
     if user_id == 0:
         st.warning("Please select a user from the sidebar.")
         st.stop()
-    planned_trx = session.query(PlannedTransaction).filter_by(user_id=user_id).all()
-    categories = dict(session.query(*[getattr(TransactionCategory, col) for col in ["id", "category"]]).filter_by(user_id=user_id, effective_to=None).all())
+    categories = get_reference_data(user_id, session).category_names
     data = []
-    if 'period' not in st.session_state:
-        period = datetime.datetime.now()
-    else:
-        period = st.session_state.period
+    period = st.session_state.get("period", datetime.datetime.now())
+    period_start, period_end = month_bounds(period.year, period.month)
+    planned_trx = get_planned_transactions_for_period(user_id, period_start, period_end, session)
     for t1 in planned_trx:
-        if t1.due_date.year == period.year and t1.due_date.month == period.month and (t1.transaction_status.value not in ['realized', 'cancelled']):
+        if t1.transaction_status.value not in ['realized', 'cancelled']:
             data.append({
                 "ID": t1.id,
                 #"Transaction ID": t1.transaction_id,
@@ -332,71 +401,91 @@ def planned_transactions_ui(session):
     }
 
     with st.expander("Link Transactions with Planned Transactions"):
-        transactions = session.query(Transaction.id, Transaction.category_id, Transaction.date).filter_by(user_id=user_id).order_by(Transaction.date.desc()).all()
+        transactions = unlinked_transactions(user_id, period_start, period_end, session)[::-1]
         col1, col2 = st.columns(2)
         with col1:
             trx_to_link = st.selectbox(
                 "Select Transaction to Link",
-                options=[""] + [f"{t.id}: {categories.get(t.category_id, 'Unknown')} - {datetime.date(t.date.year, t.date.month, t.date.day)}" for t in transactions if t.date.year == period.year and t.date.month == period.month and t.id not in [pt.transaction_id for pt in planned_trx if pt.transaction_id is not None]],
+                options=[""] + [f"{t.id}: {categories.get(t.category_id, 'Unknown')} - {datetime.date(t.date.year, t.date.month, t.date.day)}" for t in transactions],
                 key="link_transaction"
             )
         with col2:
             planned_trx_to_link = st.selectbox(
                 "Select Planned Transaction to Link",
-                options=[""] + [f"{t.id}: {categories.get(t.category_id, 'Unknown')} - {datetime.date(t.due_date.year, t.due_date.month, t.due_date.day)}" for t in planned_trx if t.due_date.year == period.year and t.due_date.month == period.month and t.transaction_id is None],
+                options=[""] + [f"{t.id}: {categories.get(t.category_id, 'Unknown')} - {datetime.date(t.due_date.year, t.due_date.month, t.due_date.day)}" for t in planned_trx if t.transaction_id is None],
                 key="link_planned_transaction"
             )
-        if st.button("Link Transactions"):
-            link_transaction_with_planned_transaction(int(trx_to_link.split(":")[0]), int(planned_trx_to_link.split(":")[0]), session=session)
-            session.commit()
-            st.rerun()
+        st.button("Link Transactions", on_click=link_transactions, args=(session.get_bind(), trx_to_link, planned_trx_to_link))
+    matching_ui(user_id, period, categories, session)
 
-    edited_df = st.data_editor(
+    editor_key = f"planned_editor_{user_id}_{period.year}_{period.month}"
+    st.data_editor(
         df,
         column_config=column_config,
         use_container_width=True,
         num_rows="dynamic",
         hide_index=True,
+        key=editor_key
     )
-    if st.button("Save Planned Transactions"):
-        # Iterate over all rows in the edited DataFrame
-        for idx, row in edited_df.iterrows():
-            # Find the original row by Transaction ID
-            planned_tx_id = row.get("ID")
-            if pd.isna(planned_tx_id):
-                # New transaction, always add
-                changed = True
-            else:
-                orig_row = df[df["ID"] == planned_tx_id]
-                if orig_row.empty:
-                    changed = True
-                else:
-                    orig_row = orig_row.iloc[0]
-                    changed = any(
-                        row.get(col) != orig_row.get(col)
-                        for col in ["Status", "Category", "Amount", "Due Date"]
-                    )
-            if changed:
-                if pd.isna(row.get("Transaction ID")):
-                    if row.get("Due Date", datetime.datetime.now().date()) >= datetime.datetime.now().date():
-                        valid_status = 'planned'
-                    else:
-                        valid_status = 'overdue'
-                else:
-                    valid_status = 'realized'
-                add_modify_planned_transaction(
-                    planned_tx_id=planned_tx_id if not pd.isna(planned_tx_id) else None,
-                    user_id=user_id,
-                    category_id=next((k for k, v in categories.items() if v == row.get("Category")), None),
-                    due_date=row.get("Due Date", datetime.datetime.now()),
-                    amount=row.get("Amount"),
-                    session=session,
-                    trx_currency= row.get("Currency", "HUF"),
-                    trx_status=valid_status
-                )
-        session.commit()
-        st.success("Transactions saved.")
-        st.rerun()
+    st.button("Save Planned Transactions", on_click=save_planned_transactions, args=(session.get_bind(), user_id, df, editor_key, categories))
+    show_panel_message("planned_transactions_ui")
+
+def matching_ui(user_id, period, categories, session):
+    """Proposed matches of the month's unlinked transactions with planned transactions, linked in one step after review"""
+    state_key = f"proposed_matches_{user_id}_{period.year}_{period.month}"
+    with st.expander("Match transactions automatically"):
+        if st.button("Find matches"):
+            st.session_state[state_key] = propose_matches(user_id, period.year, period.month, session)
+            st.session_state.pop(f"{state_key}_editor", None)
+        matches = st.session_state.get(state_key)
+        if matches is None:
+            return
+        if not matches:
+            st.info("No unlinked transaction matches a planned transaction.")
+            return
+        proposals = pd.DataFrame([{
+            "Confirm": True,
+            "Category": categories.get(m.category_id, "Unknown"),
+            "Date": m.date.date(),
+            "Amount": float(m.amount),
+            "Due Date": m.due_date,
+            "Planned Amount": float(m.planned_amount),
+            "Currency": m.currency
+        } for m in matches])
+        reviewed = st.data_editor(proposals, disabled=[c for c in proposals.columns if c != "Confirm"], hide_index=True, key=f"{state_key}_editor")
+        confirmed = [m for m, confirm in zip(matches, reviewed["Confirm"]) if confirm]
+        st.button(f"Link {len(confirmed)} matches", disabled=not confirmed, on_click=confirm_matches, args=(session.get_bind(), user_id, state_key))
+
+def confirm_matches(engine, user_id, state_key):
+    # Every proposal starts confirmed, the editor state holds the ones unticked up to the click
+    unticked = st.session_state.get(f"{state_key}_editor", {}).get("edited_rows", {})
+    matches = [m for i, m in enumerate(st.session_state[state_key]) if unticked.get(i, {}).get("Confirm", True)]
+    with session_scope(engine) as session:
+        linked = apply_matches(user_id, matches, session)
+    del st.session_state[state_key]
+    st.session_state.pop(f"{state_key}_editor", None)
+    rerun_panels("planned_transactions_ui", f"{linked} transactions linked to planned transactions.")
+
+def link_transactions(engine, trx_to_link, planned_trx_to_link):
+    with session_scope(engine) as session:
+        link_transaction_with_planned_transaction(int(trx_to_link.split(":")[0]), int(planned_trx_to_link.split(":")[0]), session=session)
+    rerun_panels("planned_transactions_ui")
+
+def save_planned_transactions(engine, user_id, df, editor_key, categories):
+    changes = diff_frames(
+        df, apply_editor_state(df, st.session_state.get(editor_key, {}), date_columns=["Due Date"]), key="ID",
+        columns=["Status", "Category", "Amount", "Currency", "Due Date"],
+        lookups={"Category": invert(categories)},
+        rename=PLANNED_EDITOR_FIELDS
+    )
+    with session_scope(engine) as session:
+        # Saved rows are planned again, the ones already past due are then marked the same way the daily maintenance does
+        rows = [{**row, "trx_status": "planned"} for row in changes.inserts + changes.updates]
+        add_modify_planned_transactions_bulk(user_id=user_id, rows=rows, session=session)
+        cancel_planned_transactions(user_id=user_id, planned_transaction_ids=changes.deletes, session=session)
+        mark_overdue_planned_transactions(session, user_id=user_id)
+    st.session_state.pop(editor_key, None)
+    rerun_panels("planned_transactions_ui", "Transactions saved.")
 
 def close_month_ui(session):
     user_id = int(st.session_state.get("selected_user","0:Unknown").split(":")[0])
@@ -405,18 +494,71 @@ def close_month_ui(session):
         st.stop()
     
     st.subheader("Close Month")
-    if st.button("Close Current Month"):
-        if 'period' not in st.session_state:
-            st.error("Please select a period first.")
-        period = st.session_state.period
-        close_month(period.year, period.month, user_id, session)
-        st.success("Current month closed successfully.")
+    all_users = st.checkbox("Close for all users", value=False, key="close_month_all_users")
+    engine = session.get_bind()
+    st.button("Close Current Month", on_click=close_selected_month, args=(engine, user_id, all_users))
+    st.button("Plan recurring transactions for the next 12 months", on_click=plan_next_12_months, args=(engine, user_id))
+    show_panel_message("close_month_ui")
+
+def close_selected_month(engine, user_id, all_users):
+    if 'period' not in st.session_state:
+        rerun_panels("close_month_ui", "Please select a period first.", level="error")
+        return
+    period = st.session_state.period
+    with session_scope(engine) as session:
+        if all_users:
+            closed = close_month_for_all_users(period.year, period.month, session)
+            message = f"Current month closed for {len(closed)} users."
+        else:
+            close_month(period.year, period.month, user_id, session)
+            message = "Current month closed successfully."
+    rerun_panels("close_month_ui", message)
+
+def plan_next_12_months(engine, user_id):
+    today = datetime.date.today()
+    start, _ = month_bounds(today.year, today.month)
+    end = start.replace(year=start.year + 1)
+    with session_scope(engine) as session:
+        created = plan_recurring_transactions([user_id], start, end, session)
+    rerun_panels("close_month_ui", f"{created} planned transactions created.")
 
 def refresh_exchange_rates_ui(session):
     with st.sidebar:
         if st.button("Refresh exchange rates"):
             load_exchange_rates(session)
             st.success("Exchange rates refreshed successfully.")
+        with st.expander("Backfill historical rates"):
+            today = datetime.date.today()
+            period = st.date_input("Period", value=(today - datetime.timedelta(days=30), today), max_value=today, key="fx_backfill_period")
+            if st.button("Backfill exchange rates") and len(period) == 2:
+                written = backfill_exchange_rates(period[0], period[1], session)
+                session.commit()
+                st.success(f"{written} exchange rates loaded.")
+
+def partition_report_ui(session):
+    """Sizes of the monthly transaction partitions, with a button to create the upcoming ones"""
+    if not is_partitioned(session):
+        return
+    with st.sidebar.expander("Transaction partitions"):
+        if st.button("Create upcoming partitions"):
+            created, _ = maintain_partitions(session, retention_months=None)
+            st.success(f"Created {', '.join(created)}" if created else "All upcoming partitions exist.")
+        partitions = pd.DataFrame([{
+            'partition': p.name,
+            'from': p.start,
+            'size (kB)': round(p.size_bytes / 1024),
+            'rows (est.)': p.estimated_rows
+        } for p in list_partitions(session)])
+        st.dataframe(partitions, hide_index=True)
+
+def query_debug_panel(query_stats):
+    """Statements and database time of this rerun per component and dml function, a statement counts for every scope it ran in"""
+    with st.sidebar.expander("Query statistics"):
+        st.dataframe(pd.DataFrame([{
+            "Scope": scope,
+            "Statements": stats.count,
+            "DB time (ms)": round(stats.milliseconds, 1)
+        } for scope, stats in sorted(query_stats.items(), key=lambda item: -item[1].seconds)]), hide_index=True)
 
 def should_keep_dbt_line(line):
     """Check if a single line should be kept"""
@@ -434,16 +576,24 @@ def clean_dbt_line(line):
     """Remove ANSI color codes from a line"""
     return re.sub(r'\[0m|\[32m|\[31m', '', line)
 
-def run_dbt_models():
+def run_dbt_models(session):
     with st.sidebar:
+        selective = st.checkbox("Only rebuild changed models", value=True, key="dbt_selective")
+        full_refresh = st.checkbox("Full refresh", value=False, key="dbt_full_refresh", help="Rebuild the FX rate intervals from the whole rate history, e.g. after changing their model. Every other model is rebuilt on each run anyway.")
         if st.button("Run dbt Transformations"):
-            cwd = os.getcwd()
+            project_dir = f"{os.getcwd()}/dbt_budget"
+            command, build_state = plan_dbt_build(session, project_dir, selective=selective, full_refresh=full_refresh)
+            # No connection is held while dbt runs
+            session.commit()
+            if command is None:
+                st.info("No source table changed since the last dbt build.")
+                return
             with st.spinner("Running dbt models..."):
                 with st.expander("dbt Output"):
                     output_placeholder = st.empty()
                 try:
                     process = subprocess.Popen(
-                        ["uv", "run", "dbt", "build", "--target", "dev", "--profiles-dir", f"{cwd}/dbt_budget/.dbt", "--project-dir", f"{cwd}/dbt_budget"],
+                        command,
                         stdout=subprocess.PIPE,
                         stderr=subprocess.STDOUT,
                         text=True
@@ -459,6 +609,7 @@ def run_dbt_models():
                     
                     process.wait()
                     if process.returncode == 0:
+                        save_last_build(project_dir, build_state)
                         st.success("dbt models executed successfully.")
                     else:
                         st.error(f"dbt execution failed with return code {process.returncode}")
@@ -471,13 +622,16 @@ def balance_checker_ui(session):
         st.warning("Please select a user from the sidebar.")
         st.stop()
     # Get all accounts and balances for the user
-    balances = session.query(CurrentAccountBalance, Account).join(Account, CurrentAccountBalance.account_id == Account.id).filter(Account.user_id == user_id).all()
+    balances = account_balances(user_id, session)
     # Filter only bank accounts
     bank_accounts = [(t1, t2) for t1, t2 in balances if t2.account_type == "bank"]
     if not bank_accounts:
         st.info("No bank accounts found.")
-        return
+    else:
+        bank_balance_metrics(bank_accounts)
+    balance_reconciliation_ui(user_id, session)
 
+def bank_balance_metrics(bank_accounts):
     # Dynamically create columns for each bank account
     cols = st.columns(len(bank_accounts))
     for idx, (col, (bal, acc)) in enumerate(zip(cols, bank_accounts)):
@@ -498,4 +652,31 @@ def balance_checker_ui(session):
         with col:
             st.markdown(f"**{acc.account_name}**")
             delta = real_balance - float(bal.balance)
-            st.metric(label="App Balance", value=f"{float(bal.balance):,.0f}", delta=f"{delta:,.0f}")
\ No newline at end of file
+            st.metric(label="App Balance", value=f"{float(bal.balance):,.0f}", delta=f"{delta:,.0f}")
+
+def balance_reconciliation_ui(user_id, session):
+    state_key = f"balance_drifts_{user_id}"
+    show_panel_message("balance_checker_ui")
+    if st.button("Check balances against transactions"):
+        st.session_state[state_key] = reconcile_user(user_id, session)
+    drifts = st.session_state.get(state_key)
+    if drifts is None:
+        return
+    if not drifts:
+        st.success("All balances match the balance history and transactions.")
+        return
+    st.dataframe(pd.DataFrame([{
+        "Account": d.account_name,
+        "Currency": d.currency,
+        "Stored balance": float(d.stored_balance),
+        "Expected balance": None if d.expected_balance is None else float(d.expected_balance),
+        "Difference": None if d.difference is None else float(d.difference),
+        "Missing rates": d.missing_rates
+    } for d in drifts]), hide_index=True)
+    st.button("Adjust balances to the expected values", on_click=adjust_balances, args=(session.get_bind(), user_id))
+
+def adjust_balances(engine, user_id):
+    with session_scope(engine) as session:
+        reconcile_user(user_id, session, fix=True)
+    del st.session_state[f"balance_drifts_{user_id}"]
+    rerun_panels("balance_checker_ui", "Adjustments posted to the expected balances.")
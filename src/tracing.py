@@ -0,0 +1,150 @@
+import functools
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# Logger configuration
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger("budget_tracing")
+LOGGER.setLevel(os.getenv("LOGLEVEL", "DEBUG"))
+
+# Spans are only recorded when an export file is configured. A .jsonl path gets one line per span name on every flush,
+# any other path is rewritten in the Prometheus text format for a node exporter textfile collector or a plain scrape.
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH") or None
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# p50 and p95 are computed over the most recent samples of each span
+RECENT_SAMPLES = 1024
+METRIC = "budget_span_duration_seconds"
+
+class Histogram:
+    """Cumulative bucket counts of one span name plus a window of recent samples for the percentiles."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+    def quantile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+_enabled = TRACE_EXPORT_PATH is not None
+_export_path = TRACE_EXPORT_PATH
+_histograms = {}
+_lock = threading.Lock()
+
+def configure_tracing(export_path=None, enabled=True):
+    """Turn span recording on or off and set the export file, e.g. from a test or a script."""
+    global _enabled, _export_path
+    _enabled = enabled
+    _export_path = export_path
+
+def tracing_enabled():
+    return _enabled
+
+def reset_tracing():
+    with _lock:
+        _histograms.clear()
+
+def record(name, seconds):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+@contextmanager
+def span(name):
+    """Record the wall time of the block under name. Does nothing unless tracing is enabled."""
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+def traced(fn=None, name=None):
+    """Decorator recording a span per call, named after the function's module and name by default."""
+    if fn is None:
+        return lambda f: traced(f, name)
+    span_name = name or f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(span_name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def span_summary():
+    """{span name: {'count', 'sum_seconds', 'p50_seconds', 'p95_seconds'}} of everything recorded so far."""
+    with _lock:
+        return {name: {
+            'count': h.count,
+            'sum_seconds': h.sum,
+            'p50_seconds': h.quantile(0.5),
+            'p95_seconds': h.quantile(0.95)
+        } for name, h in sorted(_histograms.items())}
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+def prometheus_text():
+    """The recorded spans as a Prometheus histogram plus a summary with the recent p50 and p95."""
+    with _lock:
+        histograms = sorted(_histograms.items())
+        lines = [f"# HELP {METRIC} Wall time of page components and dml calls.", f"# TYPE {METRIC} histogram"]
+        for name, h in histograms:
+            for bound, count in zip(BUCKETS, h.buckets):
+                lines.append(f'{METRIC}_bucket{{span="{_label(name)}",le="{bound}"}} {count}')
+            lines.append(f'{METRIC}_bucket{{span="{_label(name)}",le="+Inf"}} {h.count}')
+            lines.append(f'{METRIC}_sum{{span="{_label(name)}"}} {h.sum:.6f}')
+            lines.append(f'{METRIC}_count{{span="{_label(name)}"}} {h.count}')
+        recent = "budget_span_recent_duration_seconds"
+        lines += [f"# HELP {recent} Percentiles over the last {RECENT_SAMPLES} calls of each span.", f"# TYPE {recent} summary"]
+        for name, h in histograms:
+            for q in (0.5, 0.95):
+                lines.append(f'{recent}{{span="{_label(name)}",quantile="{q}"}} {h.quantile(q):.6f}')
+            lines.append(f'{recent}_sum{{span="{_label(name)}"}} {sum(h.recent):.6f}')
+            lines.append(f'{recent}_count{{span="{_label(name)}"}} {len(h.recent)}')
+    return "\n".join(lines) + "\n"
+
+def flush_metrics(path=None):
+    """Write the recorded spans to the export file. Prometheus files are replaced atomically, JSON lines are appended."""
+    path = path or _export_path
+    if not _enabled or not path:
+        return None
+    try:
+        if path.endswith(".jsonl"):
+            now = datetime.now().isoformat(timespec='milliseconds')
+            with open(path, "a") as f:
+                for name, stats in span_summary().items():
+                    f.write(json.dumps({'ts': now, 'span': name, **stats}) + "\n")
+        else:
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(prometheus_text())
+            os.replace(tmp_path, path)
+    except OSError as e:
+        LOGGER.warning(f"Could not write the span metrics to {path}: {e}")
+        return None
+    return path
@@ -2,13 +2,33 @@ import requests
 import dotenv
 import os
 
-from datetime import datetime
+from datetime import datetime, timedelta
 dotenv.load_dotenv()
 
+def api_base_url():
+    """Base URL of the open exchange rates api, EXCHANGE_RATES_API_URL points it elsewhere, e.g. to a local stub server."""
+    return os.getenv("EXCHANGE_RATES_API_URL", "https://openexchangerates.org/api/")
+
+def rates_from_response(data, symbols, day):
+    """Turn the USD based rates of one api response into rates between every pair of symbols."""
+    result = []
+    for from_curr in symbols:
+        if from_curr not in data['rates']:
+            print(f"Symbol {from_curr} not found in the response.")
+            continue
+        for to_curr in symbols:
+            if to_curr not in data['rates']:
+                continue
+            if from_curr == 'USD':
+                result.append({'from_currency': from_curr, 'to_currency': to_curr, 'rate': data['rates'][to_curr], 'date': day})
+            else:
+                result.append({'from_currency': from_curr, 'to_currency': to_curr, 'rate': data['rates'][to_curr] * (1/data['rates'][from_curr]), 'date': day})
+    return result
+
 def fetch_exchange_rates(symbols: list) -> list[dict]:
     """Fetch the latest currency exchange rates from an open exchange rates' api.
     The api always gives results with USD base currency."""
-    url_base = "https://openexchangerates.org/api/"  # Example API endpoint
+    url_base = api_base_url()
     headers = {"accept": "application/json"}
     app_id = os.getenv("APP_ID")
     today = datetime.now().date()
@@ -22,19 +42,26 @@ def fetch_exchange_rates(symbols: list) -> list[dict]:
     except Exception as e:
         print(f"Unexpected error: {e}")
         return [{}]
-    result = []
-    for from_curr in symbols:
-        if from_curr not in data['rates']:
-            print(f"Symbol {from_curr} not found in the response.")
-            continue
-        for to_curr in symbols:
-            if to_curr not in data['rates']:
-                continue
-            if from_curr == 'USD':
-                result.append({'from_currency': from_curr, 'to_currency': to_curr, 'rate': data['rates'][to_curr], 'date': today})
-            else:
-                result.append({'from_currency': from_curr, 'to_currency': to_curr, 'rate': data['rates'][to_curr] * (1/data['rates'][from_curr]), 'date': today})
+    return rates_from_response(data, symbols, today)
 
+def fetch_historical_exchange_rates(symbols: list, start_date, end_date) -> list[dict]:
+    """Fetch the rates of every day between start_date and end_date (inclusive) from the historical endpoint of the api.
+    Days the api cannot serve are skipped and reported."""
+    url_base = api_base_url()
+    headers = {"accept": "application/json"}
+    app_id = os.getenv("APP_ID")
+    result = []
+    # One connection is reused for the whole range
+    with requests.Session() as http:
+        day = start_date
+        while day <= end_date:
+            try:
+                response = http.get(url_base + f"historical/{day:%Y-%m-%d}.json?app_id={app_id}&symbols={','.join(symbols)}", headers=headers)
+                response.raise_for_status()
+                result += rates_from_response(response.json(), symbols, day)
+            except Exception as e:
+                print(f"Error fetching exchange rates of {day}: {e}")
+            day += timedelta(days=1)
     return result
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+"""
+Local stand-in for the open exchange rates api, serving latest.json and historical/<YYYY-MM-DD>.json with USD based rates.
+
+Rates are deterministic: every currency moves by 0.1% per day from its base rate, so any date can be served offline.
+Run it with `python -m tests.fx_stub_server --port 8099` and set EXCHANGE_RATES_API_URL=http://localhost:8099/api/.
+"""
+import argparse
+import json
+import re
+import threading
+
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BASE_RATES = {"USD": 1.0, "EUR": 0.92, "GBP": 0.78, "HUF": 360.0}
+BASE_DATE = date(2025, 1, 1)
+HISTORICAL_PATH = re.compile(r"^/api/historical/(\d{4}-\d{2}-\d{2})\.json$")
+
+def stub_rates(day, symbols=None):
+    factor = 1 + (day - BASE_DATE).days * 0.001
+    return {s: (1.0 if s == "USD" else rate * factor) for s, rate in BASE_RATES.items() if not symbols or s in symbols}
+
+class FxStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        symbols = parse_qs(url.query).get("symbols", [""])[0].split(",")
+        symbols = [s for s in symbols if s]
+        self.server.requests.append(url.path)
+        match = HISTORICAL_PATH.match(url.path)
+        if url.path == "/api/latest.json":
+            day = datetime.now().date()
+        elif match:
+            day = date.fromisoformat(match.group(1))
+        else:
+            self.send_error(404)
+            return
+        if day in self.server.missing_days:
+            self.send_error(400, "No rates for this day")
+            return
+        body = json.dumps({"base": "USD", "rates": stub_rates(day, symbols)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FxStubServer(ThreadingHTTPServer):
+    """Stub api on a background thread. Use as a context manager, `url` is the value for EXCHANGE_RATES_API_URL."""
+
+    def __init__(self, port=0, missing_days=()):
+        super().__init__(("127.0.0.1", port), FxStubHandler)
+        self.requests = []
+        self.missing_days = set(missing_days)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+    server = FxStubServer(args.port)
+    print(f"Serving stub exchange rates on {server.url}")
+    server.serve_forever()
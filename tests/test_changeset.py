@@ -0,0 +1,59 @@
+import pandas as pd
+from datetime import date
+from src.changeset import apply_editor_state, diff_frames, invert
+
+COLUMNS = ["Category", "Amount", "Comment"]
+
+def original_frame():
+    return pd.DataFrame([
+        {"ID": 1, "Category": "Water", "Amount": 10.0, "Comment": None},
+        {"ID": 2, "Category": "Car", "Amount": 20.0, "Comment": "fuel"},
+        {"ID": 3, "Category": "Car", "Amount": 30.0, "Comment": None},
+    ])
+
+def test_diff_frames():
+    original = original_frame()
+    edited = original.copy()
+    edited.loc[1, "Amount"] = 25.0
+    edited = edited[edited["ID"] != 3]
+    edited = pd.concat([edited, pd.DataFrame([
+        {"ID": None, "Category": "Water", "Amount": 5.0, "Comment": None},
+        {"ID": None, "Category": None, "Amount": None, "Comment": None},
+    ])], ignore_index=True)
+    changes = diff_frames(original, edited, key="ID", columns=COLUMNS,
+                          lookups={"Category": invert({7: "Water", 8: "Car"})},
+                          rename={"ID": "id", "Category": "category_id", "Amount": "amount", "Comment": "comment"})
+    # Empty rows are ignored and unchanged rows with empty cells are not updates
+    assert changes.inserts == [{"category_id": 7, "amount": 5.0, "comment": None}]
+    assert changes.updates == [{"id": 2, "category_id": 8, "amount": 25.0, "comment": "fuel"}]
+    assert changes.deletes == [3]
+    assert changes
+
+def test_diff_frames_no_changes():
+    original = original_frame()
+    changes = diff_frames(original, original.copy(), key="ID", columns=COLUMNS)
+    assert not changes
+    assert not diff_frames(pd.DataFrame([]), pd.DataFrame([]), key="ID", columns=COLUMNS)
+
+def test_invert():
+    assert invert({1: "a", 2: "b", 3: "a"}) == {"a": 1, "b": 2}
+
+def test_apply_editor_state():
+    original = original_frame()
+    original["Due Date"] = [date(2025, 9, 1)] * 3
+    state = {
+        "edited_rows": {0: {"Comment": "tap"}, 1: {"Amount": 25, "Comment": None, "Due Date": "2025-09-15"}},
+        "deleted_rows": [2],
+        "added_rows": [{"Category": "Water", "Amount": 5}]
+    }
+    edited = apply_editor_state(original, state, date_columns=["Due Date"])
+    assert edited.to_dict("records") == [
+        {"ID": 1, "Category": "Water", "Amount": 10.0, "Comment": "tap", "Due Date": date(2025, 9, 1)},
+        {"ID": 2, "Category": "Car", "Amount": 25, "Comment": None, "Due Date": date(2025, 9, 15)},
+        {"ID": None, "Category": "Water", "Amount": 5, "Comment": None, "Due Date": None},
+    ]
+    # The original frame is left as the editor was given it
+    assert original.loc[1, "Amount"] == 20.0
+    changes = diff_frames(original, edited, key="ID", columns=COLUMNS + ["Due Date"])
+    assert [u["ID"] for u in changes.updates] == [1, 2] and changes.deletes == [3] and len(changes.inserts) == 1
+    assert apply_editor_state(original, {}).equals(original.astype(object))
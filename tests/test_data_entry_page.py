@@ -0,0 +1,77 @@
+import pytest
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from streamlit.testing.v1 import AppTest
+from models import Base, TransactionCategory
+from src.database_dml import add_new_user, add_transaction, add_modify_planned_transaction
+from src.database_engine import get_engine
+from datetime import datetime
+
+pg = create_postgres_fixture(Base)
+
+@pytest.fixture
+def page_engine(pg, monkeypatch):
+    """The engine 1_Data_Entry.py creates from the DB_* variables, pointed at the test database"""
+    credentials = pg.pmr_credentials
+    for name, value in [('DB_USER', credentials.username), ('DB_PASSWORD', credentials.password), ('DB_HOST', credentials.host),
+                        ('DB_PORT', credentials.port), ('DB_NAME', credentials.database)]:
+        monkeypatch.setenv(name, str(value))
+    get_engine.cache_clear()
+    engine = get_engine()
+    yield engine
+    engine.dispose()
+    get_engine.cache_clear()
+
+@pytest.fixture
+def statements(page_engine):
+    executed = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+    event.listen(page_engine, "before_cursor_execute", capture)
+    yield executed
+    event.remove(page_engine, "before_cursor_execute", capture)
+
+def test_saves_only_rerun_the_dependent_panels(page_engine, statements):
+    session = sessionmaker(bind=page_engine)()
+    user_id, bank_id = add_new_user('A', 'B', session, 1000)
+    category_id = session.query(TransactionCategory.id).filter_by(user_id=user_id).first()[0]
+    today = datetime.now()
+    for day in range(1, today.day + 1):
+        add_transaction(user_id, category_id, 'debit', today.replace(day=day).strftime('%Y-%m-%d'), 5, session, bank_id)
+    add_modify_planned_transaction(user_id, category_id, today.date(), 5, session)
+    session.commit()
+    session.close()
+
+    page = AppTest.from_file("../1_Data_Entry.py", default_timeout=60)
+    page.run()
+    assert not page.exception
+    # A rerun of the whole page, with the reference data already cached
+    statements.clear()
+    page.run()
+    full_render = len(statements)
+
+    # Nothing but the planned transactions panel shows planned transactions
+    statements.clear()
+    next(b for b in page.button if b.label == "Save Planned Transactions").click().run()
+    assert not page.exception
+    assert "Transactions saved." in [s.value for s in page.success]
+    assert not [s for s in statements if "app.current_account_balance" in s or "FROM app.users" in s]
+    # Before the panels were fragments every click reran the whole page, a save even twice
+    assert len(statements) < full_render
+
+    # Transactions change the balances and the transactions offered for linking, not the categories or the users.
+    # AppTest only keeps the elements of the fragments that reran, a full run brings back the other panels.
+    page.run()
+    statements.clear()
+    next(b for b in page.button if b.label == "Save Transactions").click().run()
+    assert not page.exception
+    assert any("app.current_account_balance" in s for s in statements)
+    assert not [s for s in statements if "FROM app.users" in s or "pg_partitioned_table" in s]
+
+    # The proposed matches are linked in one step
+    page.run()
+    next(b for b in page.button if b.label == "Find matches").click().run()
+    next(b for b in page.button if b.label == "Link 1 matches").click().run()
+    assert not page.exception
+    assert "1 transactions linked to planned transactions." in [s.value for s in page.success]
@@ -1,9 +1,10 @@
 import pytest
 from pytest_mock_resources import create_postgres_fixture
 from sqlalchemy.orm import sessionmaker
-from models import Base, User, Account, TransactionCategory, CurrentAccountBalance, ExchangeRate, RecurringTransaction, PlannedTransaction, ClosedMonth
-from src.database_dml import add_new_user, add_modify_account, create_modify_account_balance, add_transaction, load_exchange_rates, add_modify_transaction_category, mark_transaction_as_recurring, add_modify_planned_transaction, currency_conversion
-from datetime import datetime
+from models import Base, User, Account, Transaction, TransactionCategory, CurrentAccountBalance, Posting, BalanceHistory, ExchangeRate, RecurringTransaction, PlannedTransaction, ClosedMonth
+from src.database_dml import add_new_user, add_modify_account, create_modify_account_balance, add_transaction, add_transactions_bulk, modify_transaction, modify_transactions_bulk, delete_transactions, account_balances_from_postings, rebuild_postings, add_modify_planned_transactions_bulk, cancel_planned_transactions, deactivate_accounts, load_exchange_rates, backfill_exchange_rates, add_modify_transaction_category, mark_transaction_as_recurring, add_modify_planned_transaction, close_month, close_month_for_all_users, currency_conversion, month_bounds, get_transactions_for_period, get_planned_transactions_for_period
+from datetime import date, datetime
+from tests.fx_stub_server import FxStubServer
 
 pg = create_postgres_fixture(Base)
 
@@ -138,6 +139,185 @@ def test_add_transaction(initial_data_transaction):
     assert float(target_bal.balance) == 50  # type: ignore
     session.close()
 
+def test_add_transactions_bulk(initial_data_transaction):
+    session = initial_data_transaction
+    user = session.query(User).filter_by(first_name='A').first()
+    category = session.query(TransactionCategory).filter_by(category='TestCat').first()
+    account = session.query(Account).filter_by(account_name='TestAccount').first()
+    loan_account = session.query(Account).filter_by(account_name='LoanAccount').first()
+    rows = [{'category_id': category.id, 'transaction_type': 'credit', 'date': '2025-09-09', 'amount': 100, 'account_id': account.id} for _ in range(50)]
+    rows.append({'category_id': category.id, 'transaction_type': 'debit', 'date': '2025-09-10', 'amount': 500})
+    rows.append({'category_id': category.id, 'transaction_type': 'transfer', 'date': '2025-09-11', 'amount': 1000, 'account_id': account.id, 'target_account_id': loan_account.id})
+    ids = add_transactions_bulk(user.id, rows, session)
+    assert len(ids) == 52
+    assert len(set(ids)) == 52
+    bal = session.query(CurrentAccountBalance).filter_by(account_id=account.id, user_id=user.id).first()
+    assert float(bal.balance) == 3500  # type: ignore
+    assert session.query(CurrentAccountBalance).filter_by(account_id=loan_account.id).count() == 1
+    # Nothing is written when any row is invalid
+    with pytest.raises(ValueError):
+        add_transactions_bulk(user.id, [rows[0], {**rows[0], 'date': '2025-08-01'}], session)
+    with pytest.raises(ValueError):
+        add_transactions_bulk(user.id, [rows[0], {**rows[0], 'category_id': 999}], session)
+    with pytest.raises(ValueError):
+        add_transactions_bulk(user.id, [{**rows[0], 'transaction_type': 'transfer'}], session)
+    # An invalid type is rejected before any statement, the session's transaction stays usable
+    with pytest.raises(ValueError):
+        add_transactions_bulk(user.id, [rows[0], {**rows[0], 'transaction_type': 'refund'}], session)
+    assert session.query(Transaction).filter_by(user_id=user.id).count() == 52
+    assert add_transactions_bulk(user.id, [], session) == []
+    session.close()
+
+def test_modify_and_delete_transactions_bulk(initial_data_transaction):
+    session = initial_data_transaction
+    user = session.query(User).filter_by(first_name='A').first()
+    category = session.query(TransactionCategory).filter_by(category='TestCat').first()
+    account = session.query(Account).filter_by(account_name='TestAccount').first()
+    target_account = Account(account_name='TargetAccount', account_type='bank', user_id=user.id, effective_from='2025-08-08')
+    session.add(target_account)
+    session.flush()
+    ids = add_transactions_bulk(user.id, [
+        {'category_id': category.id, 'transaction_type': 'credit', 'date': '2025-09-09', 'amount': 1000, 'account_id': account.id},
+        {'category_id': category.id, 'transaction_type': 'debit', 'date': '2025-09-10', 'amount': 100, 'account_id': account.id},
+    ], session)
+    # Turn the debit into a transfer and raise the credit
+    modify_transactions_bulk(user.id, [
+        {'id': ids[0], 'amount': 1500},
+        {'id': ids[1], 'transaction_type': 'transfer', 'target_account_id': target_account.id, 'comment': 'moved'},
+    ], session)
+    bal = session.query(CurrentAccountBalance).filter_by(account_id=account.id).first()
+    target_bal = session.query(CurrentAccountBalance).filter_by(account_id=target_account.id).first()
+    assert float(bal.balance) == 1400  # type: ignore
+    assert float(target_bal.balance) == 100  # type: ignore
+    with pytest.raises(ValueError):
+        modify_transactions_bulk(user.id, [{'id': ids[0], 'date': '2025-08-02'}], session)
+    with pytest.raises(ValueError):
+        modify_transactions_bulk(user.id, [{'id': ids[0], 'user_id': 5}], session)
+    with pytest.raises(ValueError):
+        modify_transactions_bulk(user.id, [{'id': 999, 'amount': 5}], session)
+    # Cleared target accounts and comments are saved as NULL, a transfer still needs its target account
+    with pytest.raises(ValueError):
+        modify_transactions_bulk(user.id, [{'id': ids[1], 'target_account_id': None}], session)
+    modify_transactions_bulk(user.id, [{'id': ids[1], 'transaction_type': 'debit', 'target_account_id': None, 'comment': None}], session)
+    trx = session.query(Transaction).filter_by(id=ids[1]).one()
+    assert trx.target_account_id is None and trx.comment is None
+    session.refresh(target_bal)
+    assert float(target_bal.balance) == 0  # type: ignore
+    # Deleting reverses the balance effect and releases linked planned transactions
+    add_modify_planned_transaction(user.id, category.id, '2025-09-10', 100, session)
+    planned = session.query(PlannedTransaction).filter_by(user_id=user.id).first()
+    planned.transaction_id = ids[1]
+    planned.transaction_status = 'realized'
+    session.flush()
+    delete_transactions(user.id, [ids[1]], session)
+    session.refresh(bal)
+    session.refresh(target_bal)
+    session.refresh(planned)
+    assert float(bal.balance) == 1500  # type: ignore
+    assert float(target_bal.balance) == 0  # type: ignore
+    assert planned.transaction_id is None
+    assert planned.transaction_status.value == 'planned'
+    with pytest.raises(ValueError):
+        delete_transactions(user.id, [ids[1]], session)
+    session.close()
+
+def test_postings_ledger(initial_data_transaction):
+    session = initial_data_transaction
+    user = session.query(User).filter_by(first_name='A').first()
+    category = session.query(TransactionCategory).filter_by(category='TestCat').first()
+    account_id = add_modify_account(user.id, 'Wallet', 'bank', session, amount=50)
+    loan = session.query(Account).filter_by(account_name='LoanAccount').first()
+    ids = add_transactions_bulk(user.id, [
+        {'category_id': category.id, 'transaction_type': 'credit', 'date': '2025-09-09', 'amount': 1000, 'account_id': account_id},
+        {'category_id': category.id, 'transaction_type': 'transfer', 'date': '2025-09-10', 'amount': 300, 'account_id': account_id, 'target_account_id': loan.id},
+    ], session)
+    legs = session.query(Posting).filter(Posting.transaction_id.in_(ids)).all()
+    assert sorted((p.account_id, float(p.amount)) for p in legs) == sorted([(account_id, 1000), (account_id, -300), (loan.id, -300)])
+    # The ledger is append-only: edits and deletes reverse the legs in effect and post the new ones
+    modify_transaction(ids[1], user.id, session, amount=200)
+    modify_transactions_bulk(user.id, [{'id': ids[0], 'transaction_type': 'debit'}], session)
+    assert session.query(Posting).filter(Posting.transaction_id.in_(ids)).count() == 9
+    delete_transactions(user.id, [ids[1]], session)
+    legs = session.query(Posting).filter(Posting.transaction_id == ids[1]).order_by(Posting.id).all()
+    assert sorted(float(p.amount) for p in legs) == [-300, -300, -200, -200, 200, 200, 300, 300]
+    assert sum(p.amount for p in legs) == 0
+    assert all(p.date == datetime(2025, 9, 10) for p in legs)
+    # Setting an account balance is an adjustment posting
+    add_modify_account(user.id, 'Wallet', 'bank', session, amount=10, account_id=account_id)
+    summary = {b.account_id: b.balance for b in session.query(CurrentAccountBalance).filter_by(user_id=user.id).all()}
+    # Accounts whose legs were all reversed sum to zero
+    assert account_balances_from_postings(user.id, session) == {a: b for a, b in summary.items() if b != 0 or a == loan.id}
+    assert float(summary[account_id]) == 10
+    assert float(summary[loan.id]) == 0
+    # Rebuilding from the transactions table gives the same ledger
+    assert rebuild_postings(user.id, session) == 1
+    assert account_balances_from_postings(user.id, session) == {a: b for a, b in summary.items() if b != 0}
+    session.close()
+
+def test_planned_transactions_and_accounts_bulk(initial_data_transaction):
+    session = initial_data_transaction
+    user = session.query(User).filter_by(first_name='A').first()
+    category = session.query(TransactionCategory).filter_by(category='TestCat').first()
+    add_modify_planned_transactions_bulk(user.id, [
+        {'category_id': category.id, 'due_date': '2025-09-01', 'amount': 10},
+        {'category_id': category.id, 'due_date': '2025-09-02', 'amount': 20, 'trx_currency': 'EUR'},
+    ], session)
+    planned = session.query(PlannedTransaction).filter_by(user_id=user.id).order_by(PlannedTransaction.due_date).all()
+    assert [float(p.amount) for p in planned] == [10, 20]
+    add_modify_planned_transactions_bulk(user.id, [{'id': planned[0].id, 'category_id': category.id, 'due_date': '2025-09-03', 'amount': 15}], session)
+    session.refresh(planned[0])
+    assert float(planned[0].amount) == 15  # type: ignore
+    with pytest.raises(ValueError):
+        add_modify_planned_transactions_bulk(user.id, [{'id': 999, 'category_id': category.id, 'due_date': '2025-09-03', 'amount': 15}], session)
+    cancel_planned_transactions(user.id, [planned[1].id], session)
+    session.refresh(planned[1])
+    assert planned[1].transaction_status.value == 'cancelled'
+    account = session.query(Account).filter_by(account_name='TestAccount').first()
+    deactivate_accounts(user.id, [account.id], session)
+    session.refresh(account)
+    assert account.effective_to is not None
+    session.close()
+
+def test_get_transactions_for_period(initial_data_transaction):
+    session = initial_data_transaction
+    user = session.query(User).filter_by(first_name='A').first()
+    category = session.query(TransactionCategory).filter_by(category='TestCat').first()
+    rows = [{'category_id': category.id, 'transaction_type': 'credit', 'date': f'2025-{month:02d}-{day:02d}', 'amount': 10} for month in (9, 10, 11) for day in (1, 15, 30)]
+    add_transactions_bulk(user.id, rows, session)
+    start, end = month_bounds(2025, 10)
+    assert (start, end) == (datetime(2025, 10, 1), datetime(2025, 11, 1))
+    assert month_bounds(2025, 12)[1] == datetime(2026, 1, 1)
+    transactions = get_transactions_for_period(user.id, start, end, session)
+    assert [t.date.day for t in transactions] == [1, 15, 30]
+    # Keyset pagination returns every row exactly once
+    first_page = get_transactions_for_period(user.id, start, end, session, limit=2)
+    second_page = get_transactions_for_period(user.id, start, end, session, limit=2, after=(first_page[-1].date, first_page[-1].id))
+    assert [t.id for t in first_page + second_page] == [t.id for t in transactions]
+    add_modify_planned_transaction(user.id, category.id, '2025-10-31', 300, session)
+    add_modify_planned_transaction(user.id, category.id, '2025-11-01', 300, session)
+    add_modify_planned_transaction(user.id, category.id, '2025-10-05', 300, session, trx_status='cancelled')
+    assert len(get_planned_transactions_for_period(user.id, start, end, session)) == 2
+    assert len(get_planned_transactions_for_period(user.id, start, end, session, statuses=['planned'])) == 1
+    session.close()
+
+def test_concurrent_balance_updates(pg):
+    from concurrent.futures import ThreadPoolExecutor
+    Session = sessionmaker(bind=pg.engine)
+    with Session() as session:
+        user_id, account_id = add_new_user('A', 'B', session)
+        session.commit()
+
+    def credit(_):
+        with Session() as session:
+            for _ in range(10):
+                create_modify_account_balance(account_id, user_id, 1, 'credit', session)
+                session.commit()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(credit, range(4)))
+    with Session() as session:
+        assert float(session.query(CurrentAccountBalance).filter_by(account_id=account_id).one().balance) == 40
+
 def test_add_modify_transaction_category(initial_data_transaction):
     session = initial_data_transaction
     user = session.query(User).filter_by(first_name='A').first()
@@ -180,8 +360,8 @@ def test_loan_transaction(initial_data_transaction):
     target_account = session.query(Account).filter_by(account_name='LoanAccount').first()
     add_transaction(user.id, category.id, 'transfer', '2025-09-09', 200, session, account_id=account.id, target_account_id=target_account.id)
     bal = session.query(CurrentAccountBalance).filter_by(account_id=1, user_id=user.id).first()
-    # This seems incorrect to pass
-    assert float(bal.balance) == 200
+    # Paying 200 into the loan debits both the bank and the loan account
+    assert float(bal.balance) == -200
     session.close()
 
 def test_invalid_transactions(initial_data_transaction):
@@ -241,6 +421,35 @@ def test_add_modify_planned_transaction(initial_data_transaction):
     #     add_transaction(user.id, category.id, 'invalid_type', '2025-11-01', 100, session)
     session.close()
 
+def test_close_month(initial_data_transaction):
+    session = initial_data_transaction
+    user = session.query(User).filter_by(first_name='A').first()
+    category = session.query(TransactionCategory).filter_by(category='TestCat').first()
+    account = session.query(Account).filter_by(account_name='TestAccount').first()
+    other_user_id, _ = add_new_user('C', 'D', session, 100)
+    add_transaction(user.id, category.id, 'credit', '2025-09-09', 200, session, account.id)
+    mark_transaction_as_recurring(user.id, category.id, session, 'monthly', amount=100, due_date_day=15)
+    mark_transaction_as_recurring(user.id, category.id, session, 'yearly', amount=50, due_date_day=5)
+    mark_transaction_as_recurring(user.id, category.id, session, 'daily', amount=1)
+    add_modify_planned_transaction(user.id, category.id, '2025-09-20', 300, session)
+    add_modify_planned_transaction(user.id, category.id, '2024-09-20', 300, session)
+    close_month(2025, 9, user.id, session)
+    # Only the closing user's balances are snapshotted
+    history = session.query(BalanceHistory).all()
+    assert [(h.user_id, float(h.balance)) for h in history] == [(user.id, 200)]
+    statuses = {str(p.due_date): p.transaction_status.value for p in session.query(PlannedTransaction).filter(PlannedTransaction.due_date < datetime(2025, 10, 1)).all()}
+    assert statuses == {'2025-09-20': 'cancelled', '2024-09-20': 'planned'}
+    planned = session.query(PlannedTransaction).filter(PlannedTransaction.due_date >= datetime(2025, 10, 1)).all()
+    assert len(planned) == 1 + 1 + 31
+    assert {str(p.due_date) for p in planned if float(p.amount) > 1} == {'2025-10-15', '2025-10-05'}
+    # Closing again is a no-op, all users closes only the ones left
+    close_month(2025, 9, user.id, session)
+    assert session.query(BalanceHistory).count() == 1
+    assert close_month_for_all_users(2025, 9, session) == [other_user_id]
+    assert session.query(ClosedMonth).filter_by(year=2025, month=9).count() == 2
+    assert session.query(BalanceHistory).filter_by(user_id=other_user_id).count() == 1
+    session.close()
+
 @pytest.fixture
 def initial_data_exchange_rate(pg):
     Session = sessionmaker(bind=pg.engine)
@@ -253,14 +462,34 @@ def initial_data_exchange_rate(pg):
     yield session  # Provide session with initial data to the test
     session.close()
 
-def test_load_exchange_rates(pg, initial_data_exchange_rate):
+def test_load_exchange_rates(pg, initial_data_exchange_rate, monkeypatch):
     session = initial_data_exchange_rate
-    load_exchange_rates(session)
+    with FxStubServer() as server:
+        monkeypatch.setenv("EXCHANGE_RATES_API_URL", server.url)
+        load_exchange_rates(session)
+    assert server.requests == ["/api/latest.json"]
     # Check if exchange rates are loaded
     rates = session.query(ExchangeRate).all()
     assert len(rates) > 0
     session.close()
 
+def test_backfill_exchange_rates(pg, initial_data_exchange_rate, monkeypatch):
+    session = initial_data_exchange_rate
+    with FxStubServer() as server:
+        monkeypatch.setenv("EXCHANGE_RATES_API_URL", server.url)
+        assert backfill_exchange_rates('2025-02-01', '2025-02-28', session, symbols=['EUR', 'HUF']) == 28 * 4
+        session.commit()
+        # Loading the same days again updates them in place, the symbols now come from the stored rates
+        assert backfill_exchange_rates('2025-02-27', '2025-03-01', session) == 3 * 4
+        # Updated rates count as loaded again for the incremental fx rate intervals in dbt
+        loaded_at = dict(session.query(ExchangeRate.date, ExchangeRate.loaded_at).filter_by(from_currency='EUR', to_currency='HUF').all())
+        assert loaded_at[date(2025, 2, 27)] == loaded_at[date(2025, 3, 1)] > loaded_at[date(2025, 2, 26)]
+        load_exchange_rates(session)
+    assert session.query(ExchangeRate).filter(ExchangeRate.date < datetime(2025, 3, 2)).count() == 29 * 4
+    # Back-dated transactions can be converted now
+    assert currency_conversion(1, 'EUR', 'HUF', datetime(2025, 2, 10), session) > 390
+    session.close()
+
 @pytest.fixture
 def initial_data_currency_conversion(pg):
     Session = sessionmaker(bind=pg.engine)
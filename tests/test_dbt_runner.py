@@ -0,0 +1,75 @@
+import json
+import time
+import pytest
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, TransactionCategory
+from src.database_dml import add_new_user, add_transaction
+from src.dbt_runner import source_write_counts, changed_source_tables, selective_build_selectors, dbt_build_command, plan_dbt_build, \
+    save_last_build, load_last_build
+
+pg = create_postgres_fixture(Base)
+
+@pytest.fixture
+def session(pg):
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    yield session
+    session.close()
+
+def eventually(session, check, timeout=5):
+    """
+    The write statistics reach pg_stat_user_tables up to a second after the commit, once the writing connection is idle.
+    The test writes and reads through the same connection, so the check ends its transaction before it is retried.
+    """
+    deadline = time.monotonic() + timeout
+    while not (result := check()) and time.monotonic() < deadline:
+        session.commit()
+        time.sleep(0.1)
+    return result
+
+def test_source_write_counts(session):
+    user_id, account_id = add_new_user('A', 'B', session, 100)
+    session.commit()
+    category = session.query(TransactionCategory).filter_by(user_id=user_id).first()
+    assert eventually(session, lambda: source_write_counts(session).get('accounts'))
+    before = source_write_counts(session)
+    add_transaction(user_id, category.id, 'credit', '2025-09-09', 200, session, account_id)
+    session.commit()
+    # Writes to the partitions count for the partitioned table
+    changed = eventually(session, lambda: changed_source_tables(source_write_counts(session), before) == ['current_account_balance', 'monthly_totals', 'transactions'])
+    assert changed
+    assert changed_source_tables({**before, 'accounts': 0}, before) == ['accounts']
+
+def test_selective_build_selectors():
+    assert selective_build_selectors(['transactions']) == ['source:budget_app.transactions+']
+    assert selective_build_selectors([], with_state=True) == ['state:modified+']
+    command = dbt_build_command('/app/dbt_budget', select=['source:budget_app.transactions+'], state_dir='/state')
+    assert command[-4:] == ['--select', 'source:budget_app.transactions+', '--state', '/state']
+
+def test_plan_dbt_build(session, tmp_path):
+    (tmp_path / 'models').mkdir()
+    (tmp_path / 'models' / 'fct.sql').write_text("select 1")
+    # Without a previous build everything is built
+    command, build_state = plan_dbt_build(session, str(tmp_path))
+    assert '--select' not in command
+    (tmp_path / 'target').mkdir()
+    (tmp_path / 'target' / 'manifest.json').write_text(json.dumps({}))
+    save_last_build(str(tmp_path), build_state)
+    assert load_last_build(str(tmp_path)) == build_state
+    # Nothing to do right after a build
+    assert plan_dbt_build(session, str(tmp_path))[0] is None
+    add_new_user('A', 'B', session, 100)
+    session.commit()
+    command = eventually(session, lambda: plan_dbt_build(session, str(tmp_path))[0])
+    assert 'source:budget_app.accounts+' in command
+    assert 'source:budget_app.users+' not in command
+    assert 'state:modified+' not in command and '--state' not in command
+    # Changed models are selected through the state of the last build
+    (tmp_path / 'models' / 'fct.sql').write_text("select 2")
+    command, _ = plan_dbt_build(session, str(tmp_path))
+    assert 'state:modified+' in command and '--state' in command
+    command, _ = plan_dbt_build(session, str(tmp_path), selective=False)
+    assert '--select' not in command
+    command, _ = plan_dbt_build(session, str(tmp_path), full_refresh=True)
+    assert '--select' not in command and '--full-refresh' in command
@@ -0,0 +1,119 @@
+import pytest
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, ExchangeRate
+from src.database_dml import currency_conversion
+from src.exchange_rate_cache import ExchangeRateCache, get_exchange_rate_cache
+from datetime import date, datetime
+from decimal import Decimal
+
+pg = create_postgres_fixture(Base)
+
+@pytest.fixture
+def initial_data_rates(pg):
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    for day, rate in [(1, '400'), (2, '401'), (5, '405')]:
+        session.add(ExchangeRate(from_currency='EUR', to_currency='HUF', rate=Decimal(rate), date=date(2025, 9, day)))
+    session.add(ExchangeRate(from_currency='USD', to_currency='HUF', rate=Decimal('350'), date=date(2025, 9, 1)))
+    session.flush()
+    yield session
+    session.close()
+
+def count_queries(session):
+    from sqlalchemy import event
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+    return statements
+
+def test_get_rate(initial_data_rates):
+    session = initial_data_rates
+    cache = ExchangeRateCache()
+    statements = count_queries(session)
+    assert cache.get_rate('EUR', 'HUF', date(2025, 9, 1), session) == Decimal('400')
+    assert cache.get_rate('EUR', 'HUF', datetime(2025, 9, 1, 12, 30), session) == Decimal('400')
+    assert len(statements) == 1
+    assert cache.get_rate('EUR', 'HUF', date(2025, 9, 3), session) is None
+    assert cache.get_rate('EUR', 'HUF', date(2025, 9, 4), session, nearest_prior=True) == Decimal('401')
+    assert cache.get_rate('EUR', 'HUF', date(2025, 8, 31), session, nearest_prior=True) is None
+    session.close()
+
+def test_nearest_prior_is_cached_for_the_requested_day(initial_data_rates):
+    session = initial_data_rates
+    cache = ExchangeRateCache()
+    assert cache.get_rate('EUR', 'HUF', date(2025, 9, 4), session, nearest_prior=True) == Decimal('401')
+    statements = count_queries(session)
+    assert cache.get_rate('EUR', 'HUF', date(2025, 9, 4), session, nearest_prior=True) == Decimal('401')
+    assert statements == []
+    session.commit()
+    assert cache.get_rate('EUR', 'HUF', date(2025, 9, 4), session, nearest_prior=True) == Decimal('401')
+    assert cache.get_rate('EUR', 'HUF', date(2025, 9, 2), session) == Decimal('401')
+    assert statements == []
+    # The fallback is not the rate of the day itself
+    assert cache.get_rate('EUR', 'HUF', date(2025, 9, 4), session) is None
+    assert len(statements) == 1
+    session.close()
+
+def test_preload(initial_data_rates):
+    session = initial_data_rates
+    cache = ExchangeRateCache()
+    assert cache.preload(session, '2025-09-01', '2025-09-30', ['EUR', 'HUF']) == 3
+    statements = count_queries(session)
+    assert cache.get_rate('EUR', 'HUF', '2025-09-05', session) == Decimal('405')
+    assert statements == []
+    # Misses inside the preloaded range are not trusted, another process may have loaded the rate since
+    assert cache.get_rate('EUR', 'HUF', '2025-09-03', session) is None
+    assert len(statements) == 1
+    assert cache.get_rate('EUR', 'HUF', '2025-09-30', session, nearest_prior=True) == Decimal('405')
+    assert len(statements) == 3
+    # USD was not part of the preload
+    assert cache.get_rate('USD', 'HUF', '2025-09-01', session) == Decimal('350')
+    assert len(statements) == 4
+    session.close()
+
+def test_eviction(initial_data_rates):
+    session = initial_data_rates
+    cache = ExchangeRateCache(max_entries=2)
+    cache.preload(session, '2025-09-01', '2025-09-30')
+    session.commit()
+    assert len(cache) == 2
+    # The evicted rate is read from the database again
+    assert cache.get_rate('EUR', 'HUF', '2025-09-01', session) == Decimal('400')
+    session.commit()
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
+    session.close()
+
+def test_rates_are_shared_after_commit(pg):
+    Session = sessionmaker(bind=pg.engine)
+    cache = ExchangeRateCache()
+    with Session() as session:
+        session.add(ExchangeRate(from_currency='EUR', to_currency='HUF', rate=Decimal('400'), date=date(2025, 9, 1)))
+        session.flush()
+        assert cache.get_rate('EUR', 'HUF', date(2025, 9, 1), session) == Decimal('400')
+        session.rollback()
+    # The rate of the rolled back transaction never reaches the shared cache
+    assert len(cache) == 0
+    with Session() as session:
+        assert cache.get_rate('EUR', 'HUF', date(2025, 9, 1), session) is None
+        # A rate loaded by another session after the miss is found
+        with Session() as other:
+            other.add(ExchangeRate(from_currency='EUR', to_currency='HUF', rate=Decimal('401'), date=date(2025, 9, 1)))
+            other.commit()
+        assert cache.get_rate('EUR', 'HUF', date(2025, 9, 1), session) == Decimal('401')
+        session.commit()
+    assert len(cache) == 1
+    with Session() as session:
+        statements = count_queries(session)
+        assert cache.get_rate('EUR', 'HUF', date(2025, 9, 1), session) == Decimal('401')
+        assert statements == []
+
+def test_currency_conversion_uses_cache(initial_data_rates):
+    session = initial_data_rates
+    get_exchange_rate_cache(session).clear()
+    assert currency_conversion(10, 'EUR', 'HUF', date(2025, 9, 2), session) == Decimal('4010')
+    with pytest.raises(ValueError):
+        currency_conversion(10, 'EUR', 'HUF', date(2025, 9, 3), session)
+    assert currency_conversion(10, 'EUR', 'HUF', date(2025, 9, 3), session, nearest_prior=True) == Decimal('4010')
+    session.close()
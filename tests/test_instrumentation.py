@@ -0,0 +1,101 @@
+import pytest
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from streamlit.testing.v1 import AppTest
+from models import Base, ExchangeRate, TransactionCategory
+from src.database_dml import add_new_user, add_modify_account, add_transaction, add_transactions_bulk, modify_transactions_bulk, \
+    delete_transactions, close_month
+from src.instrumentation import assert_max_queries, collect_query_stats, instrument_engine, query_scope
+from datetime import date, datetime
+from decimal import Decimal
+
+pg = create_postgres_fixture(Base)
+
+@pytest.fixture
+def ledger(pg):
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    session.add_all([ExchangeRate(from_currency=f, to_currency=t, rate=Decimal(r), date=date(2025, 9, d))
+                     for d in range(1, 31) for f, t, r in (('EUR', 'HUF', '400'), ('HUF', 'EUR', '0.0025'))])
+    user_id, bank_id = add_new_user('A', 'B', session, 1000)
+    savings_id = add_modify_account(user_id, 'Savings', 'saving', session, currency='EUR')
+    category_id = session.query(TransactionCategory.id).filter_by(user_id=user_id).first()[0]
+    session.commit()
+    yield session, user_id, bank_id, savings_id, category_id
+    session.close()
+
+def transactions(n, category_id, bank_id, savings_id):
+    return [{'category_id': category_id, 'transaction_type': 'transfer' if i % 2 else 'debit', 'date': f'2025-09-{i % 28 + 1:02d}',
+             'amount': 5, 'account_id': bank_id, 'target_account_id': savings_id, 'trx_currency': 'EUR' if i % 3 else 'HUF'} for i in range(n)]
+
+def test_query_counts_do_not_grow_with_rows(pg, ledger):
+    session, user_id, bank_id, savings_id, category_id = ledger
+    with assert_max_queries(pg.engine, 7):
+        add_transaction(user_id, category_id, 'debit', '2025-09-09', 5, session, bank_id)
+    for n in (1, 30):
+        with assert_max_queries(pg.engine, 9):
+            ids = add_transactions_bulk(user_id, transactions(n, category_id, bank_id, savings_id), session)
+        with assert_max_queries(pg.engine, 10):
+            modify_transactions_bulk(user_id, [{'id': i, 'amount': 9} for i in ids], session)
+        with assert_max_queries(pg.engine, 9):
+            delete_transactions(user_id, ids, session)
+    with assert_max_queries(pg.engine, 7):
+        close_month(2025, 9, user_id, session)
+
+def test_statements_are_counted_per_scope(pg, ledger):
+    session, user_id, bank_id, savings_id, category_id = ledger
+    instrument_engine(pg.engine)
+    with collect_query_stats() as stats:
+        with query_scope('transaction_overview'):
+            add_transaction(user_id, category_id, 'debit', '2025-09-09', 5, session, bank_id)
+        session.execute(text("SELECT 1"))
+    # The component, the dml function and the bulk path it delegates to all see the same statements
+    assert stats['transaction_overview'].count == stats['database_dml.add_transaction'].count == stats['database_dml.add_transactions_bulk'].count
+    assert stats['(unscoped)'].count == 1
+    assert stats['(total)'].count == stats['transaction_overview'].count + 1
+    assert stats['(total)'].seconds > 0
+    # Nothing is collected outside the block
+    session.execute(text("SELECT 1"))
+    assert stats['(unscoped)'].count == 1
+    with pytest.raises(AssertionError, match="statements executed in database_dml.add_transactions_bulk, expected at most 2"):
+        with assert_max_queries(pg.engine, 2, scope='database_dml.add_transactions_bulk'):
+            add_transactions_bulk(user_id, transactions(3, category_id, bank_id, savings_id), session)
+
+def data_entry_page(engine):
+    """The components of 1_Data_Entry.py with their statement counts in the session state"""
+    import streamlit as st
+    from src.database_engine import session_scope
+    from src.instrumentation import collect_query_stats, query_scope
+    from src.reference_data import pinned_versions
+    from src.streamlit_components import user_selector, account_balance_overview, transaction_overview, transaction_category_ui, \
+        planned_transactions_ui, close_month_ui, balance_checker_ui
+    with pinned_versions(), collect_query_stats() as stats:
+        for component in [user_selector, balance_checker_ui, transaction_overview, account_balance_overview, transaction_category_ui,
+                          planned_transactions_ui, close_month_ui]:
+            with session_scope(engine) as session, query_scope(component.__name__):
+                component(session)
+    st.session_state["query_counts"] = {scope: s.count for scope, s in stats.items()}
+    st.session_state["statements"] = stats["(total)"].statements
+
+def test_component_query_counts(pg, ledger):
+    session, user_id, bank_id, savings_id, category_id = ledger
+    today = datetime.now().strftime('%Y-%m-%d')
+    for _ in range(20):
+        add_transaction(user_id, category_id, 'debit', today, 5, session, bank_id)
+    session.commit()
+    instrument_engine(pg.engine)
+    page = AppTest.from_function(data_entry_page, args=(pg.engine,), default_timeout=60)
+    page.run()
+    assert not page.exception
+    # The first render loads the reference data, afterwards only its data version is checked, once per render
+    page.run()
+    assert not page.exception
+    counts = page.session_state["query_counts"]
+    reference_tables = ('app.user_data_versions', 'app.accounts', 'app.transaction_categories', 'app.recurring_transactions')
+    assert len([s for s in page.session_state["statements"] if any(f"FROM {t}" in s for t in reference_tables)]) == 1
+    limits = {'user_selector': 1, 'balance_checker_ui': 2, 'transaction_overview': 2, 'account_balance_overview': 1,
+              'transaction_category_ui': 0, 'planned_transactions_ui': 3, 'close_month_ui': 0}
+    exceeded = {c: counts.get(c, 0) for c, limit in limits.items() if counts.get(c, 0) > limit}
+    assert not exceeded, counts
+    assert counts['transaction_overview'] > 0
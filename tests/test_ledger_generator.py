@@ -0,0 +1,26 @@
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+from models import Base, Transaction, PlannedTransaction
+from benchmarks.ledger_generator import generate_ledger
+from src.reconciliation import reconcile_user
+from datetime import date
+
+pg = create_postgres_fixture(Base)
+
+def test_generate_ledger(pg):
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    ledger = generate_ledger(session, users=2, years=1, seed=7, start=date(2025, 1, 1), transactions_per_month=10)
+    assert (ledger.start, ledger.end) == (date(2025, 1, 1), date(2026, 1, 1))
+    assert ledger.transactions == session.query(Transaction).count() == 2 * 12 * 10
+    assert ledger.planned_transactions == session.query(PlannedTransaction).count() == 2 * (4 * 12 + 1)
+    assert session.query(func.count(Transaction.currency.distinct())).scalar() > 1
+    # Everything goes through the dml functions, so the balances add up
+    for user_id in ledger.user_ids:
+        assert reconcile_user(user_id, session) == []
+    # The same seed produces the same ledger
+    amounts = lambda user_ids: [a for (a,) in session.query(Transaction.amount).filter(Transaction.user_id.in_(user_ids)).order_by(Transaction.user_id, Transaction.id)]
+    again = generate_ledger(session, users=2, years=1, seed=7, start=date(2025, 1, 1), transactions_per_month=10)
+    assert amounts(again.user_ids) == amounts(ledger.user_ids)
+    session.close()
@@ -0,0 +1,48 @@
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, MaintenanceRun, PlannedTransaction, TransactionCategory
+from src.database_dml import add_new_user, add_modify_planned_transactions_bulk
+from src.instrumentation import collect_query_stats, instrument_engine
+from src.maintenance import run_overdue_maintenance, mark_overdue_planned_transactions, last_watermark
+from datetime import date
+
+pg = create_postgres_fixture(Base)
+
+def statuses(session):
+    return {(p.user_id, p.due_date): p.transaction_status.value for p in session.query(PlannedTransaction).all()}
+
+def test_overdue_maintenance_runs_once_a_day(pg):
+    instrument_engine(pg.engine)
+    session = sessionmaker(bind=pg.engine)()
+    users = [add_new_user('A', str(i), session)[0] for i in range(2)]
+    for user_id in users:
+        category_id = session.query(TransactionCategory.id).filter_by(user_id=user_id).first()[0]
+        add_modify_planned_transactions_bulk(user_id, [
+            {'category_id': category_id, 'due_date': '2025-09-05', 'amount': 10},
+            {'category_id': category_id, 'due_date': '2025-09-10', 'amount': 10},
+            {'category_id': category_id, 'due_date': '2025-09-01', 'amount': 10, 'trx_status': 'realized'},
+        ], session)
+    session.commit()
+
+    assert run_overdue_maintenance(session, today=date(2025, 9, 8)) == 2
+    assert statuses(session) == {(u, d): s for u in users for d, s in [
+        (date(2025, 9, 5), 'overdue'), (date(2025, 9, 10), 'planned'), (date(2025, 9, 1), 'realized')
+    ]}
+    run = session.query(MaintenanceRun).one()
+    assert (run.task, run.watermark, run.rows_affected) == ('overdue_planned_transactions', date(2025, 9, 8), 2)
+    session.commit()
+
+    # Later runs of the same day only read the watermark
+    with collect_query_stats() as stats:
+        assert run_overdue_maintenance(session, today=date(2025, 9, 8)) is None
+    assert not [s for s in stats['(total)'].statements if s.startswith('UPDATE')]
+    assert run_overdue_maintenance(session, today=date(2025, 9, 11)) == 2
+    assert run_overdue_maintenance(session, today=date(2025, 9, 11), force=True) == 0
+    assert last_watermark('overdue_planned_transactions', session) == date(2025, 9, 11)
+    session.commit()
+
+    # A save marks the rows of its user that are already past due
+    add_modify_planned_transactions_bulk(users[0], [{'category_id': category_id, 'due_date': '2025-09-02', 'amount': 5}], session)
+    assert mark_overdue_planned_transactions(session, today=date(2025, 9, 11), user_id=users[1]) == 0
+    assert mark_overdue_planned_transactions(session, today=date(2025, 9, 11), user_id=users[0]) == 1
+    session.close()
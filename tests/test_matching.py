@@ -0,0 +1,77 @@
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, PlannedTransaction, TransactionCategory, TransactionStatusEnum
+from src.database_dml import add_new_user, add_transactions_bulk, add_modify_planned_transactions_bulk
+from src.instrumentation import assert_max_queries
+from src.matching import propose_matches, apply_matches
+from dataclasses import replace
+from datetime import date, datetime
+from decimal import Decimal
+
+pg = create_postgres_fixture(Base)
+
+def test_propose_and_apply_matches(pg):
+    session = sessionmaker(bind=pg.engine)()
+    user_id, bank_id = add_new_user('A', 'B', session, 100000)
+    categories = dict(session.query(TransactionCategory.category, TransactionCategory.id).filter_by(user_id=user_id).all())
+    water, telco, car = categories['Water'], categories['Telco'], categories['Car']
+    rows = {
+        'water': (water, '2025-09-05', 1000, 'HUF'),
+        'water_next': (water, '2025-10-05', 1000, 'HUF'),
+        'telco': (telco, '2025-09-15', 5000, 'HUF'),
+        # Due in the window before the month, without an amount
+        'car_august': (car, '2025-08-28', 0, 'HUF'),
+        'car_eur': (car, '2025-09-02', 50, 'EUR'),
+    }
+    add_modify_planned_transactions_bulk(user_id, [{'category_id': c, 'due_date': d, 'amount': a, 'trx_currency': cur} for c, d, a, cur in rows.values()], session)
+    planned = {k: session.query(PlannedTransaction.id).filter_by(user_id=user_id, category_id=c, due_date=date.fromisoformat(d), currency=cur).scalar()
+               for k, (c, d, _, cur) in rows.items()}
+    trx = add_transactions_bulk(user_id, [
+        {'category_id': water, 'transaction_type': 'debit', 'date': '2025-09-03', 'amount': 1050, 'account_id': bank_id},
+        # Within the window but beyond the tolerance of 10%
+        {'category_id': telco, 'transaction_type': 'debit', 'date': '2025-09-15', 'amount': 6000, 'account_id': bank_id},
+        # A planned amount of 0 accepts any amount, the currency has to agree
+        {'category_id': car, 'transaction_type': 'debit', 'date': '2025-09-01', 'amount': 31000, 'account_id': bank_id},
+        # The second water bill of the month has no planned transaction close enough
+        {'category_id': water, 'transaction_type': 'debit', 'date': '2025-09-20', 'amount': 1000, 'account_id': bank_id},
+    ], session)
+    session.flush()
+
+    matches = propose_matches(user_id, 2025, 9, session)
+    assert [(m.transaction_id, m.planned_transaction_id) for m in matches] == [(trx[2], planned['car_august']), (trx[0], planned['water'])]
+    assert (matches[1].days_apart, matches[1].amount_difference) == (2, Decimal(50))
+    with assert_max_queries(pg.engine, 1):
+        assert apply_matches(user_id, matches, session) == 2
+    linked = session.query(PlannedTransaction).filter(PlannedTransaction.id.in_([planned['water'], planned['car_august']])).all()
+    assert {(p.transaction_id, p.transaction_status, p.amount) for p in linked} == {
+        (trx[0], TransactionStatusEnum.realized, Decimal(1050)), (trx[2], TransactionStatusEnum.realized, Decimal(31000))
+    }
+    # Linked transactions and realized planned transactions are not proposed again
+    assert propose_matches(user_id, 2025, 9, session) == []
+    assert [m.planned_transaction_id for m in propose_matches(user_id, 2025, 9, session, amount_tolerance=Decimal('0.2'))] == [planned['telco']]
+
+    # A stale confirm neither relinks a realized planned transaction nor links a transaction twice
+    stale = propose_matches(user_id, 2025, 9, session, amount_tolerance=Decimal('0.2'))
+    assert apply_matches(user_id, matches + stale, session) == 1
+    assert apply_matches(user_id, stale, session) == 0
+    add_modify_planned_transactions_bulk(user_id, [{'category_id': telco, 'due_date': '2025-09-16', 'amount': 6000}], session)
+    other_telco = session.query(PlannedTransaction.id).filter_by(user_id=user_id, due_date=date(2025, 9, 16)).scalar()
+    assert apply_matches(user_id, [replace(stale[0], planned_transaction_id=other_telco)], session) == 0
+    assert session.query(PlannedTransaction.transaction_id).filter_by(id=other_telco).scalar() is None
+
+    # A tampered proposal cannot link the rows of two users, in either direction
+    other_user_id, other_bank_id = add_new_user('C', 'D', session, 100000)
+    other_category = session.query(TransactionCategory.id).filter_by(user_id=other_user_id, category='Telco').scalar()
+    other_trx = add_transactions_bulk(other_user_id, [
+        {'category_id': other_category, 'transaction_type': 'debit', 'date': '2025-09-16', 'amount': 6000, 'account_id': other_bank_id}
+    ], session)
+    foreign_transaction = replace(stale[0], transaction_id=other_trx[0], planned_transaction_id=other_telco, date=datetime(2025, 9, 16))
+    assert apply_matches(user_id, [foreign_transaction], session) == 0
+    assert apply_matches(other_user_id, [foreign_transaction], session) == 0
+    assert session.query(PlannedTransaction.transaction_id).filter_by(id=other_telco).scalar() is None
+    # The same match of the user's own rows is linked
+    own = add_transactions_bulk(user_id, [
+        {'category_id': telco, 'transaction_type': 'debit', 'date': '2025-09-16', 'amount': 6000, 'account_id': bank_id}
+    ], session)
+    assert apply_matches(user_id, [replace(foreign_transaction, transaction_id=own[0])], session) == 1
+    session.close()
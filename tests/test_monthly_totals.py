@@ -0,0 +1,57 @@
+from datetime import date
+from decimal import Decimal
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, MonthlyTotal, TransactionCategory
+from src.database_dml import add_new_user, add_modify_account, add_transactions_bulk, modify_transactions_bulk, delete_transactions
+from src.monthly_totals import get_monthly_totals, rebuild_monthly_totals
+
+pg = create_postgres_fixture(Base)
+
+def totals(user_id, session):
+    return {(t.month, t.category_id, t.account_id, t.target_account_id, t.transaction_type.value, t.currency): (t.amount, t.transaction_count)
+            for t in get_monthly_totals(user_id, session)}
+
+def test_monthly_totals_follow_every_transaction_write(pg):
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    user_id, bank_id = add_new_user('A', 'B', session, 1000)
+    other_user_id, other_bank_id = add_new_user('C', 'D', session, 1000)
+    savings_id = add_modify_account(user_id, 'Savings', 'saving', session)
+    food_id, rent_id = [c[0] for c in session.query(TransactionCategory.id).filter_by(user_id=user_id).order_by(TransactionCategory.id).limit(2)]
+    other_category_id = session.query(TransactionCategory.id).filter_by(user_id=other_user_id).first()[0]
+    ids = add_transactions_bulk(user_id, [
+        {'category_id': food_id, 'transaction_type': 'debit', 'date': '2025-08-03', 'amount': 10, 'account_id': bank_id},
+        {'category_id': food_id, 'transaction_type': 'debit', 'date': '2025-08-20', 'amount': 15, 'account_id': bank_id},
+        {'category_id': rent_id, 'transaction_type': 'debit', 'date': '2025-09-01', 'amount': 300, 'account_id': bank_id},
+        {'category_id': rent_id, 'transaction_type': 'transfer', 'date': '2025-09-02', 'amount': 50, 'account_id': bank_id, 'target_account_id': savings_id},
+        {'category_id': rent_id, 'transaction_type': 'transfer', 'date': '2025-09-05', 'amount': 25, 'account_id': bank_id, 'target_account_id': savings_id}
+    ], session)
+    add_transactions_bulk(other_user_id, [
+        {'category_id': other_category_id, 'transaction_type': 'debit', 'date': '2025-08-03', 'amount': 99, 'account_id': other_bank_id}
+    ], session)
+    assert totals(user_id, session) == {
+        (date(2025, 8, 1), food_id, bank_id, None, 'debit', 'HUF'): (Decimal(25), 2),
+        (date(2025, 9, 1), rent_id, bank_id, None, 'debit', 'HUF'): (Decimal(300), 1),
+        (date(2025, 9, 1), rent_id, bank_id, savings_id, 'transfer', 'HUF'): (Decimal(75), 2)
+    }
+
+    # An edit moves the transaction to its new group, a group without transactions is removed
+    modify_transactions_bulk(user_id, [{'id': ids[0], 'date': '2025-09-10', 'category_id': rent_id}, {'id': ids[1], 'amount': 20}], session)
+    delete_transactions(user_id, [ids[3]], session)
+    assert totals(user_id, session) == {
+        (date(2025, 8, 1), food_id, bank_id, None, 'debit', 'HUF'): (Decimal(20), 1),
+        (date(2025, 9, 1), rent_id, bank_id, None, 'debit', 'HUF'): (Decimal(310), 2),
+        (date(2025, 9, 1), rent_id, bank_id, savings_id, 'transfer', 'HUF'): (Decimal(25), 1)
+    }
+    delete_transactions(user_id, [ids[1]], session)
+    assert [t.month for t in get_monthly_totals(user_id, session, start=date(2025, 8, 1), end=date(2025, 9, 1))] == []
+
+    # The rebuild from the transactions gives the same totals, for one user or everybody
+    maintained = totals(user_id, session)
+    assert rebuild_monthly_totals(session, user_id) == 2
+    assert totals(user_id, session) == maintained
+    assert rebuild_monthly_totals(session) == 3
+    assert totals(user_id, session) == maintained
+    assert session.query(MonthlyTotal).filter_by(user_id=other_user_id).one().amount == 99
+    session.close()
@@ -0,0 +1,47 @@
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from models import Base
+from src.partitions import is_partitioned, list_partitions, ensure_partitions, maintain_partitions
+from datetime import date
+
+pg = create_postgres_fixture(Base)
+
+def partition_transactions(session):
+    # The models create a plain table, the database scripts a partitioned one
+    session.execute(text("DROP TABLE app.transactions"))
+    session.execute(text(
+        "CREATE TABLE app.transactions (id integer GENERATED ALWAYS AS IDENTITY, user_id integer, account_id integer, category_id integer, "
+        "target_account_id integer, transaction_type varchar, date timestamp, amount numeric, currency varchar DEFAULT 'HUF', comment varchar, "
+        "PRIMARY KEY (id, date)) PARTITION BY RANGE (date)"
+    ))
+
+def test_maintain_partitions(pg):
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    assert maintain_partitions(session, today=date(2025, 11, 15)) == ([], [])
+    partition_transactions(session)
+    assert is_partitioned(session)
+    created, detached = maintain_partitions(session, months_ahead=2, today=date(2025, 11, 15))
+    assert (created, detached) == (['transactions_2025_11', 'transactions_2025_12', 'transactions_2026_01'], [])
+    assert session.execute(text("SELECT count(*) FROM pg_indexes WHERE indexname = 'transactions_2025_12_user_id_date_idx'")).scalar() == 1
+    session.execute(text("INSERT INTO app.transactions (user_id, date, amount) VALUES (1, '2025-12-24 18:00', 10)"))
+    # Months with a partition are skipped, back-dated months can be added on demand
+    assert ensure_partitions(date(2025, 10, 1), date(2026, 1, 1), session) == ['transactions_2025_10']
+    partitions = list_partitions(session)
+    assert [(p.name, p.start, p.end) for p in partitions][:2] == [('transactions_2025_10', date(2025, 10, 1), date(2025, 11, 1)),
+                                                                  ('transactions_2025_11', date(2025, 11, 1), date(2025, 12, 1))]
+    assert all(p.size_bytes > 0 for p in partitions)
+    session.commit()
+    # Another process holding the maintenance lock makes this run a no-op
+    with pg.engine.connect() as other:
+        other.execute(text("SELECT pg_advisory_lock(7301001)"))
+        assert maintain_partitions(session, months_ahead=6, today=date(2025, 11, 15)) == ([], [])
+        other.execute(text("SELECT pg_advisory_unlock(7301001)"))
+    session.rollback()
+    created, detached = maintain_partitions(session, months_ahead=0, retention_months=1, archive_schema='archive', today=date(2026, 1, 10))
+    assert (created, detached) == ([], ['transactions_2025_10', 'transactions_2025_11'])
+    assert [p.name for p in list_partitions(session)] == ['transactions_2025_12', 'transactions_2026_01']
+    assert session.execute(text("SELECT count(*) FROM archive.transactions_2025_11")).scalar() == 0
+    assert session.execute(text("SELECT count(*) FROM app.transactions")).scalar() == 1
+    session.close()
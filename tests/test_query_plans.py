@@ -0,0 +1,155 @@
+import json
+import pytest
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy import event, text
+from sqlalchemy.orm import sessionmaker
+from streamlit.testing.v1 import AppTest
+from models import Base
+from src.database_dml import add_transactions_bulk, modify_transactions_bulk, delete_transactions, get_transactions_for_period, \
+    get_planned_transactions_for_period, add_modify_planned_transactions_bulk, cancel_planned_transactions, add_modify_account, \
+    add_modify_transaction_category, deactivate_accounts, link_transaction_with_planned_transaction, currency_conversion, \
+    account_balances_from_postings, month_bounds, close_month, mark_transaction_as_recurring
+from src.reconciliation import reconcile_user
+from src.matching import propose_matches, apply_matches
+from src.maintenance import run_overdue_maintenance
+from datetime import date
+
+pg = create_postgres_fixture(Base, scope="module")
+
+USERS = 2000
+# Tables with fewer estimated rows are small enough for a sequential scan to be the right plan
+LARGE_TABLE_ROWS = 5000
+
+SEED = [
+    f"INSERT INTO app.users (first_name, last_name) SELECT 'User', g::text FROM generate_series(1, {USERS}) g",
+    # Ids are predictable on a fresh database: user u owns accounts 3u-2 .. 3u and categories 10u-9 .. 10u
+    """INSERT INTO app.accounts (user_id, account_name, account_type, currency, effective_from)
+       SELECT u.id, a.name, a.type, a.currency, '2024-01-01' FROM app.users u
+       CROSS JOIN (VALUES (1, 'Bank', 'bank', 'HUF'), (2, 'Savings', 'saving', 'EUR'), (3, 'Loan', 'loan', 'HUF')) a(n, name, type, currency)
+       ORDER BY u.id, a.n""",
+    """INSERT INTO app.current_account_balance (user_id, account_id, balance, currency, last_modified_date)
+       SELECT user_id, id, 1000, currency, '2025-06-30' FROM app.accounts""",
+    """INSERT INTO app.transaction_categories (user_id, category, effective_from)
+       SELECT u.id, 'Category ' || c, '2024-01-01' FROM app.users u CROSS JOIN generate_series(1, 10) c ORDER BY u.id, c""",
+    """INSERT INTO app.recurring_transactions (user_id, category_id, recurrence, amount, due_date_day)
+       SELECT u.id, u.id * 10 - 9 + c, 'monthly', 100, 5 FROM app.users u CROSS JOIN generate_series(0, 2) c""",
+    """INSERT INTO app.transactions (user_id, account_id, category_id, transaction_type, date, amount, currency)
+       SELECT u.id, u.id * 3 - 2, u.id * 10 - 9 + g % 10, CASE WHEN g % 5 = 0 THEN 'credit' ELSE 'debit' END::transaction_type,
+              timestamp '2024-01-01' + (g * 13 % 540) * interval '1 day', 10 + g % 90, 'HUF'
+       FROM app.users u CROSS JOIN generate_series(1, 60) g""",
+    """INSERT INTO app.postings (user_id, account_id, transaction_id, amount, currency, date, created_at)
+       SELECT user_id, account_id, id, CASE WHEN transaction_type = 'credit' THEN amount ELSE -amount END, currency, date, date
+       FROM app.transactions""",
+    """INSERT INTO app.monthly_totals (user_id, month, category_id, account_id, target_account_id, transaction_type, currency, amount, transaction_count)
+       SELECT user_id, date_trunc('month', date)::date, category_id, account_id, target_account_id, transaction_type, currency, sum(amount), count(*)
+       FROM app.transactions GROUP BY 1, 2, 3, 4, 5, 6, 7""",
+    """INSERT INTO app.planned_transactions (category_id, user_id, transaction_status, amount, currency, due_date)
+       SELECT u.id * 10 - 9, u.id, CASE WHEN m < 18 THEN 'realized' ELSE 'planned' END::app.transaction_status, 100, 'HUF',
+              date '2024-01-05' + m * interval '1 month'
+       FROM app.users u CROSS JOIN generate_series(0, 23) m""",
+    """INSERT INTO app.balance_history (user_id, account_id, balance, currency, month, created_at)
+       SELECT a.user_id, a.id, 1000, a.currency, date '2024-01-01' + m * interval '1 month', date '2024-02-01' + m * interval '1 month'
+       FROM app.accounts a CROSS JOIN generate_series(0, 17) m""",
+    """INSERT INTO app.closed_months (user_id, year, month)
+       SELECT u.id, 2024 + m / 12, m % 12 + 1 FROM app.users u CROSS JOIN generate_series(0, 17) m""",
+    """INSERT INTO app.exchange_rates (from_currency, to_currency, rate, date)
+       SELECT f, t, CASE WHEN f = t THEN 1 ELSE 1.1 END, d FROM unnest(ARRAY['EUR', 'GBP', 'HUF', 'USD']) f
+       CROSS JOIN unnest(ARRAY['EUR', 'GBP', 'HUF', 'USD']) t CROSS JOIN generate_series(date '2024-01-01', date '2025-12-31', interval '1 day') d""",
+]
+
+@pytest.fixture(scope="module")
+def seeded(pg):
+    with pg.engine.begin() as conn:
+        for statement in SEED:
+            conn.execute(text(statement))
+        conn.execute(text("ANALYZE"))
+    return pg.engine
+
+@pytest.fixture
+def captured(seeded):
+    statements = {}
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")):
+            statements.setdefault(statement, parameters[0] if executemany else parameters)
+    event.listen(seeded, "before_cursor_execute", capture)
+    yield statements
+    event.remove(seeded, "before_cursor_execute", capture)
+
+def large_tables(engine):
+    with engine.connect() as conn:
+        return {r[0] for r in conn.execute(text(
+            "SELECT relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = 'app' AND c.relkind = 'r' AND c.reltuples >= :rows"
+        ), {"rows": LARGE_TABLE_ROWS})}
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+def sequential_scans(engine, statements):
+    """EXPLAIN every captured statement with its parameters, returns the statements scanning a large table sequentially"""
+    large = large_tables(engine)
+    found = []
+    with engine.connect() as conn:
+        for statement, parameters in statements.items():
+            plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+            plan = plan if isinstance(plan, list) else json.loads(plan)
+            scanned = {n["Relation Name"] for n in plan_nodes(plan[0]["Plan"]) if n["Node Type"] == "Seq Scan" and n.get("Relation Name") in large}
+            if scanned:
+                found.append((sorted(scanned), " ".join(statement.split())[:300]))
+        conn.rollback()
+    return found
+
+def test_large_tables_are_seeded(seeded):
+    assert {'transactions', 'postings', 'accounts', 'transaction_categories', 'current_account_balance', 'planned_transactions',
+            'balance_history', 'closed_months', 'exchange_rates', 'monthly_totals'} <= large_tables(seeded)
+
+def test_dml_queries_use_indexes(seeded, captured):
+    user_id, bank_id, savings_id, category_id = 1000, 2998, 2999, 9991
+    session = sessionmaker(bind=seeded)()
+    new_ids = add_transactions_bulk(user_id, [
+        {'category_id': category_id, 'transaction_type': 'debit', 'date': '2025-07-10', 'amount': 5, 'account_id': bank_id},
+        {'category_id': category_id, 'transaction_type': 'transfer', 'date': '2025-07-11', 'amount': 400, 'account_id': bank_id, 'target_account_id': savings_id, 'trx_currency': 'EUR'},
+    ], session)
+    modify_transactions_bulk(user_id, [{'id': new_ids[0], 'amount': 7}], session)
+    start, end = month_bounds(2025, 7)
+    get_transactions_for_period(user_id, start, end, session, limit=50)
+    planned = get_planned_transactions_for_period(user_id, start.date(), end.date(), session)
+    add_modify_planned_transactions_bulk(user_id, [{'category_id': category_id, 'due_date': '2025-08-05', 'amount': 10}], session)
+    link_transaction_with_planned_transaction(new_ids[0], planned[0].id, session)
+    cancel_planned_transactions(user_id, [planned[0].id], session)
+    add_modify_transaction_category(user_id, 'Renamed', session, category_id=category_id)
+    mark_transaction_as_recurring(user_id, category_id, session)
+    add_modify_account(user_id, 'Savings', 'saving', session, currency='EUR', amount=2000, account_id=savings_id)
+    deactivate_accounts(user_id, [bank_id + 2], session)
+    currency_conversion(100, 'EUR', 'HUF', date(2025, 7, 11), session)
+    account_balances_from_postings(user_id, session)
+    reconcile_user(user_id, session)
+    apply_matches(user_id, propose_matches(user_id, 2025, 7, session), session)
+    run_overdue_maintenance(session, today=date(2025, 7, 10))
+    delete_transactions(user_id, [new_ids[1]], session)
+    close_month(2025, 7, user_id, session)
+    session.rollback()
+    session.close()
+    assert captured
+    scans = sequential_scans(seeded, captured)
+    assert not scans, "\n".join(f"{tables}: {statement}" for tables, statement in scans)
+
+def data_entry_page(engine):
+    """The components of 1_Data_Entry.py. AppTest runs the source of this function as the page script, so it imports what it needs"""
+    from src.database_engine import session_scope
+    from src.streamlit_components import user_selector, account_balance_overview, transaction_overview, transaction_category_ui, \
+        planned_transactions_ui, close_month_ui, refresh_exchange_rates_ui, balance_checker_ui, partition_report_ui, monthly_totals_ui
+    for component in [refresh_exchange_rates_ui, user_selector, balance_checker_ui, transaction_overview, account_balance_overview,
+                      monthly_totals_ui, transaction_category_ui, planned_transactions_ui, close_month_ui, partition_report_ui]:
+        with session_scope(engine) as session:
+            component(session)
+
+def test_streamlit_queries_use_indexes(seeded, captured):
+    page = AppTest.from_function(data_entry_page, args=(seeded,), default_timeout=60)
+    page.run()
+    assert not page.exception
+    assert captured
+    # Listing every user for the user selector is the one intended full scan, the users table stays small
+    scans = sequential_scans(seeded, captured)
+    assert not scans, "\n".join(f"{tables}: {statement}" for tables, statement in scans)
@@ -0,0 +1,53 @@
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, CurrentAccountBalance, ExchangeRate, Posting, TransactionCategory
+from src.database_dml import add_new_user, add_modify_account, add_transactions_bulk, close_month, account_balances_from_postings, apply_balance_deltas
+from src.reconciliation import reconcile_user, reconcile_all
+from datetime import date, datetime
+from decimal import Decimal
+
+pg = create_postgres_fixture(Base)
+
+def test_reconcile(pg):
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    session.add_all([ExchangeRate(from_currency='EUR', to_currency='HUF', rate=Decimal('400'), date=date(2025, 9, d)) for d in (9, 10)])
+    session.add_all([ExchangeRate(from_currency='HUF', to_currency='EUR', rate=Decimal('0.0025'), date=date(2025, m, d)) for m, d in ((9, 10), (10, 2))])
+    user_id, bank_id = add_new_user('A', 'B', session, 1000)
+    other_user_id, _ = add_new_user('C', 'D', session, 50)
+    savings_id = add_modify_account(user_id, 'Savings', 'saving', session, currency='EUR', amount=10)
+    category = session.query(TransactionCategory).filter_by(user_id=user_id).first()
+    add_transactions_bulk(user_id, [
+        {'category_id': category.id, 'transaction_type': 'debit', 'date': '2025-09-09', 'amount': 5, 'account_id': bank_id, 'trx_currency': 'EUR'},
+        {'category_id': category.id, 'transaction_type': 'transfer', 'date': '2025-09-10', 'amount': 400, 'account_id': bank_id, 'target_account_id': savings_id},
+    ], session)
+    session.commit()
+    assert reconcile_user(user_id, session) == []
+    # Movements after the closed month are added to the snapshot
+    close_month(2025, 9, user_id, session)
+    add_transactions_bulk(user_id, [
+        {'category_id': category.id, 'transaction_type': 'credit', 'date': '2025-10-02', 'amount': 4000, 'account_id': savings_id, 'trx_currency': 'HUF'}
+    ], session)
+    session.commit()
+    assert reconcile_user(user_id, session) == []
+    session.query(CurrentAccountBalance).filter_by(account_id=savings_id).update({'balance': Decimal('99')})
+    session.commit()
+    drifts = reconcile_user(user_id, session)
+    assert [(d.account_id, d.expected_balance, d.difference) for d in drifts] == [(savings_id, Decimal('21'), Decimal('78'))]
+    # Fixing runs in a session per user, the other user has nothing to fix
+    assert len(reconcile_all(pg.engine, fix=True, max_workers=2)) == 1
+    session.expire_all()
+    assert reconcile_all(pg.engine, user_ids=[user_id, other_user_id]) == []
+    assert session.query(CurrentAccountBalance).filter_by(account_id=savings_id).one().balance == Decimal('21')
+
+    # A ledger out of line with the history and transactions gets a reconciliation adjustment, the summary stays the sum of the postings
+    session.add(Posting(user_id=user_id, account_id=bank_id, transaction_id=999, amount=Decimal('50'), currency='HUF', date=datetime.now()))
+    apply_balance_deltas(user_id, {bank_id: Decimal('50')}, session)
+    session.commit()
+    assert [(d.account_id, d.difference) for d in reconcile_user(user_id, session, fix=True)] == [(bank_id, Decimal('50'))]
+    session.commit()
+    assert reconcile_user(user_id, session) == []
+    balances = dict(session.query(CurrentAccountBalance.account_id, CurrentAccountBalance.balance).filter_by(user_id=user_id).all())
+    assert account_balances_from_postings(user_id, session) == balances
+    assert session.query(Posting.amount).filter_by(account_id=bank_id, reconciliation=True).all() == [(Decimal('-50'),)]
+    session.close()
@@ -0,0 +1,67 @@
+import pandas as pd
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, User, TransactionCategory, RecurringTransaction, PlannedTransaction
+from src.recurrence import RECURRENCE_COLUMNS, expand_recurrences, plan_recurring_transactions
+from datetime import date, datetime
+from decimal import Decimal
+
+pg = create_postgres_fixture(Base)
+
+def recurrences(*rows):
+    return pd.DataFrame([dict(zip(RECURRENCE_COLUMNS, r)) for r in rows], columns=RECURRENCE_COLUMNS)
+
+def due_dates(planned, category_id):
+    return [d.strftime('%Y-%m-%d') for d in planned.loc[planned['category_id'] == category_id, 'due_date']]
+
+def test_expand_month_end_and_whole_year():
+    recurring = recurrences(
+        (1, 1, 10, 'monthly', Decimal('100'), 31, None, None, None),
+        (2, 1, 20, 'yearly', Decimal('50'), 31, datetime(2025, 2, 3), Decimal('55'), 'EUR'),
+        (3, 1, 30, 'yearly', Decimal('70'), 10, None, None, None)
+    )
+    planned = expand_recurrences(recurring, date(2025, 10, 1), date(2026, 10, 1))
+    monthly = due_dates(planned, 10)
+    assert len(monthly) == 12
+    assert monthly[:5] == ['2025-10-31', '2025-11-30', '2025-12-31', '2026-01-31', '2026-02-28']
+    # The anchor's month, amount and currency repeat every year
+    yearly = planned[planned['category_id'] == 20]
+    assert due_dates(planned, 20) == ['2026-02-28']
+    assert (yearly['amount'].iloc[0], yearly['currency'].iloc[0]) == (Decimal('55'), 'EUR')
+    # Without an anchor it is planned once, in the first month
+    assert due_dates(planned, 30) == ['2025-10-10']
+
+def test_expand_weekly_and_daily():
+    recurring = recurrences(
+        (1, 1, 10, 'weekly', Decimal('5'), 1, datetime(2025, 1, 6, 12, 0), Decimal('5'), 'HUF'),
+        (2, 1, 20, 'weekly', Decimal('5'), 3, None, None, None),
+        (3, 1, 30, 'daily', Decimal('1'), None, None, None, None)
+    )
+    planned = expand_recurrences(recurring, date(2025, 10, 1), date(2025, 11, 1))
+    # An old anchor is moved forward by whole weeks, still on Mondays
+    assert due_dates(planned, 10) == ['2025-10-06', '2025-10-13', '2025-10-20', '2025-10-27']
+    assert due_dates(planned, 20) == ['2025-10-03', '2025-10-10', '2025-10-17', '2025-10-24', '2025-10-31']
+    assert len(due_dates(planned, 30)) == 31
+    assert expand_recurrences(recurring.iloc[0:0], date(2025, 10, 1), date(2025, 11, 1)).empty
+
+def test_plan_recurring_transactions(pg):
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    user = User(first_name='A', last_name='B')
+    session.add(user)
+    session.flush()
+    category = TransactionCategory(category='Rent', user_id=user.id, effective_from='2025-01-01')
+    inactive = TransactionCategory(category='Old', user_id=user.id, effective_from='2025-01-01', effective_to='2025-06-01')
+    session.add_all([category, inactive])
+    session.flush()
+    session.add_all([
+        RecurringTransaction(user_id=user.id, category_id=category.id, recurrence='monthly', amount=100, due_date_day=30),
+        RecurringTransaction(user_id=user.id, category_id=inactive.id, recurrence='monthly', amount=100, due_date_day=1)
+    ])
+    session.flush()
+    assert plan_recurring_transactions([user.id], date(2026, 1, 1), date(2027, 1, 1), session) == 12
+    assert session.query(PlannedTransaction).filter_by(due_date=date(2026, 2, 28)).count() == 1
+    # Planning an overlapping horizon only adds the missing months
+    assert plan_recurring_transactions([user.id], date(2026, 7, 1), date(2027, 3, 1), session) == 2
+    assert session.query(PlannedTransaction).filter_by(category_id=inactive.id).count() == 0
+    session.close()
@@ -0,0 +1,56 @@
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, TransactionCategory
+from src.database_dml import add_new_user, add_modify_account, add_modify_transaction_category, mark_transaction_as_recurring, \
+    deactivate_accounts
+from src.instrumentation import collect_query_stats, instrument_engine
+from src.reference_data import get_reference_data, get_reference_cache, data_version, pinned_versions
+
+pg = create_postgres_fixture(Base)
+
+def test_reference_data_is_cached_until_a_change(pg):
+    instrument_engine(pg.engine)
+    Session = sessionmaker(bind=pg.engine)
+    session = Session()
+    user_id, bank_id = add_new_user('A', 'B', session)
+    other_user_id, _ = add_new_user('C', 'D', session)
+    session.commit()
+    assert data_version(user_id, session) == 1
+    reference = get_reference_data(user_id, session)
+    assert reference.account_names == {bank_id: 'Bank'}
+    assert len(reference.categories) == 9 and not reference.recurring
+
+    # A fresh session reuses the cached data after checking the version
+    reader = Session()
+    with collect_query_stats() as stats:
+        assert get_reference_data(user_id, reader) is reference
+    assert stats['(total)'].count == 1
+    get_reference_data(other_user_id, reader)
+    with pinned_versions(), collect_query_stats() as stats:
+        for _ in range(3):
+            get_reference_data(user_id, reader)
+            get_reference_data(other_user_id, reader)
+    assert stats['(total)'].count == 2
+    reader.rollback()
+
+    # Every change of the accounts, categories or recurring transactions bumps the version and reloads the data
+    savings_id = add_modify_account(user_id, 'Savings', 'saving', session, currency='EUR')
+    category_id = add_modify_transaction_category(user_id, 'Salary', session)
+    session.commit()
+    reference = get_reference_data(user_id, reader)
+    assert reference.version == 3
+    assert reference.account_names == {bank_id: 'Bank', savings_id: 'Savings'}
+    assert reference.category_names[category_id] == 'Salary'
+    reader.rollback()
+    mark_transaction_as_recurring(user_id, category_id, session, amount=100)
+    deactivate_accounts(user_id, [savings_id], session)
+    session.commit()
+    reference = get_reference_data(user_id, reader)
+    assert [(r.category_id, r.amount) for r in reference.recurring] == [(category_id, 100)]
+    assert [a.id for a in reference.active_accounts] == [bank_id]
+    assert reference.account_names[savings_id] == 'Savings'
+    # The other user's entry is untouched
+    assert get_reference_cache(reader).get(other_user_id, 1) is not None
+    assert session.query(TransactionCategory).filter_by(user_id=other_user_id).count() == 9
+    reader.close()
+    session.close()
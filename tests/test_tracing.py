@@ -0,0 +1,57 @@
+import json
+import pytest
+from pytest_mock_resources import create_postgres_fixture
+from sqlalchemy.orm import sessionmaker
+from models import Base, TransactionCategory
+from src.database_dml import add_new_user, add_transaction
+from src.tracing import configure_tracing, reset_tracing, record, span, traced, span_summary, prometheus_text, flush_metrics
+
+pg = create_postgres_fixture(Base)
+
+@pytest.fixture
+def tracing(tmp_path):
+    configure_tracing(str(tmp_path / "spans.prom"))
+    reset_tracing()
+    yield tmp_path
+    configure_tracing(enabled=False)
+    reset_tracing()
+
+def test_percentiles_and_exports(tracing):
+    for ms in range(1, 101):
+        record('transaction_overview', ms / 1000)
+    summary = span_summary()['transaction_overview']
+    assert (summary['count'], summary['p50_seconds'], summary['p95_seconds']) == (100, 0.05, 0.095)
+    text = prometheus_text()
+    assert 'budget_span_duration_seconds_bucket{span="transaction_overview",le="0.01"} 10' in text
+    assert 'budget_span_duration_seconds_bucket{span="transaction_overview",le="+Inf"} 100' in text
+    assert 'budget_span_recent_duration_seconds{span="transaction_overview",quantile="0.95"} 0.095000' in text
+    assert open(flush_metrics()).read() == text
+    jsonl = str(tracing / "spans.jsonl")
+    flush_metrics(jsonl)
+    flush_metrics(jsonl)
+    lines = [json.loads(line) for line in open(jsonl)]
+    assert len(lines) == 2 and lines[0]['span'] == 'transaction_overview' and lines[0]['p50_seconds'] == 0.05
+
+def test_spans_of_components_and_dml_calls(pg, tracing):
+    session = sessionmaker(bind=pg.engine)()
+    user_id, account_id = add_new_user('A', 'B', session)
+    category_id = session.query(TransactionCategory.id).filter_by(user_id=user_id).first()[0]
+
+    @traced
+    def transaction_overview():
+        add_transaction(user_id, category_id, 'credit', '2025-09-09', 10, session, account_id)
+
+    with span('rerun'):
+        transaction_overview()
+        transaction_overview()
+    spans = span_summary()
+    assert spans['rerun']['count'] == 1
+    assert spans['test_tracing.transaction_overview']['count'] == 2
+    # The instrumented dml functions record spans as well
+    assert spans['database_dml.add_transaction']['count'] == spans['database_dml.add_transactions_bulk']['count'] == 2
+    assert spans['rerun']['sum_seconds'] >= spans['test_tracing.transaction_overview']['sum_seconds']
+    configure_tracing(enabled=False)
+    with span('rerun'):
+        pass
+    assert span_summary()['rerun']['count'] == 1
+    session.close()
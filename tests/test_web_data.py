@@ -1,7 +1,9 @@
 from unittest import mock
 
 import requests
-from src.web_data import fetch_exchange_rates
+from datetime import date
+from tests.fx_stub_server import FxStubServer, stub_rates
+from src.web_data import fetch_exchange_rates, fetch_historical_exchange_rates
 
 @mock.patch("src.web_data.requests.get")
 @mock.patch("src.web_data.os.getenv", return_value="dummy_app_id")
@@ -83,4 +85,15 @@ def test_fetch_exchange_rates_empty_symbols(mock_getenv, mock_get):
     mock_get.return_value = mock_response
 
     result = fetch_exchange_rates([])
-    assert result == []
\ No newline at end of file
+    assert result == []
+
+def test_fetch_historical_exchange_rates_from_stub(monkeypatch):
+    with FxStubServer(missing_days=[date(2025, 3, 2)]) as server:
+        monkeypatch.setenv("EXCHANGE_RATES_API_URL", server.url)
+        result = fetch_historical_exchange_rates(['EUR', 'HUF'], date(2025, 3, 1), date(2025, 3, 3))
+    assert server.requests == [f"/api/historical/2025-03-0{d}.json" for d in (1, 2, 3)]
+    # The day the api could not serve is skipped
+    assert sorted({r['date'] for r in result}) == [date(2025, 3, 1), date(2025, 3, 3)]
+    eur_huf = next(r for r in result if r['date'] == date(2025, 3, 3) and r['from_currency'] == 'EUR' and r['to_currency'] == 'HUF')
+    rates = stub_rates(date(2025, 3, 3))
+    assert eur_huf['rate'] == rates['HUF'] * (1 / rates['EUR'])